@@ -0,0 +1,334 @@
+import gc
+import os
+import random
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from sos.utils.mapgen import encrypt_secret
+from sos.utils.protocol import DEFAULT_CODEC, Packet, JSON_ENCODING, BINARY_ENCODING, ZLIB_COMPRESSION
+from sos.core.database_manager import DatabaseManager
+from sos.core.connection_pool import ConnectionPool
+from sos.core.game_server import GameRunner, GameScheduler
+from sos.core.board import Board
+from sos.core.numpy_board import NumpyBoard, numpy
+from sos.core.game_replay import GameReplay
+from sos.core.game_journal import GameJournal
+
+def legacy_encrypt(bmsg : bytes) -> bytearray:
+    result = bytearray()
+    for b in bmsg:
+        result.append(encrypt_secret[int(b)])
+    return result
+
+def benchmark_cipher(payload_size = 64 * 1024, number = 20):
+    payload = os.urandom(payload_size)
+    assert bytes(legacy_encrypt(payload)) == DEFAULT_CODEC.encode(payload)
+    candidates = [
+        ("per-byte loop", legacy_encrypt),
+        ("translate table (bytes)", DEFAULT_CODEC.encode),
+        ("translate table (in place)", lambda p: DEFAULT_CODEC.encode(bytearray(p)))
+    ]
+    for name, function in candidates:
+        seconds = min(timeit.repeat(lambda: function(payload), number=number, repeat=3))
+        print("{:<28} {:>10.1f} MB/s".format(name, payload_size * number / seconds / 1e6))
+
+def random_board_packet(board_size = 30, player_count = 4, fill = 0.6):
+    colors = ["hsl({}, 100%, 50%)".format(i * 18) for i in range(player_count)]
+    packet = Packet()
+    packet["command"] = "game_runner_board_status"
+    packet["data"] = {"sequence" : 0, "board" : []}
+    for i in range(board_size):
+        packet["data"]["board"].append([])
+        for j in range(board_size):
+            if random.random() < fill:
+                packet["data"]["board"][i].append([random.choice(colors), random.choice("SO")])
+            else:
+                packet["data"]["board"][i].append(["silver", ""])
+    return packet
+
+def benchmark_board_encoding(board_size = 30, number = 50):
+    packet = random_board_packet(board_size)
+    for encoding in [JSON_ENCODING, BINARY_ENCODING]:
+        payload = encoding.dumps(packet)
+        assert encoding.loads(payload) == packet
+        dump_seconds = min(timeit.repeat(lambda: encoding.dumps(packet), number=number, repeat=3)) / number
+        load_seconds = min(timeit.repeat(lambda: encoding.loads(payload), number=number, repeat=3)) / number
+        print("{:<8} {}x{} board: {:>7} bytes, dumps {:>8.1f} us, loads {:>8.1f} us".format(
+            encoding.name, board_size, board_size, len(payload), dump_seconds * 1e6, load_seconds * 1e6
+        ))
+
+def benchmark_compression(board_size = 30, number = 50):
+    packet = random_board_packet(board_size)
+    for encoding in [JSON_ENCODING, BINARY_ENCODING]:
+        plain_frame = packet.to_frame(encoding)
+        compressed_frame = packet.to_frame(encoding, compression=ZLIB_COMPRESSION)
+        seconds = min(timeit.repeat(lambda: packet.to_frame(encoding, compression=ZLIB_COMPRESSION), number=number, repeat=3)) / number
+        print("{:<8} {}x{} board frame: {:>7} bytes plain, {:>7} bytes zlib, to_frame {:>8.1f} us".format(
+            encoding.name, board_size, board_size, len(plain_frame), len(compressed_frame), seconds * 1e6
+        ))
+
+def random_boards(board_size, fill = 0.6):
+    boards = [Board(board_size)]
+    if numpy is not None:
+        boards.append(NumpyBoard(board_size))
+    for i in range(board_size):
+        for j in range(board_size):
+            if random.random() < fill:
+                account_id, letter = random.randint(1, 4), random.choice("SO")
+                for board in boards:
+                    board.set_cell(i, j, account_id, letter)
+    return boards
+
+def benchmark_board_engines(board_size = 100, number = 5):
+    boards = random_boards(board_size)
+    for board in boards:
+        assert board.scoring_moves() == boards[0].scoring_moves()
+        seconds = min(timeit.repeat(board.scoring_moves, number=number, repeat=3)) / number
+        print("{:<11} {}x{} board: scoring_moves {:>9.2f} ms".format(type(board).__name__, board_size, board_size, seconds * 1e3))
+
+class BlockingGameRunner(GameRunner):
+    """
+    The GameRunner loop before GameScheduler, one thread per game blocking on its queue.
+    """
+    def run(self):
+        while True:
+            task = self._tasks_queue.dequeue(block = True, timeout = self.idle_timeout())
+            if task is not None:
+                self.handle_task(task)
+            elif self.check_for_end():
+                return
+
+class PollingGameRunner(GameRunner):
+    """
+    The former GameRunner loop, which checks its queue every 10 ms.
+    """
+    def run(self):
+        while True:
+            if not self._tasks_queue.is_empty():
+                self.handle_task(self._tasks_queue.dequeue())
+            else:
+                if self.check_for_end():
+                    return
+                time.sleep(0.01)
+
+def create_benchmark_games(game_count, board_size = 10):
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3"))
+    db_manager.add_account("benchmark", "benchmark", "BENCH", "MARK")
+    session_token = db_manager.login("benchmark", "benchmark")
+    game_ids = [db_manager.new_game(session_token, board_size, 2, True, 3)[0] for i in range(game_count)]
+    return db_manager, game_ids
+
+def benchmark_idle_games(game_count = 500, seconds = 3):
+    db_manager, game_ids = create_benchmark_games(game_count)
+    for name in ["PollingGameRunner", "BlockingGameRunner", "GameScheduler"]:
+        scheduler = None
+        threads = []
+        if name == "GameScheduler":
+            scheduler = GameScheduler()
+            scheduler.start()
+            runners = [GameRunner(db_manager, game_id, scheduler) for game_id in game_ids]
+            for runner in runners:
+                scheduler.schedule(runner)
+        else:
+            runner_class = PollingGameRunner if name == "PollingGameRunner" else BlockingGameRunner
+            runners = [runner_class(db_manager, game_id) for game_id in game_ids]
+            threads = [threading.Thread(target=runner.run) for runner in runners]
+            for thread in threads:
+                thread.start()
+        time.sleep(0.5)
+        thread_count = threading.active_count()
+        cpu_start = time.process_time()
+        time.sleep(seconds)
+        cpu_seconds = time.process_time() - cpu_start
+        for runner in runners:
+            runner.stop()
+        if scheduler:
+            scheduler.stop()
+        for thread in threads:
+            thread.join()
+        print("{:<18} {} idle games: {:>6.1f}% of one core, {} threads".format(name, game_count, 100 * cpu_seconds / seconds, thread_count))
+
+class ListBoardGameRunner(GameRunner):
+    BOARD_CLASS = Board
+
+def traced_bytes(function):
+    gc.collect()
+    tracemalloc.start()
+    result = function()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return current, result
+
+def benchmark_game_memory(game_count = 1000, board_size = 50):
+    db_manager, game_ids = create_benchmark_games(game_count, board_size)
+    for runner_class in [ListBoardGameRunner, GameRunner]:
+        board_class = runner_class.BOARD_CLASS
+        board_bytes, boards = traced_bytes(lambda: [board_class(board_size) for game_id in game_ids])
+        del boards
+        game_bytes, runners = traced_bytes(lambda: [runner_class(db_manager, game_id) for game_id in game_ids])
+        del runners
+        print("{:<12} {}x{} board: {:>8} bytes per board, {:>8} bytes per hosted game".format(
+            board_class.__name__, board_size, board_size, board_bytes // game_count, game_bytes // game_count
+        ))
+
+class FullGameReplay(GameReplay):
+    """
+    Replays from the first move every time, as without checkpoints.
+    """
+    def nearest_checkpoint(self, game_id, board_size, move_number):
+        return None
+
+    def save_checkpoints(self, game_id, checkpoints):
+        pass
+
+def benchmark_game_replay(board_size = 100, seeks = 20):
+    db_manager, game_ids = create_benchmark_games(1, board_size)
+    cells = [(i, j) for i in range(board_size) for j in range(board_size)]
+    random.shuffle(cells)
+    db_manager.db_cursor.executemany(
+        "INSERT INTO GameLogs (log_number, row_number, column_number, letter, game_id, account_id, log_datetime) VALUES (?, ?, ?, ?, ?, ?, ?);",
+        [(i + 1, row + 1, column + 1, random.choice("SO"), game_ids[0], random.randint(1, 2), "") for i, (row, column) in enumerate(cells)]
+    )
+    db_manager.db_connection.commit()
+    move_numbers = [random.randint(1, len(cells)) for i in range(seeks)]
+    replay = GameReplay(db_manager.db_path)
+    start = time.perf_counter()
+    exported = sum(1 for move in replay.moves(game_ids[0]))
+    print("GameReplay.moves   {} moves exported: {:>9.2f} ms".format(exported, (time.perf_counter() - start) * 1e3))
+    replay.replay(game_ids[0]) # stores the checkpoints
+    for replay in [FullGameReplay(db_manager.db_path), replay]:
+        start = time.perf_counter()
+        for move_number in move_numbers:
+            replay.replay(game_ids[0], move_number)
+        seconds = (time.perf_counter() - start) / seeks
+        print("{:<18} {}x{} board: seek {:>9.2f} ms".format(type(replay).__name__, board_size, board_size, seconds * 1e3))
+
+class SharedConnectionPool(ConnectionPool):
+    """
+    The former setup, one connection and cursor for every thread in the default rollback journal mode.
+    """
+    def configure(self, connection):
+        pass
+
+    def connection(self):
+        if not hasattr(self, "shared_connection"):
+            self.shared_connection = self.open()
+            self.shared_cursor = self.shared_connection.cursor()
+        return self.shared_connection
+
+    def cursor(self):
+        self.connection()
+        return self.shared_cursor
+
+class SharedConnectionDatabaseManager(DatabaseManager):
+    CONNECTION_POOL_CLASS = SharedConnectionPool
+
+def benchmark_database_concurrency(thread_count = 8, seconds = 3, write_ratio = 0.1):
+    for manager_class in [SharedConnectionDatabaseManager, DatabaseManager]:
+        db_manager = manager_class(os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3"))
+        db_manager.add_account("benchmark", "benchmark", "BENCH", "MARK")
+        session_token = db_manager.login("benchmark", "benchmark")
+        game_ids = [db_manager.new_game(session_token, 10, 2, True, 3)[0] for i in range(thread_count)]
+        # the shared cursor is only safe with every call under one lock
+        lock = threading.Lock() if manager_class is SharedConnectionDatabaseManager else None
+        counts = [0] * thread_count
+        deadline = time.perf_counter() + seconds
+        def worker(i):
+            generator = random.Random(i)
+            while time.perf_counter() < deadline:
+                if lock:
+                    lock.acquire()
+                try:
+                    if generator.random() < write_ratio:
+                        db_manager.add_game_log(game_ids[i], 1, "S", generator.randrange(10), generator.randrange(10))
+                    else:
+                        db_manager.get_game_information(game_ids[i])
+                        db_manager.validate_session_token(session_token)
+                finally:
+                    if lock:
+                        lock.release()
+                counts[i] += 1
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db_manager.close_connection()
+        print("{:<32} {} threads, {:.0%} writes: {:>8.0f} operations/s".format(
+            manager_class.__name__, thread_count, write_ratio, sum(counts) / seconds
+        ))
+
+def benchmark_move_logging(moves = 2000):
+    db_manager, game_ids = create_benchmark_games(1)
+    journal = GameJournal(db_manager)
+    journal.start()
+    for name, writer in [("add_game_log", db_manager), ("GameJournal", journal)]:
+        latencies = []
+        for i in range(moves):
+            start = time.perf_counter()
+            writer.add_game_log(game_ids[0], 1, "S", i % 10, i // 10 % 10)
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        journal.flush()
+        flush_seconds = time.perf_counter() - start
+        latencies.sort()
+        print("{:<13} {} moves: mean {:>7.1f} us, p99 {:>7.1f} us per move, {:>6.1f} ms left to flush".format(
+            name, moves, sum(latencies) / moves * 1e6, latencies[len(latencies) * 99 // 100] * 1e6, flush_seconds * 1e3
+        ))
+    journal.stop()
+
+def counting_add_game_log(db_manager, game_id, account_id, letter, row_number, column_number):
+    # the former numbering, fetching every move of the game to count them
+    db_manager.db_cursor.execute("SELECT log_number FROM GameLogs WHERE (game_id = ?);", (game_id,))
+    log_number = len(db_manager.db_cursor.fetchall()) + 1
+    db_manager.add_game_log(game_id, account_id, letter, row_number, column_number, log_number)
+
+def benchmark_log_numbering(table_sizes = (10 ** 4, 10 ** 5, 10 ** 6, 2 * 10 ** 6), game_length = 400, inserts = 500):
+    db_manager, game_ids = create_benchmark_games(1)
+    rows = 0
+    for table_size in table_sizes:
+        db_manager.db_cursor.executemany( # finished games of game_length moves
+            "INSERT INTO GameLogs (log_number, row_number, column_number, letter, game_id, account_id, log_datetime) VALUES (?, ?, ?, ?, ?, ?, ?);",
+            ((i % game_length + 1, 1, 1, "S", 10 ** 6 + i // game_length, 1, "") for i in range(rows, table_size))
+        )
+        db_manager.db_connection.commit()
+        rows = table_size
+        results = []
+        for name in ["counting", "sequence"]:
+            log_number = db_manager.get_game_sequence_numbers(game_ids[0])[0] # what a runner does once, when the game loads
+            start = time.perf_counter()
+            for i in range(inserts):
+                if name == "counting":
+                    counting_add_game_log(db_manager, game_ids[0], 1, "S", 0, 0)
+                else:
+                    log_number += 1
+                    db_manager.add_game_log(game_ids[0], 1, "S", 0, 0, log_number)
+            results.append("{} {:>7.1f} us".format(name, (time.perf_counter() - start) / inserts * 1e6))
+        print("GameLogs {:>8} rows, played game {:>5} moves: {}".format(
+            table_size, db_manager.get_game_sequence_numbers(game_ids[0])[0], ", ".join(results)
+        ))
+
+def benchmark_session_validation(sessions = 100, number = 20000):
+    for session_cache_size in [0, None]:
+        db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "benchmark.sqlite3"), session_cache_size = session_cache_size)
+        db_manager.add_account("benchmark", "benchmark", "BENCH", "MARK")
+        tokens = [db_manager.login("benchmark", "benchmark") for i in range(sessions)]
+        seconds = timeit.timeit(lambda: db_manager.validate_session_token(random.choice(tokens)), number=number) / number
+        print("{:<15} {} sessions: validate_session_token {:>6.2f} us".format(
+            "SessionCache" if session_cache_size is None else "no cache", sessions, seconds * 1e6
+        ))
+
+if __name__ == "__main__":
+    benchmark_cipher()
+    benchmark_board_encoding()
+    benchmark_compression()
+    benchmark_board_engines()
+    benchmark_idle_games()
+    benchmark_game_memory()
+    benchmark_game_replay()
+    benchmark_database_concurrency()
+    benchmark_move_logging()
+    benchmark_log_numbering()
+    benchmark_session_validation()
@@ -12,5 +12,6 @@ class SOSGameServerApp(QApplication):
         self.main_window = MainWindow(self.db_model)
         self.main_window.show()
 
-app = SOSGameServerApp(sys.argv)
-app.exec_()
+if __name__ == "__main__": # bot searches and game shards start spawned processes, which import this module again
+    app = SOSGameServerApp(sys.argv)
+    app.exec_()
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+from threading import Lock
+
+class AccountCache:
+    """
+    AccountCache keeps the username and display fields of recently used accounts by account_id,
+    evicting the least recently used one beyond max_size entries (0 disables it).
+    DatabaseManager fills it on a miss and writes the new fields through whenever it updates an account.
+    A fill that read the database before a write or an invalidation is dropped, it may hold the old values.
+    """
+    MAX_SIZE = 4096
+    FIELDS = frozenset(("username", "first_name", "last_name"))
+    def __init__(self, max_size = None):
+        self.max_size = max_size if max_size is not None else AccountCache.MAX_SIZE
+        self.__accounts = OrderedDict() # least recently used first
+        self.__lock = Lock()
+        self.__generation = 0 # writes and invalidations so far
+        self.__counters = {
+            "hits" : 0,
+            "misses" : 0,
+            "evictions" : 0,
+            "writes" : 0,
+            "invalidations" : 0
+        }
+
+    def get(self, account_id : int):
+        """
+        Returns (account, generation), account is None on a miss and generation is to be passed to put().
+        """
+        with self.__lock:
+            account = self.__accounts.get(account_id)
+            if account is None:
+                self.__counters["misses"] += 1
+            else:
+                self.__accounts.move_to_end(account_id)
+                self.__counters["hits"] += 1
+            return account, self.__generation
+
+    def put(self, account_id : int, account : dict, generation : int):
+        with self.__lock:
+            if generation != self.__generation or self.max_size == 0:
+                return
+            self.__store(account_id, account)
+
+    def write(self, account_id : int, fields : dict):
+        """
+        Writes the changed fields of an account through to its entry. An account that is not cached is only
+        added when fields holds all of FIELDS.
+        """
+        with self.__lock:
+            self.__generation += 1
+            self.__counters["writes"] += 1
+            account = self.__accounts.get(account_id)
+            if self.max_size == 0 or (account is None and not AccountCache.FIELDS <= fields.keys()):
+                return
+            # a new dict, readers may still hold the old one
+            self.__store(account_id, dict(account or {}, **fields))
+
+    def __store(self, account_id, account):
+        self.__accounts[account_id] = account
+        self.__accounts.move_to_end(account_id)
+        if len(self.__accounts) > self.max_size:
+            self.__accounts.popitem(last=False)
+            self.__counters["evictions"] += 1
+
+    def invalidate(self, account_id : int):
+        with self.__lock:
+            self.__accounts.pop(account_id, None)
+            self.__generation += 1
+            self.__counters["invalidations"] += 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            result = dict(self.__counters)
+            result["size"] = len(self.__accounts)
+        lookups = result["hits"] + result["misses"]
+        result["hit_rate"] = result["hits"] / lookups if lookups else 0.0
+        return result
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+class AdmissionRejectedError(Exception):
+    pass
+
+class TokenBucket:
+    """
+    TokenBucket allows rate requests per second on average and bursts of up to burst requests.
+    """
+    def __init__(self, rate : float, burst : int):
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = float(burst)
+        self.__last_refill = monotonic()
+
+    def has_token(self) -> bool:
+        # callers serialize access, AdmissionController holds its lock
+        now = monotonic()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__last_refill) * self.rate)
+        self.__last_refill = now
+        return self.__tokens >= 1
+
+    def take(self):
+        # only after has_token returned True
+        self.__tokens -= 1
+
+class Admission:
+    def __init__(self, controller, client_host):
+        self.__controller = controller
+        self.__client_host = client_host
+
+    def __enter__(self):
+        self.__controller.acquire(self.__client_host)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__controller.release()
+
+class AdmissionController:
+    """
+    AdmissionController guards the expensive account commands (login and signup hash a password under the database lock).
+    A request needs a token from its client's bucket and from the global bucket, and at most max_pending requests
+    may be waiting for the database at once. Anything else is rejected at once with AdmissionRejectedError.
+    """
+    PER_CLIENT_RATE = 2
+    PER_CLIENT_BURST = 10
+    GLOBAL_RATE = 50
+    GLOBAL_BURST = 100
+    MAX_PENDING = 16
+    MAX_TRACKED_CLIENTS = 10000
+    def __init__(self, per_client_rate = None, per_client_burst = None, global_rate = None, global_burst = None, max_pending = None):
+        self.per_client_rate = per_client_rate if per_client_rate else AdmissionController.PER_CLIENT_RATE
+        self.per_client_burst = per_client_burst if per_client_burst else AdmissionController.PER_CLIENT_BURST
+        self.max_pending = max_pending if max_pending else AdmissionController.MAX_PENDING
+        self.__global_bucket = TokenBucket(
+            global_rate if global_rate else AdmissionController.GLOBAL_RATE,
+            global_burst if global_burst else AdmissionController.GLOBAL_BURST
+        )
+        self.__client_buckets = OrderedDict() # least recently seen client first
+        self.__lock = Lock()
+        self.__pending = 0
+        self.__counters = {
+            "admitted" : 0,
+            "rejected_client_rate" : 0,
+            "rejected_global_rate" : 0,
+            "rejected_pending" : 0
+        }
+
+    def admit(self, client_host : str) -> Admission:
+        """
+        Returns a context manager holding a pending slot for client_host while the request runs.
+        """
+        return Admission(self, client_host)
+
+    def acquire(self, client_host : str):
+        with self.__lock:
+            if self.__pending >= self.max_pending:
+                self.__counters["rejected_pending"] += 1
+                raise AdmissionRejectedError("Server is busy, try again later.")
+            bucket = self.__client_buckets.get(client_host)
+            if bucket is None:
+                bucket = TokenBucket(self.per_client_rate, self.per_client_burst)
+                self.__client_buckets[client_host] = bucket
+                if len(self.__client_buckets) > AdmissionController.MAX_TRACKED_CLIENTS:
+                    self.__client_buckets.popitem(last=False) # a forgotten client starts over with a full bucket
+            else:
+                self.__client_buckets.move_to_end(client_host)
+            # a rejected request spends no token, from either bucket
+            if not bucket.has_token():
+                self.__counters["rejected_client_rate"] += 1
+                raise AdmissionRejectedError("Too many requests, try again later.")
+            if not self.__global_bucket.has_token():
+                self.__counters["rejected_global_rate"] += 1
+                raise AdmissionRejectedError("Server is busy, try again later.")
+            bucket.take()
+            self.__global_bucket.take()
+            self.__pending += 1
+            self.__counters["admitted"] += 1
+
+    def release(self):
+        with self.__lock:
+            self.__pending -= 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            result = dict(self.__counters)
+            result["pending"] = self.__pending
+            result["tracked_clients"] = len(self.__client_buckets)
+        return result
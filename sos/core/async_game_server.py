@@ -0,0 +1,172 @@
+import asyncio
+import traceback
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from sos.utils.protocol import Packet, AsyncConnection, ProtocolError
+from sos.core.game_server import GameRunner, ClientTask, GameServer, CLIENT_COMMANDS
+from sos.core.admission_control import AdmissionController
+from sos.core.game_journal import GameJournal
+from sos.core.bot import BotConnection, shutdown_search_pool
+
+class AsyncGameRunner(GameRunner):
+    """
+    AsyncGameRunner runs a game as a coroutine on the server's event loop instead of in its own thread.
+    Its tasks wait on the loop but are handled one at a time on executor, they write to the database.
+    """
+    def __init__(self, db_manager, game_id, loop, journal = None, executor = None):
+        super().__init__(db_manager, game_id, journal = journal)
+        self.__loop = loop
+        self.__executor = executor
+        self.__tasks = asyncio.Queue()
+
+    def enqueue_task(self, task):
+        self.__loop.call_soon_threadsafe(self.__tasks.put_nowait, task)
+
+    def start_player_listener(self, account_id, connection):
+        asyncio.run_coroutine_threadsafe(self.async_player_listener(account_id, connection), self.__loop) # called on executor
+
+    async def async_player_listener(self, account_id, connection):
+        while True:
+            try:
+                response = await connection.recv_async()
+            except ProtocolError as error:
+                print("Disconnecting player", account_id, error)
+                response = Packet()
+            task = self.task_from_packet(account_id, response)
+            if task:
+                self.__tasks.put_nowait(task)
+                if task["command"] == "disconnect_player_task":
+                    return
+
+    async def run_async(self):
+        while True:
+            try:
+                if not self.__tasks.empty():
+                    task = self.__tasks.get_nowait()
+                else:
+                    task = await asyncio.wait_for(self.__tasks.get(), self.idle_timeout())
+            except asyncio.TimeoutError:
+                if await self.__loop.run_in_executor(self.__executor, self.check_for_end):
+                    return
+            else:
+                try:
+                    await self.__loop.run_in_executor(self.__executor, self.handle_task, task)
+                except Exception:
+                    traceback.print_exc()
+
+class AsyncGameServer(Thread):
+    """
+    AsyncGameServer serves the same protocol as GameServer from one asyncio event loop.
+    Game runners and player listeners are coroutines, account commands and game tasks still run
+    on a worker pool because the database calls block.
+    """
+    def __init__(self, db_manager, host = None, port = None, max_frame_size = None, keep_alive_timeout = None, keep_alive_max_requests = None, admission = None, journal = None):
+        super().__init__()
+        self.__server_host = host if host else GameServer.DEFAULT_HOST
+        self.__server_port = port if port else GameServer.DEFAULT_PORT
+        self.__max_frame_size = max_frame_size
+        self.keep_alive_timeout = keep_alive_timeout if keep_alive_timeout else GameServer.KEEP_ALIVE_TIMEOUT
+        self.keep_alive_max_requests = keep_alive_max_requests if keep_alive_max_requests else GameServer.KEEP_ALIVE_MAX_REQUESTS
+        self.admission = admission if admission else AdmissionController()
+        self.journal = journal if journal else GameJournal(db_manager)
+        self.__db_manager = db_manager
+        self._game_runners = {}
+        self.__runner_tasks = set()
+        self.__loop = None
+        self.__executor = None
+        self.__stop_event = None
+        self.__is_paused = False
+        self.__is_stopped = False
+
+    def add_to_runners(self, game_id):
+        runner = AsyncGameRunner(self.__db_manager, game_id, self.__loop, self.journal, self.__executor)
+        self._game_runners[game_id] = runner
+        self.__loop.call_soon_threadsafe(self.start_runner, runner)
+
+    def connect_player(self, game_id, account_id, connection, client_address, new_game = False):
+        if new_game:
+            self.add_to_runners(game_id)
+        task = {
+            "command" : "new_player_connection_task",
+            "account_id" : account_id,
+            "connection" : connection,
+            "client_address" : client_address
+        }
+        self._game_runners[game_id].enqueue_task(task)
+
+    def add_bot(self, game_id, account_id, difficulty):
+        self.connect_player(game_id, account_id, BotConnection(difficulty), None)
+
+    def start_runner(self, runner):
+        task = self.__loop.create_task(runner.run_async())
+        self.__runner_tasks.add(task)
+        task.add_done_callback(self.__runner_tasks.discard)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__stop_event = asyncio.Event()
+        self.__executor = ThreadPoolExecutor()
+        self.journal.start()
+        server = await asyncio.start_server(self.handle_client, self.__server_host, self.__server_port)
+        if self.__is_stopped:
+            self.__stop_event.set()
+        await self.__stop_event.wait()
+        server.close()
+        for runner in self._game_runners.values():
+            runner.stop()
+        if self.__runner_tasks:
+            await asyncio.wait(self.__runner_tasks)
+        self._game_runners.clear()
+        self.__executor.shutdown()
+        shutdown_search_pool()
+        self.journal.stop()
+
+    async def handle_client(self, stream_reader, stream_writer):
+        address = stream_writer.get_extra_info("peername")
+        print("Connected from", address[0], address[1])
+        connection = AsyncConnection(stream_reader, stream_writer, self.__loop, max_frame_size = self.__max_frame_size)
+        try:
+            request = await connection.recv_async()
+        except ProtocolError as error:
+            print("Rejected request from", address[0], address[1], error)
+            connection.close()
+            return
+        client_task = ClientTask(self.__db_manager, self, connection, address)
+        while await self.__loop.run_in_executor(self.__executor, client_task.handle_request, request):
+            try:
+                request = await asyncio.wait_for(connection.recv_async(), self.keep_alive_timeout)
+            except (ProtocolError, asyncio.TimeoutError):
+                connection.close()
+                return
+
+    def command_metrics(self) -> dict:
+        return CLIENT_COMMANDS.metrics()
+
+    def admission_stats(self) -> dict:
+        return self.admission.stats()
+
+    def account_cache_stats(self) -> dict:
+        return self.__db_manager.account_cache.stats()
+
+    def session_cache_stats(self) -> dict:
+        return self.__db_manager.session_cache.stats()
+
+    def journal_stats(self) -> dict:
+        return self.journal.stats()
+
+    def pause(self):
+        self.__is_paused = True
+
+    def is_paused(self):
+        return self.__is_paused
+
+    def is_stopped(self):
+        return self.__is_stopped
+
+    def stop(self):
+        self.__is_stopped = True
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__stop_event.set)
@@ -0,0 +1,180 @@
+from array import array
+
+# neighbour directions in the order Board.check_for_sos_triple visits them, direction i is opposite to direction 7 - i
+DIRECTIONS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+class Board:
+    """
+    Board holds the letter and owner account_id of every cell, as [owner, letter] lists, and finds SOS triples.
+    """
+    __slots__ = ("size", "cells")
+    def __init__(self, board_size):
+        self.size = board_size
+        self.cells = [[[None, None] for i in range(board_size)] for j in range(board_size)]
+
+    def owner(self, row, column):
+        return self.cells[row][column][0]
+
+    def letter(self, row, column):
+        return self.cells[row][column][1]
+
+    def set_cell(self, row, column, owner, letter):
+        self.cells[row][column] = [owner, letter]
+
+    def letter_codes(self) -> bytes:
+        # row-major letters, 0 for empty, 1 for "S" and 2 for "O"
+        return bytes(CompactBoard.LETTER_CODES[self.letter(i, j)] for i in range(self.size) for j in range(self.size))
+
+    def check_for_sos_triple(self, account_id, row, column, letter, no_act = False, changed_cells = None):
+        neighbour_cells = [
+            (row - 1, column - 1),
+            (row - 1, column),
+            (row - 1, column + 1),
+            (row, column - 1),
+            (row, column + 1),
+            (row + 1, column - 1),
+            (row + 1, column),
+            (row + 1, column + 1)
+        ]
+        second_layer_neighbor_cells = [
+            (row - 2, column - 2),
+            (row - 2, column),
+            (row - 2, column + 2),
+            (row, column - 2),
+            (row, column + 2),
+            (row + 2, column - 2),
+            (row + 2, column),
+            (row + 2, column + 2)
+        ]
+        found = False
+        counter = 0
+        if letter == "S":
+            for i in range(8):
+                cell = neighbour_cells[i]
+                if 0 <= cell[0] < self.size and 0 <= cell[1] < self.size:
+                    if self.cells[cell[0]][cell[1]][1] == "O":
+                        second_layer_cell = second_layer_neighbor_cells[i]
+                        if 0 <= second_layer_cell[0] < self.size and 0 <= second_layer_cell[1] < self.size:
+                            if self.cells[second_layer_cell[0]][second_layer_cell[1]][1] == "S":
+                                found = True
+                                counter += 1
+                                if not no_act:
+                                    self.cells[second_layer_cell[0]][second_layer_cell[1]][0] = account_id
+                                    self.cells[cell[0]][cell[1]][0] = account_id
+                                    if changed_cells is not None:
+                                        changed_cells[second_layer_cell] = True
+                                        changed_cells[cell] = True
+        else: # letter == "O"
+            for i in range(4):
+                row1 = neighbour_cells[i][0]
+                row2 = neighbour_cells[7 - i][0]
+                col1 = neighbour_cells[i][1]
+                col2 = neighbour_cells[7 - i][1]
+                if 0 <= row1 < self.size and 0 <= col1 < self.size and 0 <= col2 < self.size and 0 <= row2 < self.size:
+                    if self.cells[row1][col1][1] == self.cells[row2][col2][1] == "S":
+                        found = True
+                        counter += 1
+                        if not no_act:
+                            self.cells[row1][col1][0] = account_id
+                            self.cells[row2][col2][0] = account_id
+                            if changed_cells is not None:
+                                changed_cells[(row1, col1)] = True
+                                changed_cells[(row2, col2)] = True
+        return found, counter
+
+    def count_sos_triples(self, row, column, letter) -> int:
+        return self.check_for_sos_triple(None, row, column, letter, no_act = True)[1]
+
+    def scoring_moves(self) -> dict:
+        """
+        Returns {(row, column, letter) : count} for every move on an empty cell that completes a triple.
+        """
+        moves = {}
+        for i in range(self.size):
+            for j in range(self.size):
+                if self.letter(i, j) is None:
+                    for letter in ("S", "O"):
+                        count = self.count_sos_triples(i, j, letter)
+                        if count:
+                            moves[(i, j, letter)] = count
+        return moves
+
+class CompactBoard(Board):
+    """
+    CompactBoard is a Board in two flat arrays: a letter code byte and a 16 bit owner index per cell.
+    Owner indexes map to account_ids through a small table, index 0 is no owner.
+    """
+    __slots__ = ("__letters", "__owners", "__owner_ids")
+    LETTERS = (None, "S", "O")
+    LETTER_CODES = {None : 0, "S" : 1, "O" : 2}
+    S = 1
+    O = 2
+    def __init__(self, board_size):
+        self.size = board_size
+        self.__letters = bytearray(board_size * board_size)
+        self.__owners = array("h", bytes(2 * board_size * board_size))
+        self.__owner_ids = [None]
+
+    def owner_index(self, account_id) -> int:
+        if account_id not in self.__owner_ids:
+            self.__owner_ids.append(account_id)
+        return self.__owner_ids.index(account_id)
+
+    def owner(self, row, column):
+        return self.__owner_ids[self.__owners[row * self.size + column]]
+
+    def letter(self, row, column):
+        return CompactBoard.LETTERS[self.__letters[row * self.size + column]]
+
+    def set_cell(self, row, column, owner, letter):
+        self.__owners[row * self.size + column] = self.owner_index(owner)
+        self.__letters[row * self.size + column] = CompactBoard.LETTER_CODES[letter]
+
+    def letter_codes(self) -> bytes:
+        return bytes(self.__letters)
+
+    def checkpoint(self) -> tuple:
+        """
+        Returns (letters, owners, owner_ids), the two arrays as bytes and the owner table, from_checkpoint rebuilds the board.
+        """
+        return bytes(self.__letters), self.__owners.tobytes(), list(self.__owner_ids)
+
+    @classmethod
+    def from_checkpoint(cls, board_size, letters, owners, owner_ids):
+        board = cls(board_size)
+        board.__letters[:] = letters
+        board.__owners = array("h")
+        board.__owners.frombytes(owners)
+        board.__owner_ids = list(owner_ids)
+        return board
+
+    def check_for_sos_triple(self, account_id, row, column, letter, no_act = False, changed_cells = None):
+        size = self.size
+        letters = self.__letters
+        triples = []
+        if letter == "S":
+            for row_offset, column_offset in DIRECTIONS:
+                row2 = row + 2 * row_offset
+                column2 = column + 2 * column_offset
+                if 0 <= row2 < size and 0 <= column2 < size:
+                    row1 = row + row_offset
+                    column1 = column + column_offset
+                    if letters[row1 * size + column1] == CompactBoard.O and letters[row2 * size + column2] == CompactBoard.S:
+                        triples.append(((row2, column2), (row1, column1)))
+        else: # letter == "O"
+            for row_offset, column_offset in DIRECTIONS[:4]:
+                row1 = row + row_offset
+                column1 = column + column_offset
+                row2 = row - row_offset
+                column2 = column - column_offset
+                if 0 <= row1 < size and 0 <= column1 < size and 0 <= row2 < size and 0 <= column2 < size:
+                    if letters[row1 * size + column1] == letters[row2 * size + column2] == CompactBoard.S:
+                        triples.append(((row1, column1), (row2, column2)))
+        if not no_act:
+            owner_index = self.owner_index(account_id)
+            for triple in triples:
+                for cell_row, cell_column in triple:
+                    self.__owners[cell_row * size + cell_column] = owner_index
+                    if changed_cells is not None:
+                        changed_cells[(cell_row, cell_column)] = True
+        return len(triples) > 0, len(triples)
@@ -0,0 +1,271 @@
+import os
+import multiprocessing
+from time import monotonic
+from threading import Lock
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from sos.core.board import DIRECTIONS
+
+EMPTY = 0
+S = 1
+O = 2
+LETTERS = [None, "S", "O"]
+DIFFICULTIES = { # seconds of search per move
+    "easy" : 0.1,
+    "medium" : 0.5,
+    "hard" : 2.0
+}
+MAX_BRANCHING = 16 # moves searched below the root, best ordered first
+MAX_QUIET_ISOLATED = 4 # moves far from every letter give nothing away and are all alike
+MAX_TABLE_SIZE = 500000
+EXACT = 0
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+class BotError(Exception):
+    pass
+
+class SearchTimeout(Exception):
+    pass
+
+# transposition table of the worker process, position -> (depth, value, flag, best move).
+# SOS is impartial, a value is for whoever moves next, so the letters alone are the key.
+transposition_table = {}
+
+def count_triples(letters, size, row, column, letter) -> int:
+    count = 0
+    if letter == S:
+        for row_offset, column_offset in DIRECTIONS:
+            row2 = row + 2 * row_offset
+            column2 = column + 2 * column_offset
+            if 0 <= row2 < size and 0 <= column2 < size:
+                if letters[(row + row_offset) * size + column + column_offset] == O and letters[row2 * size + column2] == S:
+                    count += 1
+    else:
+        for row_offset, column_offset in DIRECTIONS[:4]:
+            row1 = row + row_offset
+            column1 = column + column_offset
+            row2 = row - row_offset
+            column2 = column - column_offset
+            if 0 <= row1 < size and 0 <= column1 < size and 0 <= row2 < size and 0 <= column2 < size:
+                if letters[row1 * size + column1] == letters[row2 * size + column2] == S:
+                    count += 1
+    return count
+
+def is_isolated(letters, size, row, column) -> bool:
+    for i in range(max(row - 2, 0), min(row + 3, size)):
+        for j in range(max(column - 2, 0), min(column + 3, size)):
+            if letters[i * size + j] != EMPTY:
+                return False
+    return True
+
+def ordered_moves(letters, size) -> list:
+    """
+    Returns (gain, index, letter) for the moves worth searching: scoring moves by gain,
+    then a few moves away from every letter, then the other quiet moves. Moves away from every letter
+    past the first few are left out.
+    """
+    scoring = []
+    isolated = []
+    quiet = []
+    for index in range(size * size):
+        if letters[index] != EMPTY:
+            continue
+        row, column = divmod(index, size)
+        if is_isolated(letters, size, row, column): # no letter within reach, so it cannot score
+            if len(isolated) < MAX_QUIET_ISOLATED:
+                isolated.append((0, index, S))
+            continue
+        for letter in (S, O):
+            gain = count_triples(letters, size, row, column, letter)
+            if gain:
+                scoring.append((gain, index, letter))
+            else:
+                quiet.append((0, index, letter))
+    scoring.sort(reverse=True)
+    return scoring + isolated + quiet
+
+def best_gain(letters, size) -> int:
+    best = 0
+    for index in range(size * size):
+        if letters[index] == EMPTY:
+            row, column = divmod(index, size)
+            best = max(best, count_triples(letters, size, row, column, S), count_triples(letters, size, row, column, O))
+    return best
+
+def negamax(letters, size, depth, alpha, beta, deadline) -> int:
+    """
+    Returns how many more triples the player to move makes than the others from here on, a scoring move
+    is followed by another move of the same player. The others are searched as one opponent.
+    """
+    if monotonic() > deadline:
+        raise SearchTimeout()
+    if depth == 0:
+        return best_gain(letters, size) # the player to move takes what is on offer
+    key = bytes(letters)
+    entry = transposition_table.get(key)
+    table_move = None
+    if entry is not None:
+        entry_depth, value, flag, table_move = entry
+        if entry_depth >= depth:
+            if flag == EXACT:
+                return value
+            if flag == LOWER_BOUND:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+    moves = ordered_moves(letters, size)[:MAX_BRANCHING]
+    if not moves:
+        return 0
+    if table_move is not None and table_move in moves:
+        moves.remove(table_move)
+        moves.insert(0, table_move)
+    original_alpha = alpha
+    best_value = None
+    best_move = None
+    for move in moves:
+        gain, index, letter = move
+        letters[index] = letter
+        try:
+            if gain:
+                value = gain + negamax(letters, size, depth - 1, alpha - gain, beta - gain, deadline)
+            else:
+                value = -negamax(letters, size, depth - 1, -beta, -alpha, deadline)
+        finally:
+            letters[index] = EMPTY
+        if best_value is None or value > best_value:
+            best_value = value
+            best_move = move
+        alpha = max(alpha, value)
+        if alpha >= beta:
+            break
+    if best_value <= original_alpha:
+        flag = UPPER_BOUND
+    elif best_value >= beta:
+        flag = LOWER_BOUND
+    else:
+        flag = EXACT
+    transposition_table[key] = (depth, best_value, flag, best_move)
+    return best_value
+
+def search(letters : bytes, size : int, time_budget : float) -> tuple:
+    """
+    Iterative deepening alpha-beta search, returns the (row, column, letter) chosen by the deepest
+    search finished within time_budget seconds.
+    """
+    deadline = monotonic() + time_budget
+    if len(transposition_table) > MAX_TABLE_SIZE:
+        transposition_table.clear()
+    letters = bytearray(letters)
+    moves = ordered_moves(letters, size)
+    if not moves:
+        return None
+    best_move = moves[0]
+    depth = 1
+    try:
+        while depth <= len(moves):
+            alpha = -size * size
+            beta = size * size
+            depth_best_move = None
+            for move in moves:
+                gain, index, letter = move
+                letters[index] = letter
+                try:
+                    if gain:
+                        value = gain + negamax(letters, size, depth - 1, alpha - gain, beta - gain, deadline)
+                    else:
+                        value = -negamax(letters, size, depth - 1, -beta, -alpha, deadline)
+                finally:
+                    letters[index] = EMPTY
+                if depth_best_move is None or value > alpha:
+                    alpha = max(alpha, value)
+                    depth_best_move = move
+            best_move = depth_best_move
+            moves.remove(best_move) # search the best move first next time
+            moves.insert(0, best_move)
+            depth += 1
+    except SearchTimeout:
+        pass
+    gain, index, letter = best_move
+    return index // size, index % size, LETTERS[letter]
+
+search_pool = None
+search_pool_lock = Lock()
+
+def get_search_pool() -> Executor:
+    global search_pool
+    with search_pool_lock:
+        if search_pool is None:
+            if multiprocessing.current_process().daemon:
+                # a game shard process may not have children, it is a process of its own already
+                search_pool = ThreadPoolExecutor(1)
+            else:
+                search_pool = ProcessPoolExecutor(os.cpu_count(), multiprocessing.get_context("spawn"))
+        return search_pool
+
+def shutdown_search_pool():
+    global search_pool
+    with search_pool_lock:
+        if search_pool is not None:
+            search_pool.shutdown(wait=False, cancel_futures=True)
+            search_pool = None
+
+def check_difficulty(difficulty):
+    if difficulty not in DIFFICULTIES:
+        raise BotError("Unknown bot difficulty {}, use one of {}.".format(difficulty, ", ".join(DIFFICULTIES)))
+
+class BotConnection:
+    """
+    BotConnection takes the place of a player's Connection for a bot account.
+    GameRunner sends to it like to any player, it answers "game_runner_your_turn" with a move
+    searched in the process pool for as long as its difficulty allows.
+    """
+    frame_format = None # bots need no frames, broadcast skips serializing for them
+    def __init__(self, difficulty):
+        check_difficulty(difficulty)
+        self.difficulty = difficulty
+        self.time_budget = DIFFICULTIES[difficulty]
+        self.__runner = None
+        self.__account_id = None
+
+    def attach(self, runner, account_id):
+        self.__runner = runner
+        self.__account_id = account_id
+
+    def to_frame(self, packet):
+        return None
+
+    def send_frame(self, frame, group = None, snapshot = False):
+        pass
+
+    def send(self, packet, group = None, snapshot = False):
+        if packet.get("command") == "game_runner_your_turn":
+            letters, size = self.__runner.board_letters()
+            try:
+                future = get_search_pool().submit(search, letters, size, self.time_budget)
+            except RuntimeError: # the pool is shutting down with the server
+                return
+            future.add_done_callback(lambda future: self.play(future, letters, size))
+
+    def play(self, future, letters, size):
+        try:
+            move = future.result()
+        except Exception: # lost the worker process, play the first move found
+            move = None
+            moves = ordered_moves(bytearray(letters), size)
+            if moves:
+                gain, index, letter = moves[0]
+                move = index // size, index % size, LETTERS[letter]
+        if move is None:
+            return
+        self.__runner.enqueue_task({
+            "command" : "player_turn_done_task",
+            "account_id" : self.__account_id,
+            "row" : move[0],
+            "column" : move[1],
+            "letter" : move[2]
+        })
+
+    def close(self):
+        pass
@@ -0,0 +1,117 @@
+from collections import deque
+from threading import Lock
+from time import perf_counter
+from sos.utils.protocol import Packet
+
+class MissingFieldError(Exception):
+    pass
+
+class CommandMetrics:
+    """
+    CommandMetrics counts calls and errors of one command and keeps its most recent latencies for percentiles.
+    """
+    MAX_SAMPLES = 1024
+    PERCENTILES = (50, 90, 99)
+    def __init__(self):
+        self.__lock = Lock()
+        self.__count = 0
+        self.__errors = 0
+        self.__latencies = deque(maxlen=CommandMetrics.MAX_SAMPLES)
+
+    def record(self, seconds : float, failed : bool):
+        with self.__lock:
+            self.__count += 1
+            if failed:
+                self.__errors += 1
+            self.__latencies.append(seconds)
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            count = self.__count
+            errors = self.__errors
+            latencies = sorted(self.__latencies)
+        result = {
+            "count" : count,
+            "errors" : errors
+        }
+        for percentile in CommandMetrics.PERCENTILES:
+            result["p{}_ms".format(percentile)] = CommandMetrics.percentile(latencies, percentile) * 1000
+        result["max_ms"] = latencies[-1] * 1000 if latencies else 0.0
+        return result
+
+    @staticmethod
+    def percentile(sorted_values : list, percentile : int) -> float:
+        if not sorted_values:
+            return 0.0
+        rank = -(-percentile * len(sorted_values) // 100) # nearest rank, ceil(p * n / 100)
+        return sorted_values[max(rank, 1) - 1]
+
+class CommandRegistry:
+    """
+    CommandRegistry maps request command names to handlers with their required data fields.
+    A handler takes (owner, data) and returns the response data, or None if it sends nothing.
+    Exceptions raised by a handler become {"error" : message} responses.
+    """
+    def __init__(self):
+        self.__handlers = {}
+        self.__metrics = {}
+
+    def command(self, name : str, *fields):
+        def decorator(handler):
+            self.register(name, handler, fields)
+            return handler
+        return decorator
+
+    def register(self, name : str, handler, fields = ()):
+        self.__handlers[name] = (handler, tuple(fields))
+        self.__metrics[name] = CommandMetrics()
+
+    def __contains__(self, name : str) -> bool:
+        return name in self.__handlers
+
+    def dispatch(self, owner, request) -> Packet:
+        """
+        Runs the handler of request["command"], returns the response packet or None.
+        Unknown commands are not answered.
+        """
+        name = request["command"]
+        if name not in self.__handlers:
+            return None
+        handler, fields = self.__handlers[name]
+        start = perf_counter()
+        failed = False
+        try:
+            data = request.get("data")
+            if not isinstance(data, dict):
+                data = {}
+            missing = [field for field in fields if field not in data]
+            if missing:
+                raise MissingFieldError("Missing fields: {}.".format(", ".join(missing)))
+            response_data = handler(owner, data)
+        except Exception as error:
+            failed = True
+            response_data = {
+                "error" : str(error)
+            }
+        self.__metrics[name].record(perf_counter() - start, failed)
+        if response_data is None:
+            return None
+        return CommandRegistry.response(name, response_data)
+
+    @staticmethod
+    def response(name : str, data : dict) -> Packet:
+        response = Packet()
+        response["command"] = name.replace("request", "response")
+        response["data"] = data
+        return response
+
+    def metrics(self) -> dict:
+        return {name : metrics.snapshot() for name, metrics in self.__metrics.items()}
+
+def check_db_result(db_result):
+    """
+    DatabaseManager returns errors instead of raising them, raise them for the registry.
+    """
+    if isinstance(db_result, Exception):
+        raise db_result
+    return db_result
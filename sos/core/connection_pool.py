@@ -0,0 +1,59 @@
+import sqlite3
+from threading import Lock, local
+from weakref import WeakSet
+
+class PooledConnection(sqlite3.Connection):
+    pass # unlike sqlite3.Connection, a subclass can be weakly referenced
+
+class ConnectionPool:
+    """
+    ConnectionPool gives every thread its own connection to db_path and cursor on it, opened on first use.
+    A connection lives as long as its thread, the pool only keeps weak references for close().
+    The database runs in WAL mode, so readers on their connections never wait for the one writer,
+    and a writer waits up to BUSY_TIMEOUT_MS for another instead of failing at once.
+    """
+    BUSY_TIMEOUT_MS = 5000
+    SYNCHRONOUS = "NORMAL" # WAL stays consistent without a sync per commit, a power cut may lose the last commits
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.__local = local()
+        self.__lock = Lock()
+        self.__connections = WeakSet()
+
+    def open(self) -> sqlite3.Connection:
+        # check_same_thread is off only so that close() may close connections of other threads
+        connection = sqlite3.connect(self.db_path, check_same_thread=False, factory=PooledConnection)
+        self.configure(connection)
+        return connection
+
+    def configure(self, connection : sqlite3.Connection):
+        connection.execute("PRAGMA journal_mode = WAL;")
+        connection.execute("PRAGMA synchronous = {};".format(self.SYNCHRONOUS))
+        connection.execute("PRAGMA busy_timeout = {};".format(self.BUSY_TIMEOUT_MS))
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = self.open()
+            self.__local.connection = connection
+            self.__local.cursor = connection.cursor()
+            with self.__lock:
+                self.__connections.add(connection)
+        return connection
+
+    def cursor(self) -> sqlite3.Cursor:
+        if getattr(self.__local, "cursor", None) is None:
+            self.connection()
+        return self.__local.cursor
+
+    def connection_count(self) -> int:
+        with self.__lock:
+            return len(self.__connections)
+
+    def close(self):
+        with self.__lock:
+            connections = list(self.__connections)
+            self.__connections = WeakSet()
+        for connection in connections:
+            connection.close()
+        self.__local = local() # threads open a new connection if they use the pool again
@@ -5,6 +5,9 @@ import datetime
 import secrets
 import functools
 from threading import Lock
+from sos.core.account_cache import AccountCache
+from sos.core.session_cache import SessionCache
+from sos.core.connection_pool import ConnectionPool
 
 class ExistingUsernameError(Exception):
     pass
@@ -27,8 +30,20 @@ class RepeatedPasswordError(Exception):
 class AccountDeletedAlready(Exception):
     pass
 
+# serializes the methods that check and then write, so that their checks still hold when they write.
+# Every thread has its own connection, reads need no lock. GameJournal writes only append records and check
+# nothing, so they run outside the lock and wait for a locked writer on busy_timeout, see ConnectionPool.
 db_lock = Lock()
 
+def db_query(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except Exception as error:
+            return error
+    return wrapper
+
 def db_transaction(function):
     @functools.wraps(function)
     def wrapper(*args, **kwargs):
@@ -123,18 +138,69 @@ class DatabaseManager:
         FOREIGN KEY (who) REFERENCES Accounts (account_id)
     );    
     """
-    def __init__(self, db_path = "db.sqlite3"):
+    # migration i brings a database from user_version i to i + 1, its statements must be safe to run again
+    MIGRATIONS = [
+        ( # indexes for the lookups of every request and move
+            "CREATE INDEX IF NOT EXISTS SessionsTokenIndex ON Sessions (token);",
+            "CREATE INDEX IF NOT EXISTS PlayersGameIndex ON Players (game_id, account_id);",
+            "CREATE INDEX IF NOT EXISTS GameLogsGameIndex ON GameLogs (game_id, log_number);",
+            "CREATE INDEX IF NOT EXISTS GameHintsGameIndex ON GameHints (game_id, hint_number);"
+        ),
+        ( # board checkpoints of GameReplay
+            """CREATE TABLE IF NOT EXISTS GameCheckpoints (
+                game_id INTEGER NOT NULL,
+                log_number INTEGER NOT NULL CHECK (log_number > 0),
+                letters BLOB NOT NULL,
+                owners BLOB NOT NULL,
+                owner_ids TEXT NOT NULL,
+                scores TEXT NOT NULL,
+                PRIMARY KEY (game_id, log_number),
+                FOREIGN KEY (game_id) REFERENCES Games (game_id)
+            );""",
+        ),
+        ( # hints asked for when there was nothing to suggest still cost a point, they are stored with letter ''
+            """CREATE TABLE IF NOT EXISTS GameHintsWithEmpty (
+                gamehint_id INTEGER PRIMARY KEY,
+                hint_number INTEGER NOT NULL CHECK (hint_number > 0),
+                row_number INTEGER NOT NULL CHECK (row_number > 0),
+                column_number INTEGER NOT NULL CHECK (column_number > 0),
+                letter TEXT NOT NULL CHECK (letter == 'S' OR letter == 'O' OR letter == ''),
+                game_id INTEGER NOT NULL,
+                account_id INTEGER NOT NULL,
+                hint_datetime TEXT NOT NULL,
+                FOREIGN KEY (game_id) REFERENCES Games (game_id),
+                FOREIGN KEY (account_id) REFERENCES Accounts (account_id)
+            );""",
+            "INSERT INTO GameHintsWithEmpty SELECT gamehint_id, hint_number, row_number, column_number, letter, game_id, account_id, hint_datetime FROM GameHints;",
+            "DROP TABLE GameHints;",
+            "ALTER TABLE GameHintsWithEmpty RENAME TO GameHints;",
+            "CREATE INDEX IF NOT EXISTS GameHintsGameIndex ON GameHints (game_id, hint_number);"
+        )
+    ]
+    CONNECTION_POOL_CLASS = ConnectionPool
+    def __init__(self, db_path = "db.sqlite3", account_cache_size = None, session_cache_size = None):
         self.db_path = db_path
+        self.account_cache = AccountCache(account_cache_size)
+        self.session_cache = SessionCache(max_size = session_cache_size)
+        self.connection_pool = None
         self.setup_connection()
 
+    @property
+    def db_connection(self) -> sqlite3.Connection:
+        return self.connection_pool.connection()
+
+    @property
+    def db_cursor(self) -> sqlite3.Cursor:
+        return self.connection_pool.cursor() # one per thread too, lastrowid and fetches see this thread's statements
+
     def setup_connection(self):
         if self.open_connection():
             self.setup_database()
 
     def open_connection(self):
         try:
-            self.db_connection = sqlite3.connect(self.db_path, check_same_thread=False)
-            self.db_cursor = self.db_connection.cursor()
+            self.connection_pool = self.CONNECTION_POOL_CLASS(self.db_path)
+            self.connection_pool.connection()
             return True
         except sqlite3.Error as err:
             self.show_errors_to_user(err)
@@ -145,7 +211,7 @@ class DatabaseManager:
             self.db_cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
             self.db_connection.commit()
             for tbl in self.db_cursor.fetchall():
-                if tbl[0] not in ["Accounts", "Sessions", "Games", "Players", "GameLogs", "Actions", "GameHints"]:
+                if tbl[0] not in ["Accounts", "Sessions", "Games", "Players", "GameLogs", "Actions", "GameHints", "GameCheckpoints"]:
                     return False
             return True
         except sqlite3.Error as err:
@@ -159,28 +225,72 @@ class DatabaseManager:
                 raise sqlite3.NotSupportedError("This database is not supported.")
             self.db_cursor.executescript(DatabaseManager.SQLITE_SCHEMA)
             self.db_connection.commit()
+            self.migrate()
         except sqlite3.Error as err:
             self.show_errors_to_user(err)
 
+    def schema_version(self) -> int:
+        self.db_cursor.execute("PRAGMA user_version;")
+        return self.db_cursor.fetchone()[0]
+
+    def migrate(self):
+        """
+        Applies the migrations the database has not seen yet, each in a transaction of its own with its new user_version.
+        Servers starting together on one database each take the write lock before reading the version, so a migration runs once.
+        """
+        while True:
+            self.db_cursor.execute("BEGIN IMMEDIATE;")
+            try:
+                version = self.schema_version()
+                if version >= len(DatabaseManager.MIGRATIONS):
+                    self.db_connection.rollback()
+                    return
+                for statement in DatabaseManager.MIGRATIONS[version]:
+                    self.db_cursor.execute(statement)
+                self.db_cursor.execute("PRAGMA user_version = {};".format(version + 1))
+                self.db_connection.commit()
+            except sqlite3.Error:
+                self.db_connection.rollback()
+                raise
+
     def validate_session_token(self, session_token : str) -> int:
+        account_id, generation = self.session_cache.get(session_token)
+        if account_id is not None:
+            return account_id
         self.db_cursor.execute(
             "SELECT account_id FROM Sessions WHERE token = ?;", 
             (session_token,)
         )
         results = self.db_cursor.fetchall()
         if len(results) == 1:
-            return results[0][0] # account_id
+            account_id = results[0][0]
         else:
-            return -1
+            account_id = -1
+        self.session_cache.put(session_token, account_id, generation)
+        return account_id
+
+    def get_cached_account(self, account_id : int) -> dict:
+        account, generation = self.account_cache.get(account_id)
+        if account is None:
+            self.db_cursor.execute(
+                "SELECT username, first_name, last_name FROM Accounts WHERE (account_id = ?);",
+                (account_id,)
+            )
+            result = self.db_cursor.fetchone()
+            if not result:
+                return None
+            account = {
+                "username" : result[0],
+                "first_name" : result[1],
+                "last_name" : result[2]
+            }
+            self.account_cache.put(account_id, account, generation)
+        return account
 
     def get_username_from_account_id(self, account_id : int) -> str:
-        self.db_cursor.execute(
-            "SELECT username FROM Accounts WHERE (account_id = ?);",
-            (account_id,)
-        )
-        result = self.db_cursor.fetchone()
-        if result:
-            return result[0]
+        account = self.get_cached_account(account_id)
+        if account:
+            return account["username"]
         else:
             return ""
 
@@ -206,34 +316,74 @@ class DatabaseManager:
         else:
             return False
 
-    def add_game_log(self, game_id : int, account_id : int, letter : str, row_number : int, column_number : int) -> bool:
+    def get_game_sequence_numbers(self, game_id : int) -> tuple:
+        """
+        Returns the last log_number and hint_number of a game, 0 if it has none, from the (game_id, number) indexes.
+        """
         self.db_cursor.execute(
-            "SELECT log_number FROM GameLogs WHERE (game_id = ?);",
-            (game_id,)
+            "SELECT (SELECT COALESCE(MAX(log_number), 0) FROM GameLogs WHERE (game_id = ?)), (SELECT COALESCE(MAX(hint_number), 0) FROM GameHints WHERE (game_id = ?));",
+            (game_id, game_id)
         )
-        new_log_number = len(self.db_cursor.fetchall()) + 1
-        dt_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        return self.db_cursor.fetchone()
+
+    def insert_game_log(self, game_id : int, account_id : int, letter : str, row_number : int, column_number : int, dt_str : str, log_number : int = None):
+        if log_number is None:
+            log_number = self.get_game_sequence_numbers(game_id)[0] + 1
         self.db_cursor.execute(
             "INSERT INTO GameLogs (log_number, row_number, column_number, letter, game_id, account_id, log_datetime) VALUES (?, ?, ?, ?, ?, ?, ?);",
-            (new_log_number, row_number + 1, column_number + 1, letter, game_id, account_id, dt_str)
+            (log_number, row_number + 1, column_number + 1, letter, game_id, account_id, dt_str)
         )
+
+    def add_game_log(self, game_id : int, account_id : int, letter : str, row_number : int, column_number : int, log_number : int = None) -> bool:
+        dt_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        self.insert_game_log(game_id, account_id, letter, row_number, column_number, dt_str, log_number)
         self.db_connection.commit()
         return True
 
-    def add_game_hint(self, game_id : int, account_id : int, letter : str, row_number : int, column_number : int) -> bool:
-        self.db_cursor.execute(
-            "SELECT hint_number FROM GameHints WHERE (game_id = ?);",
-            (game_id,)
-        )
-        new_hint_number = len(self.db_cursor.fetchall()) + 1
-        dt_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+    def insert_game_hint(self, game_id : int, account_id : int, letter : str, row_number : int, column_number : int, dt_str : str, hint_number : int = None):
+        if hint_number is None:
+            hint_number = self.get_game_sequence_numbers(game_id)[1] + 1
         self.db_cursor.execute(
             "INSERT INTO GameHints (hint_number, row_number, column_number, letter, game_id, account_id, hint_datetime) VALUES (?, ?, ?, ?, ?, ?, ?);",
-            (new_hint_number, row_number + 1, column_number + 1, letter, game_id, account_id, dt_str)
+            (hint_number, row_number + 1, column_number + 1, letter, game_id, account_id, dt_str)
         )
+
+    def add_game_hint(self, game_id : int, account_id : int, letter : str, row_number : int, column_number : int, hint_number : int = None) -> bool:
+        dt_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        self.insert_game_hint(game_id, account_id, letter, row_number, column_number, dt_str, hint_number)
         self.db_connection.commit()
         return True
 
+    def insert_game_record(self, record : tuple):
+        kind, game_id, account_id, letter, row_number, column_number, dt_str, number = record
+        if kind == "log":
+            self.insert_game_log(game_id, account_id, letter, row_number, column_number, dt_str, number)
+        else: # kind == "hint"
+            self.insert_game_hint(game_id, account_id, letter, row_number, column_number, dt_str, number)
+
+    def add_game_records(self, records : list) -> int:
+        """
+        Writes GameJournal records in one transaction, returns how many of them could not be written.
+        If the transaction fails, the records are written one at a time and the failing ones are dropped.
+        """
+        try:
+            for record in records:
+                self.insert_game_record(record)
+            self.db_connection.commit()
+            return 0
+        except sqlite3.Error:
+            self.db_connection.rollback()
+        failed = 0
+        for record in records:
+            try:
+                self.insert_game_record(record)
+                self.db_connection.commit()
+            except sqlite3.Error as err:
+                self.db_connection.rollback()
+                self.show_errors_to_user(err)
+                failed += 1
+        return failed
+
     @db_transaction
     def update_account_games_and_wins(self, account_id : int, games_changes : int, wins_changes : int) -> bool:
         self.db_cursor.execute(
@@ -299,6 +449,48 @@ class DatabaseManager:
         player_id = self.db_cursor.lastrowid
         return account_id
 
+    @db_transaction
+    def add_bot_player(self, game_id : int, difficulty : str) -> int:
+        # bots are disabled accounts without a password, named like "easy_bot_1"
+        self.db_cursor.execute(
+            "SELECT player_count FROM Games WHERE (game_id = ? AND is_running = 1);",
+            (game_id,)
+        )
+        game = self.db_cursor.fetchone()
+        if game is None:
+            raise WrongGameIDError("Game ID is not valid.")
+        self.db_cursor.execute(
+            "SELECT account_id FROM Players WHERE (game_id = ?);",
+            (game_id,)
+        )
+        game_players = [player[0] for player in self.db_cursor.fetchall()]
+        if len(game_players) >= game[0]:
+            raise GameNewPlayerBannedError("This game does not accept new players anymore.")
+        self.db_cursor.execute(
+            "SELECT account_id FROM Accounts WHERE (password = '' AND is_disabled = 1 AND username LIKE ?) ORDER BY account_id;",
+            (difficulty + "_bot_%",)
+        )
+        bots = [bot[0] for bot in self.db_cursor.fetchall()]
+        free_bots = [account_id for account_id in bots if account_id not in game_players]
+        dt_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        if free_bots:
+            account_id = free_bots[0]
+        else:
+            number = len(bots) + 1
+            while self.does_username_exist("{}_bot_{}".format(difficulty, number)) != -1:
+                number += 1
+            self.db_cursor.execute(
+                "INSERT INTO Accounts (username, password, first_name, last_name, when_joined, is_disabled) VALUES (?, '', ?, 'Bot', ?, 1);",
+                ("{}_bot_{}".format(difficulty, number), difficulty.capitalize(), dt_str)
+            )
+            account_id = self.db_cursor.lastrowid
+        self.db_cursor.execute(
+            "INSERT INTO Players (game_id, account_id, when_joined) VALUES (?, ?, ?);",
+            (game_id, account_id, dt_str)
+        )
+        self.db_connection.commit()
+        return account_id
+
     def get_game_information(self, game_id : int):
         self.db_cursor.execute(
             "SELECT player_count, board_size, who_created, username, max_hint FROM Games INNER JOIN Accounts ON who_created = account_id WHERE (game_id = ?);",
@@ -330,7 +522,7 @@ class DatabaseManager:
         self.db_connection.commit()        
         return game_id, account_id
 
-    @db_transaction
+    @db_query
     def get_account(self, session_token : str) -> dict:
         account_id = self.validate_session_token(session_token)
         if account_id == -1:   
@@ -395,6 +587,7 @@ class DatabaseManager:
             (account_id, session_token)
         )
         self.db_connection.commit()
+        self.session_cache.invalidate(session_token)
         return True
 
     @db_transaction
@@ -430,6 +623,7 @@ class DatabaseManager:
             (account_id,)
         )
         self.db_connection.commit()
+        self.session_cache.invalidate_account(account_id)
         self.notify_admin()         
         return True
 
@@ -445,6 +639,7 @@ class DatabaseManager:
             (first_name, last_name, account_id)
         )
         self.db_connection.commit()
+        self.account_cache.write(account_id, {"first_name" : first_name, "last_name" : last_name})
         self.notify_admin() 
         return True
 
@@ -463,12 +658,14 @@ class DatabaseManager:
             (username, account_id)
         )
         self.db_connection.commit()
+        self.account_cache.write(account_id, {"username" : username})
         # delete all sessions
         self.db_cursor.execute(
             "DELETE FROM Sessions WHERE (account_id = ?);",
             (account_id,)
         )
         self.db_connection.commit()
+        self.session_cache.invalidate_account(account_id)
         self.notify_admin()         
         return True
 
@@ -482,6 +679,7 @@ class DatabaseManager:
             (username, hashlib.sha512(password.encode(encoding="utf-8")).hexdigest(), first_name, last_name, 1 if is_admin else 0, 1 if is_disabled else 0, account_id)
         )
         self.db_connection.commit()
+        self.account_cache.write(account_id, {"username" : username, "first_name" : first_name, "last_name" : last_name})
         self.notify_admin() 
         return True
 
@@ -519,12 +717,18 @@ class DatabaseManager:
             )
         )
         self.db_connection.commit()
+        self.account_cache.write(account_id, {
+            "username" : "DELETED_ACCOUNT_{}".format(account_id),
+            "first_name" : "DELETED",
+            "last_name" : "ACCOUNT"
+        })
         # delete all sessions
         self.db_cursor.execute(
             "DELETE FROM Sessions WHERE (account_id = ?);",
             (account_id,)
         )
         self.db_connection.commit()
+        self.session_cache.invalidate_account(account_id)
         self.notify_admin()   
         return True
 
@@ -551,17 +755,23 @@ class DatabaseManager:
             )
         )
         self.db_connection.commit()
+        self.account_cache.write(account_id, {
+            "username" : "DELETED_ACCOUNT_{}".format(account_id),
+            "first_name" : "DELETED",
+            "last_name" : "ACCOUNT"
+        })
         # delete all sessions
         self.db_cursor.execute(
             "DELETE FROM Sessions WHERE (account_id = ?);",
             (account_id,)
         )
         self.db_connection.commit()
+        self.session_cache.invalidate_account(account_id)
         self.notify_admin()        
         return True
 
     def close_connection(self):
-        self.db_connection.close()
+        self.connection_pool.close()
 
     def notify_admin(self):
         pass
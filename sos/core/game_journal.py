@@ -0,0 +1,126 @@
+import datetime
+from threading import Thread, Condition
+
+class GameJournal(Thread):
+    """
+    GameJournal takes the move and hint records of GameRunners and writes them behind their backs,
+    many records per transaction, when max_batch records are waiting or flush_interval seconds have passed.
+    With durability "immediate" every record is committed before add_game_log or add_game_hint returns instead.
+    Records keep the time they were added, not the time they were written.
+    """
+    MAX_BATCH = 256
+    FLUSH_INTERVAL = 0.05
+    DURABILITIES = ("batched", "immediate")
+    def __init__(self, db_manager, max_batch = None, flush_interval = None, durability = None):
+        super().__init__(daemon=True)
+        self.max_batch = max_batch if max_batch else GameJournal.MAX_BATCH
+        self.flush_interval = flush_interval if flush_interval else GameJournal.FLUSH_INTERVAL
+        self.durability = durability if durability else GameJournal.DURABILITIES[0]
+        if self.durability not in GameJournal.DURABILITIES:
+            raise ValueError("Unknown journal durability {}, use one of {}.".format(self.durability, ", ".join(GameJournal.DURABILITIES)))
+        self.__db_manager = db_manager
+        self.__records = []
+        self.__condition = Condition()
+        self.__added = 0
+        self.__written = 0
+        self.__flush_requested = False
+        self.__is_stopped = False
+        self.__counters = {
+            "records" : 0,
+            "batches" : 0,
+            "failed_records" : 0
+        }
+
+    def settings(self) -> dict:
+        return {
+            "max_batch" : self.max_batch,
+            "flush_interval" : self.flush_interval,
+            "durability" : self.durability
+        }
+
+    def add_game_log(self, game_id : int, account_id : int, letter : str, row_number : int, column_number : int, log_number : int = None):
+        self.add(("log", game_id, account_id, letter, row_number, column_number, self.now(), log_number))
+
+    def add_game_hint(self, game_id : int, account_id : int, letter : str, row_number : int, column_number : int, hint_number : int = None):
+        self.add(("hint", game_id, account_id, letter, row_number, column_number, self.now(), hint_number))
+
+    @staticmethod
+    def now() -> str:
+        return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    def add(self, record : tuple):
+        if self.durability == "immediate":
+            self.write([record])
+            return
+        with self.__condition:
+            self.__records.append(record)
+            self.__added += 1
+            if len(self.__records) == 1 or len(self.__records) >= self.max_batch: # the first record starts the flush timer
+                self.__condition.notify_all()
+
+    def write(self, records : list):
+        failed = self.__db_manager.add_game_records(records)
+        with self.__condition:
+            self.__counters["records"] += len(records) - failed
+            self.__counters["batches"] += 1
+            self.__counters["failed_records"] += failed
+
+    def run(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__records or self.__flush_requested or self.__is_stopped)
+                self.__condition.wait_for(
+                    lambda: len(self.__records) >= self.max_batch or self.__flush_requested or self.__is_stopped,
+                    self.flush_interval
+                )
+                records = self.__records
+                self.__records = []
+                self.__flush_requested = False
+                is_stopped = self.__is_stopped
+            if records:
+                self.write(records)
+            with self.__condition:
+                self.__written += len(records)
+                self.__condition.notify_all()
+            if is_stopped and not records:
+                return
+
+    def flush(self):
+        """
+        Blocks until every record added before the call is written.
+        """
+        if not self.is_alive():
+            self.write_pending()
+            return
+        with self.__condition:
+            target = self.__added
+            self.__flush_requested = True
+            self.__condition.notify_all()
+            self.__condition.wait_for(lambda: self.__written >= target)
+
+    def stop(self):
+        """
+        Writes the records still waiting and ends the journal thread.
+        """
+        with self.__condition:
+            self.__is_stopped = True
+            self.__condition.notify_all()
+        if self.is_alive():
+            self.join()
+        else: # never started, or gone already
+            self.write_pending()
+
+    def write_pending(self):
+        with self.__condition:
+            records = self.__records
+            self.__records = []
+        if records:
+            self.write(records)
+        with self.__condition:
+            self.__written += len(records)
+
+    def stats(self) -> dict:
+        with self.__condition:
+            result = dict(self.__counters)
+            result["pending"] = len(self.__records)
+        return result
@@ -0,0 +1,127 @@
+import json
+import sqlite3
+from sos.core.board import CompactBoard
+from sos.core.database_manager import WrongGameIDError
+
+class WrongMoveNumberError(Exception):
+    pass
+
+class GameReplay:
+    """
+    GameReplay rebuilds the board and scores of a game at any move number by playing its GameLogs
+    through the SOS logic of GameRunner. Every CHECKPOINT_INTERVAL moves a replay stores the board in
+    GameCheckpoints, so a later replay starts from the nearest checkpoint instead of the first move.
+    It reads through a connection of its own, exports and analytics never take the game server's lock.
+    """
+    CHECKPOINT_INTERVAL = 64
+    BATCH_SIZE = 512 # GameLogs rows read at a time by moves()
+    def __init__(self, db_path = "db.sqlite3"):
+        self.db_path = db_path
+        self.db_connection = sqlite3.connect(db_path, check_same_thread=False)
+
+    def board_size(self, game_id : int) -> int:
+        result = self.db_connection.execute(
+            "SELECT board_size FROM Games WHERE (game_id = ?);",
+            (game_id,)
+        ).fetchone()
+        if result is None:
+            raise WrongGameIDError("Game ID is not valid.")
+        return result[0]
+
+    def move_count(self, game_id : int) -> int:
+        return self.db_connection.execute(
+            "SELECT COUNT(*) FROM GameLogs WHERE (game_id = ?);",
+            (game_id,)
+        ).fetchone()[0]
+
+    def moves(self, game_id : int, after : int = 0, until : int = None):
+        """
+        Yields (log_number, account_id, row, column, letter, log_datetime) for the moves numbered after + 1 to until,
+        rows and columns counted from 0 like on the board. Rows are read in batches, a game is never held in memory.
+        """
+        if until is None:
+            until = self.move_count(game_id)
+        while after < until:
+            rows = self.db_connection.execute(
+                "SELECT log_number, account_id, row_number - 1, column_number - 1, letter, log_datetime FROM GameLogs "
+                "WHERE (game_id = ? AND log_number > ? AND log_number <= ?) ORDER BY log_number LIMIT ?;",
+                (game_id, after, until, self.BATCH_SIZE)
+            ).fetchall()
+            if not rows:
+                return
+            yield from rows
+            after = rows[-1][0]
+
+    def nearest_checkpoint(self, game_id : int, board_size : int, move_number : int):
+        """
+        Returns (log_number, board, scores) of the last checkpoint at or before move_number, or None.
+        """
+        result = self.db_connection.execute(
+            "SELECT log_number, letters, owners, owner_ids, scores FROM GameCheckpoints "
+            "WHERE (game_id = ? AND log_number <= ?) ORDER BY log_number DESC LIMIT 1;",
+            (game_id, move_number)
+        ).fetchone()
+        if result is None:
+            return None
+        log_number, letters, owners, owner_ids, scores = result
+        board = CompactBoard.from_checkpoint(board_size, letters, owners, json.loads(owner_ids))
+        return log_number, board, {int(account_id) : score for account_id, score in json.loads(scores).items()}
+
+    def save_checkpoints(self, game_id : int, checkpoints : list):
+        self.db_connection.executemany(
+            "INSERT OR IGNORE INTO GameCheckpoints (game_id, log_number, letters, owners, owner_ids, scores) VALUES (?, ?, ?, ?, ?, ?);",
+            [
+                (game_id, log_number, letters, owners, json.dumps(owner_ids), json.dumps(scores))
+                for log_number, (letters, owners, owner_ids), scores in checkpoints
+            ]
+        )
+        self.db_connection.commit()
+
+    def replay(self, game_id : int, move_number : int = None) -> tuple:
+        """
+        Returns (board, scores) after move move_number, or after the last move if it is None.
+        scores maps account_id to points, one per SOS triple less one per hint taken up to that move.
+        """
+        board_size = self.board_size(game_id)
+        if move_number is None:
+            move_number = self.move_count(game_id)
+        checkpoint = self.nearest_checkpoint(game_id, board_size, move_number)
+        if checkpoint is not None:
+            played, board, scores = checkpoint
+        else:
+            played = 0
+            board = CompactBoard(board_size)
+            scores = {
+                account_id : 0 for account_id, in self.db_connection.execute(
+                    "SELECT account_id FROM Players WHERE (game_id = ?);",
+                    (game_id,)
+                )
+            }
+        log_datetime = None
+        new_checkpoints = []
+        for log_number, account_id, row, column, letter, log_datetime in self.moves(game_id, played, move_number):
+            board.set_cell(row, column, account_id, letter)
+            found, count = board.check_for_sos_triple(account_id, row, column, letter)
+            scores[account_id] = scores.get(account_id, 0) + count
+            played = log_number
+            if log_number % self.CHECKPOINT_INTERVAL == 0:
+                new_checkpoints.append((log_number, board.checkpoint(), dict(scores)))
+        if played < move_number:
+            raise WrongMoveNumberError("Game {} has only {} moves.".format(game_id, played))
+        if new_checkpoints:
+            self.save_checkpoints(game_id, new_checkpoints)
+        if move_number > 0: # hints are charged when replayed, checkpoints keep the triples only
+            if log_datetime is None:
+                log_datetime = self.db_connection.execute(
+                    "SELECT log_datetime FROM GameLogs WHERE (game_id = ? AND log_number = ?);",
+                    (game_id, move_number)
+                ).fetchone()[0]
+            for account_id, hint_count in self.db_connection.execute(
+                "SELECT account_id, COUNT(*) FROM GameHints WHERE (game_id = ? AND hint_datetime <= ?) GROUP BY account_id;",
+                (game_id, log_datetime)
+            ):
+                scores[account_id] = scores.get(account_id, 0) - hint_count
+        return board, scores
+
+    def close_connection(self):
+        self.db_connection.close()
@@ -1,21 +1,35 @@
-from threading import Thread, Lock, RLock
+from threading import Thread, Lock, RLock, Condition
 import socket
 from time import sleep, time
 import random
+import os
+import heapq
+import traceback
+import selectors
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
-from sos.utils.protocol import Packet
+from sos.utils.protocol import Packet, Connection, ProtocolError, negotiate_encoding, negotiate_compression
 from sos.core.database_manager import DatabaseManager
+from sos.core.command_registry import CommandRegistry, check_db_result
+from sos.core.admission_control import AdmissionController
+from sos.core.game_journal import GameJournal
+from sos.core.sos_index import SosOpportunityIndex
+from sos.core.board import CompactBoard
+from sos.core.bot import BotConnection, BotError, check_difficulty, shutdown_search_pool
 
 class QueueNode:
+    __slots__ = ("next", "data")
     def __init__(self, data):
         self.next = None
         self.data = data
 
 class Queue:
+    __slots__ = ("head", "tail", "lock", "not_empty")
     def __init__(self):
         self.head = None
         self.tail = None
         self.lock = Lock()
+        self.not_empty = Condition(self.lock)
     
     def is_empty(self):
         if self.head is None and self.tail is None:
@@ -30,11 +44,18 @@ class Queue:
         else:
             self.tail.next = node
             self.tail = node
+        self.not_empty.notify()
         self.lock.release()
         return True
 
-    def dequeue(self):
+    def dequeue(self, block = False, timeout = None):
+        """
+        Returns None if the queue is empty. With block set, waits up to timeout seconds
+        (forever if timeout is None) for an item to arrive first.
+        """
         self.lock.acquire()
+        if block and self.head is None:
+            self.not_empty.wait_for(lambda: self.head is not None, timeout)
         if self.head is not None:
             node = self.head
             self.head = node.next
@@ -46,18 +67,35 @@ class Queue:
             self.lock.release()
             return None        
 
-class GameRunner(Thread):
+class GameRunner:
+    """
+    GameRunner holds the state of one game. Its tasks are handled one at a time by a GameScheduler worker,
+    or by the event loop of an AsyncGameServer.
+    """
     MAX_PLAYER = 20
-    def __init__(self, db_manager, game_id):
-        super().__init__()
+    IDLE_TIMEOUT = 30 # seconds a game without online players is kept
+    MAX_QUEUED_BYTES = 1024 * 1024 # per player, see OutboundQueue
+    SLOW_CONSUMER_TIMEOUT = 10
+    # newer board and players status replace the queued ones for players who are behind
+    COALESCED_COMMANDS = {
+        "game_runner_board_status" : ("board", True),
+        "game_runner_board_delta" : ("board", False),
+        "game_runner_players_status" : ("players", True)
+    }
+    BOARD_CLASS = CompactBoard
+    def __init__(self, db_manager, game_id, scheduler = None, journal = None):
         self.__db_manager = db_manager
+        self.__journal = journal if journal else db_manager # moves and hints, written behind by a GameJournal
         self.__game_id = game_id
+        self.__scheduler = scheduler
         self.__players_connections = {}
         self.__players_address = {}
         self.__players_scores = {}
+        self.__players_usernames = {} # taken when a player joins, moves need no database lookups
         self.__players_colors = {}
         self.__players_turn = []
         self.has_stopped = False
+        self.has_ended = False
         self.__players_hints = {}
         self.__current_player_turn = None
         self.__generated_colors = []
@@ -65,9 +103,14 @@ class GameRunner(Thread):
         self.__occupied_cells_number = 0
         self.__last_activity = time()
         self.__has_winner = False
+        self.__board_sequence = 0
         self._tasks_queue = Queue()
         self.get_game_information()
-        self.__game_board = [[[None, None] for i in range(self.__board_size)] for j in range(self.__board_size)]
+        # numbers of the last move and hint, a game has one runner in a process so they are counted here.
+        # A runner is only created for a new game, or after a restart when the journal has been written.
+        self.__log_number, self.__hint_number = self.__db_manager.get_game_sequence_numbers(self.__game_id)
+        self.__game_board = self.BOARD_CLASS(self.__board_size)
+        self.__sos_index = SosOpportunityIndex(self.__board_size, self.__game_board.count_sos_triples)
         self.generate_colors()
 
     def generate_colors(self):
@@ -85,31 +128,57 @@ class GameRunner(Thread):
         self.__who_created_username = result[3]
         self.__max_hint = result[4]
 
-    def player_listener(self, account_id, sock):
+    def start_player_listener(self, account_id, connection):
+        Thread(target=self.player_listener, args=(account_id, connection)).start()
+
+    def player_listener(self, account_id, connection):
         while True:
-            response = Packet.recv(sock)
-            if response["command"] == "game_runner_disconnect":
-                task = {
-                    "command" : "disconnect_player_task",
-                    "account_id" : account_id
-                }
-                self._tasks_queue.enqueue(task)
-                return
-            elif response["command"] == "game_runner_my_turn":
-                task = {
-                    "command" : "player_turn_done_task",
-                    "account_id" : account_id,
-                    "row" : response["data"]["row"],
-                    "column" : response["data"]["column"],
-                    "letter" : response["data"]["letter"]
-                }
-                self._tasks_queue.enqueue(task)
-            elif response["command"] == "game_runner_hint":
-                task = {
-                    "command" : "please_help_task",
-                    "account_id" : account_id
-                }
-                self._tasks_queue.enqueue(task)                
+            try:
+                response = connection.recv()
+            except (ProtocolError, OSError) as error: # a reset connection is a disconnect too
+                print("Disconnecting player", account_id, error)
+                response = Packet()
+            task = self.task_from_packet(account_id, response)
+            if task:
+                self.enqueue_task(task)
+                if task["command"] == "disconnect_player_task":
+                    return
+
+    def task_from_packet(self, account_id, response):
+        if response.get("command", "game_runner_disconnect") == "game_runner_disconnect": # closed connections disconnect too
+            return {
+                "command" : "disconnect_player_task",
+                "account_id" : account_id
+            }
+        elif response["command"] == "game_runner_my_turn":
+            return {
+                "command" : "player_turn_done_task",
+                "account_id" : account_id,
+                "row" : response["data"]["row"],
+                "column" : response["data"]["column"],
+                "letter" : response["data"]["letter"]
+            }
+        elif response["command"] == "game_runner_hint":
+            return {
+                "command" : "please_help_task",
+                "account_id" : account_id
+            }
+        elif response["command"] == "game_runner_board_request":
+            return {
+                "command" : "board_snapshot_task",
+                "account_id" : account_id
+            }
+        return None
+
+    def broadcast(self, response):
+        frames = {} # serialized once per wire format, shared by every online player using it
+        group, snapshot = GameRunner.COALESCED_COMMANDS.get(response["command"], (None, False))
+        for player_connection in self.__players_connections.values():
+            if player_connection != None:
+                frame_format = player_connection.frame_format
+                if frame_format not in frames:
+                    frames[frame_format] = player_connection.to_frame(response)
+                player_connection.send_frame(frames[frame_format], group, snapshot)
 
     def broadcast_players_status(self):
         response = Packet()
@@ -121,7 +190,7 @@ class GameRunner(Thread):
             "status" : {}
         }
         for player_account_id, player_connection in self.__players_connections.items():
-            player_username = self.__db_manager.get_username_from_account_id(player_account_id)
+            player_username = self.__players_usernames[player_account_id]
             response["data"]["colors"][player_username] = self.__players_colors[player_account_id]
             response["data"]["scores"][player_username] = str(self.__players_scores[player_account_id])
             response["data"]["hints"][player_username] = str(self.__players_hints[player_account_id]) + "h"
@@ -129,29 +198,45 @@ class GameRunner(Thread):
                 response["data"]["status"][player_username] = "online"
             else:
                 response["data"]["status"][player_username] = "offline"
-        for player_connection in self.__players_connections.values():
-            if player_connection != None:
-                response.send(player_connection)
+        self.broadcast(response)
 
-    def broadcast_board_status(self):
+    def cell_status(self, row, column):
+        owner = self.__game_board.owner(row, column)
+        if owner != None:
+            return [self.__players_colors[owner], self.__game_board.letter(row, column)]
+        else:
+            return ["silver", ""]
+
+    def board_status_packet(self):
         response = Packet()
         response["command"] = "game_runner_board_status"
         response["data"] = {
+            "sequence" : self.__board_sequence,
             "board" : []
         }
         for i in range(self.__board_size):
             response["data"]["board"].append([])
             for j in range(self.__board_size):
-                if self.__game_board[i][j][0] != None:
-                    response["data"]["board"][i].append([
-                            self.__players_colors[self.__game_board[i][j][0]], self.__game_board[i][j][1]
-                        ]
-                    )
-                else:
-                    response["data"]["board"][i].append(["silver", ""])
-        for player_connection in self.__players_connections.values():
-            if player_connection != None:
-                response.send(player_connection)
+                response["data"]["board"][i].append(self.cell_status(i, j))
+        return response
+
+    def send_board_status(self, connection):
+        connection.send(self.board_status_packet(), "board", True)
+
+    def broadcast_board_status(self):
+        self.broadcast(self.board_status_packet())
+
+    def broadcast_board_delta(self, changed_cells):
+        # clients apply a delta only if its sequence follows the last one they have seen,
+        # otherwise they ask for a full snapshot with "game_runner_board_request"
+        self.__board_sequence += 1
+        response = Packet()
+        response["command"] = "game_runner_board_delta"
+        response["data"] = {
+            "sequence" : self.__board_sequence,
+            "cells" : [[row, column] + self.cell_status(row, column) for row, column in changed_cells]
+        }
+        self.broadcast(response)
 
     def broadcast_start_game(self):
         self.__players_turn = list(self.__players_connections.keys())
@@ -166,7 +251,7 @@ class GameRunner(Thread):
             return
         response = Packet()
         response["command"] = "game_runner_your_turn"
-        response.send(player_connection)
+        player_connection.send(response)
 
     def broadcast_winner(self):
         response = Packet()
@@ -176,467 +261,590 @@ class GameRunner(Thread):
             response["draw"] = True
             self.__db_manager.set_game_ended(self.__game_id, None)
         else:
-            response["winner"] = self.__db_manager.get_username_from_account_id(sorted_scores[0][0])
+            response["winner"] = self.__players_usernames[sorted_scores[0][0]]
             self.__db_manager.update_account_games_and_wins(sorted_scores[0][0], 0, 1)
             self.__db_manager.set_game_ended(self.__game_id, sorted_scores[0][0])
-        for player_account_id, player_connection in self.__players_connections.items():
+        for player_account_id in self.__players_connections.keys():
             self.__db_manager.update_account_games_and_wins(player_account_id, 1, 0)
-            if player_connection != None:
-                response.send(player_connection)
+        self.broadcast(response)
         self.__has_winner = True        
 
-    def check_for_sos_triple(self, account_id, row, column, letter, no_act = False):
-        neighbour_cells = [
-            (row - 1, column - 1),
-            (row - 1, column),
-            (row - 1, column + 1),
-            (row, column - 1),
-            (row, column + 1),
-            (row + 1, column - 1),
-            (row + 1, column),
-            (row + 1, column + 1)
-        ]
-        second_layer_neighbor_cells = [
-            (row - 2, column - 2),
-            (row - 2, column),
-            (row - 2, column + 2),
-            (row, column - 2),
-            (row, column + 2),
-            (row + 2, column - 2),
-            (row + 2, column),
-            (row + 2, column + 2)
-        ]
-        found = False
-        counter = 0
-        if letter == "S":
-            for i in range(8):
-                cell = neighbour_cells[i]
-                if 0 <= cell[0] < self.__board_size and 0 <= cell[1] < self.__board_size:
-                    if self.__game_board[cell[0]][cell[1]][1] == "O":
-                        second_layer_cell = second_layer_neighbor_cells[i]
-                        if 0 <= second_layer_cell[0] < self.__board_size and 0 <= second_layer_cell[1] < self.__board_size:
-                            if self.__game_board[second_layer_cell[0]][second_layer_cell[1]][1] == "S":
-                                found = True
-                                counter += 1
-                                if not no_act:
-                                    self.__game_board[second_layer_cell[0]][second_layer_cell[1]][0] = account_id
-                                    self.__game_board[cell[0]][cell[1]][0] = account_id
-        else: # letter == "O"
-            for i in range(4):
-                row1 = neighbour_cells[i][0]
-                row2 = neighbour_cells[7 - i][0]
-                col1 = neighbour_cells[i][1]
-                col2 = neighbour_cells[7 - i][1]
-                if 0 <= row1 < self.__board_size and 0 <= col1 < self.__board_size and 0 <= col2 < self.__board_size and 0 <= row2 < self.__board_size:
-                    if self.__game_board[row1][col1][1] == self.__game_board[row2][col2][1] == "S":
-                        found = True
-                        counter += 1
-                        if not no_act:
-                            self.__game_board[row1][col1][0] = account_id
-                            self.__game_board[row2][col2][0] = account_id
-        return found, counter
+    def board_letters(self):
+        return self.__game_board.letter_codes(), self.__board_size
 
     def find_good_place(self):
-        for i in range(self.__board_size):
-            for j in range(self.__board_size):
-                if self.__game_board[i][j][0] is None:
-                    found, _ = self.check_for_sos_triple(None, i, j, "S", no_act = True)
-                    if found:
-                        return i, j, "S"
-                    found, _ = self.check_for_sos_triple(None, i, j, "O", no_act = True)
-                    if found:
-                        return i, j, "O"
+        # the move completing the most triples, kept up to date by player_turn_done_task
+        return self.__sos_index.best_move()
+
+    def enqueue_task(self, task):
+        self._tasks_queue.enqueue(task)
+        if self.__scheduler:
+            self.__scheduler.schedule(self)
+
+    def stop(self):
+        self.has_stopped = True
+        self.enqueue_task({"command" : "stop_task"}) # wakes the runner up so it notices has_stopped
+
+    def idle_timeout(self):
+        """
+        Seconds the runner may wait for a task before check_for_end has to run again, None if it can wait forever.
+        """
+        if self.has_stopped or (self.__online_players == 0 and self.__has_winner):
+            return 0
+        if self.__online_players == 0:
+            return max(0, self.__last_activity + self.IDLE_TIMEOUT - time())
         return None
 
-    def run(self):
-        while True:
-            if not self._tasks_queue.is_empty():
-                task = self._tasks_queue.dequeue()
-                if task["command"] == "new_player_connection_task":
-                    account_id = task["account_id"]
-                    sock = task["socket"]
-                    client_address = task["client_address"]
-                    if self.__has_winner:
-                        response = Packet()
-                        response["command"] = "game_runner_new_player_banned"
-                        response["data"] = {
-                            "error" : "Game has been finished."
-                        } 
-                        response.send(sock)                        
-                    elif account_id in self.__players_connections and self.__players_connections[account_id] != None:
-                        response = Packet()
-                        response["command"] = "game_runner_new_player_banned"
-                        response["data"] = {
-                            "error" : "You have joined the game with another session."
-                        } 
-                        response.send(sock)
-                    else:
-                        self.__online_players += 1
-                        self.__players_connections[account_id] = sock
-                        self.__players_address[account_id] = client_address
-                        if account_id not in self.__players_scores:
-                            self.__players_scores[account_id] = 0
-                        if account_id not in self.__players_hints:
-                            self.__players_hints[account_id] = 0                            
-                        if account_id not in self.__players_colors:
-                            self.__players_colors[account_id] = "hsl({}, 100%, 50%)".format(str(self.__generated_colors[len(self.__players_connections)]))
-                        Thread(target=self.player_listener, args=(account_id, sock)).start()
-                        response = Packet()
-                        response["command"] = "game_runner_game_details"
-                        response["data"] = {
-                            "game_id" : self.__game_id,
-                            "board_size" : self.__board_size,
-                            "player_count" : self.__player_count,
-                            "creator_username" : self.__who_created_username,
-                            "color" : self.__players_colors[account_id],
-                            "max_hint" : self.__max_hint
-                        }
-                        response.send(sock)
-                        self.broadcast_players_status()
-                        self.broadcast_board_status()
-                        if self.__current_player_turn != None:
-                            if self.__players_turn[self.__current_player_turn] == account_id:
-                                self.broadcast_player_turn()
-                        else:
-                            if len(self.__players_connections) == self.__player_count: # game has not started yet but enough players
-                                self.broadcast_start_game()
-                elif task["command"] == "disconnect_player_task":
-                    account_id = task["account_id"]
-                    sock = self.__players_connections[account_id]
-                    response = Packet()
-                    response["command"] = "game_runner_abort"
-                    response.send(sock)
-                    self.__players_connections[account_id].close()
-                    self.__players_connections[account_id] = None
-                    self.broadcast_players_status()
-                    self.__online_players -= 1
-                    if self.__online_players == 0:
-                        self.__last_activity = time()
-                elif task["command"] == "player_turn_done_task":
-                    account_id = task["account_id"]
-                    row = task["row"]
-                    column = task["column"]
-                    letter = task["letter"]
-                    if self.__players_turn[self.__current_player_turn] == account_id:
-                        self.__game_board[row][column] = [account_id, letter]
-                        self.__db_manager.add_game_log(self.__game_id, account_id, letter, row, column)
-                        self.__occupied_cells_number += 1
-                        found, count = self.check_for_sos_triple(account_id, row, column, letter)
-                        if not found:
-                            self.__current_player_turn += 1
-                            if self.__current_player_turn == len(self.__players_turn):
-                                self.__current_player_turn = 0
-                        else:
-                            self.__players_scores[account_id] += count
-                        self.broadcast_players_status()
-                        self.broadcast_board_status()                          
-                        if self.__occupied_cells_number == (self.__board_size * self.__board_size):
-                            self.broadcast_winner()
-                        else:
-                            self.broadcast_player_turn()
-                elif task["command"] == "please_help_task":
-                    account_id = task["account_id"]
-                    response = Packet()
-                    response["command"] = "game_runner_hint_result"                    
-                    if self.__players_turn[self.__current_player_turn] == account_id:
-                        if self.__players_hints[account_id] < self.__max_hint:
-                            self.__players_hints[account_id] += 1
-                            if self.__players_hints[account_id] == self.__max_hint:
-                                response["finished"] = True
-                            result = self.find_good_place()
-                            self.__players_scores[account_id] -= 1
-                            if result == None:
-                                self.__db_manager.add_game_hint(self.__game_id, account_id, "", 0, 0)
-                                response["result"] = "Unfortunately no hint is available."
-                            else:
-                                self.__db_manager.add_game_hint(self.__game_id, account_id, result[2], result[0] + 1, result[1] + 1)
-                                response["result"] = "You can put \"{}\" at row {} and column {} to obtain a SOS.".format(
-                                    result[2], str(result[0] + 1), str(result[1] + 1)
-                                )
-                        else:
-                            response["error"] = "You have used all your hints."
-                    else:               
-                        response["error"] = "It is not your turn."
-                    response.send(self.__players_connections[account_id])
-                    self.broadcast_players_status()
+    def check_for_end(self) -> bool:
+        if self.has_ended:
+            return True
+        if self.has_stopped:
+            self.__db_manager.set_game_ended(self.__game_id, None)
+            print("Game deleted")
+            self.has_ended = True
+            return True
+        if self.__online_players == 0 and self.__has_winner:
+            self.has_stopped = True
+            print("Game deleted")
+            self.has_ended = True
+            return True
+        if self.__online_players == 0 and (time() - self.__last_activity) >= self.IDLE_TIMEOUT:
+            self.__db_manager.set_game_ended(self.__game_id, None)
+            self.has_stopped = True
+            print("Game deleted")
+            self.has_ended = True
+            return True
+        return False
+
+    def handle_task(self, task):
+        if task["command"] == "new_player_connection_task":
+            account_id = task["account_id"]
+            connection = task["connection"]
+            client_address = task["client_address"]
+            if self.__has_winner:
+                response = Packet()
+                response["command"] = "game_runner_new_player_banned"
+                response["data"] = {
+                    "error" : "Game has been finished."
+                } 
+                connection.send(response)
+            elif account_id in self.__players_connections and self.__players_connections[account_id] != None:
+                response = Packet()
+                response["command"] = "game_runner_new_player_banned"
+                response["data"] = {
+                    "error" : "You have joined the game with another session."
+                } 
+                connection.send(response)
             else:
-                if self.has_stopped:
-                    self.__db_manager.set_game_ended(self.__game_id, None)
-                    print("Game deleted")
-                    return                    
-                if self.__online_players == 0 and self.__has_winner:
-                    self.has_stopped = True
-                    print("Game deleted")
-                    return
-                if self.__online_players == 0 and (time() - self.__last_activity) > 30:
-                    self.__db_manager.set_game_ended(self.__game_id, None)
-                    self.has_stopped = True
-                    print("Game deleted")
-                    return
-                sleep(0.01)
+                is_bot = isinstance(connection, BotConnection)
+                if not is_bot: # bots do not keep a game without humans alive
+                    self.__online_players += 1
+                self.__players_connections[account_id] = connection
+                self.__players_address[account_id] = client_address
+                self.__players_usernames[account_id] = self.__db_manager.get_username_from_account_id(account_id)
+                if account_id not in self.__players_scores:
+                    self.__players_scores[account_id] = 0
+                if account_id not in self.__players_hints:
+                    self.__players_hints[account_id] = 0                            
+                if account_id not in self.__players_colors:
+                    self.__players_colors[account_id] = "hsl({}, 100%, 50%)".format(str(self.__generated_colors[len(self.__players_connections)]))
+                if is_bot:
+                    connection.attach(self, account_id)
+                else:
+                    abort_packet = Packet()
+                    abort_packet["command"] = "game_runner_abort"
+                    connection.start_writer(abort_packet, GameRunner.MAX_QUEUED_BYTES, GameRunner.SLOW_CONSUMER_TIMEOUT)
+                    self.start_player_listener(account_id, connection)
+                response = Packet()
+                response["command"] = "game_runner_game_details"
+                response["data"] = {
+                    "game_id" : self.__game_id,
+                    "board_size" : self.__board_size,
+                    "player_count" : self.__player_count,
+                    "creator_username" : self.__who_created_username,
+                    "color" : self.__players_colors[account_id],
+                    "max_hint" : self.__max_hint
+                }
+                connection.send(response)
+                self.broadcast_players_status()
+                self.send_board_status(connection)
+                if self.__current_player_turn != None:
+                    if self.__players_turn[self.__current_player_turn] == account_id:
+                        self.broadcast_player_turn()
+                else:
+                    if len(self.__players_connections) == self.__player_count: # game has not started yet but enough players
+                        self.broadcast_start_game()
+        elif task["command"] == "disconnect_player_task":
+            account_id = task["account_id"]
+            connection = self.__players_connections[account_id]
+            response = Packet()
+            response["command"] = "game_runner_abort"
+            try:
+                connection.send(response)
+            except OSError:
+                pass
+            self.__players_connections[account_id].close()
+            self.__players_connections[account_id] = None
+            self.broadcast_players_status()
+            self.__online_players -= 1
+            if self.__online_players == 0:
+                self.__last_activity = time()
+        elif task["command"] == "player_turn_done_task":
+            account_id = task["account_id"]
+            row = task["row"]
+            column = task["column"]
+            letter = task["letter"]
+            if self.__players_turn[self.__current_player_turn] == account_id:
+                self.__game_board.set_cell(row, column, account_id, letter)
+                self.__sos_index.place(row, column)
+                self.__log_number += 1
+                self.__journal.add_game_log(self.__game_id, account_id, letter, row, column, self.__log_number)
+                self.__occupied_cells_number += 1
+                changed_cells = {(row, column) : True} # ordered set of cells touched by this move
+                found, count = self.__game_board.check_for_sos_triple(account_id, row, column, letter, changed_cells = changed_cells)
+                if not found:
+                    self.__current_player_turn += 1
+                    if self.__current_player_turn == len(self.__players_turn):
+                        self.__current_player_turn = 0
+                else:
+                    self.__players_scores[account_id] += count
+                self.broadcast_players_status()
+                self.broadcast_board_delta(changed_cells)
+                if self.__occupied_cells_number == (self.__board_size * self.__board_size):
+                    self.broadcast_winner()
+                else:
+                    self.broadcast_player_turn()
+        elif task["command"] == "please_help_task":
+            account_id = task["account_id"]
+            response = Packet()
+            response["command"] = "game_runner_hint_result"                    
+            if self.__players_turn[self.__current_player_turn] == account_id:
+                if self.__players_hints[account_id] < self.__max_hint:
+                    self.__players_hints[account_id] += 1
+                    if self.__players_hints[account_id] == self.__max_hint:
+                        response["finished"] = True
+                    result = self.find_good_place()
+                    self.__players_scores[account_id] -= 1
+                    self.__hint_number += 1
+                    if result == None:
+                        self.__journal.add_game_hint(self.__game_id, account_id, "", 0, 0, self.__hint_number)
+                        response["result"] = "Unfortunately no hint is available."
+                    else:
+                        self.__journal.add_game_hint(self.__game_id, account_id, result[2], result[0] + 1, result[1] + 1, self.__hint_number)
+                        response["result"] = "You can put \"{}\" at row {} and column {} to obtain a SOS.".format(
+                            result[2], str(result[0] + 1), str(result[1] + 1)
+                        )
+                else:
+                    response["error"] = "You have used all your hints."
+            else:               
+                response["error"] = "It is not your turn."
+            self.__players_connections[account_id].send(response)
+            self.broadcast_players_status()
+        elif task["command"] == "board_snapshot_task":
+            account_id = task["account_id"]
+            if self.__players_connections.get(account_id) != None:
+                self.send_board_status(self.__players_connections[account_id])
+
+class GameScheduler:
+    """
+    GameScheduler runs the tasks of many GameRunners on a fixed pool of worker threads.
+    A runner is handed to at most one worker at a time, so its tasks stay serialized and
+    runner state needs no locking. Idle-reaping checks are scheduled from a deadline heap.
+    """
+    BATCH_SIZE = 64 # tasks a worker runs for one game before giving other games a turn
+    def __init__(self, worker_count = None):
+        self.worker_count = worker_count if worker_count else min(32, (os.cpu_count() or 1) + 4)
+        self.__ready_runners = Queue()
+        self.__lock = Lock()
+        self.__deadlines_changed = Condition(self.__lock)
+        self.__runner_settled = Condition(self.__lock)
+        self.__scheduled_runners = set() # runners waiting in the ready queue or being run
+        self.__deadlines = [] # heap of (deadline, sequence, runner)
+        self.__deadline_sequence = 0
+        self.__threads = []
+        self.__is_stopped = False
+
+    def start(self):
+        for i in range(self.worker_count):
+            self.__threads.append(Thread(target=self.worker, daemon=True))
+        self.__threads.append(Thread(target=self.timer, daemon=True))
+        for thread in self.__threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Stops the workers once every scheduled runner has run out of tasks, so the runners stopped
+        just before still run their stop task and check_for_end.
+        """
+        with self.__lock:
+            self.__is_stopped = True
+            self.__deadlines_changed.notify()
+            while self.__threads and self.__scheduled_runners:
+                self.__runner_settled.wait()
+        for i in range(self.worker_count):
+            self.__ready_runners.enqueue(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads.clear()
+
+    def schedule(self, runner):
+        with self.__lock:
+            if runner.has_ended or runner in self.__scheduled_runners:
+                return
+            self.__scheduled_runners.add(runner)
+        self.__ready_runners.enqueue(runner)
+
+    def worker(self):
+        while True:
+            runner = self.__ready_runners.dequeue(block = True)
+            if runner is None:
+                return
+            for i in range(GameScheduler.BATCH_SIZE):
+                task = runner._tasks_queue.dequeue()
+                if task is None:
+                    break
+                try:
+                    runner.handle_task(task)
+                except Exception:
+                    traceback.print_exc()
+            timeout = runner.idle_timeout()
+            if timeout == 0 and runner._tasks_queue.is_empty():
+                runner.check_for_end()
+            with self.__lock:
+                if not runner.has_ended and not runner._tasks_queue.is_empty():
+                    self.__ready_runners.enqueue(runner)
+                    continue
+                self.__scheduled_runners.discard(runner)
+                self.__runner_settled.notify_all()
+                if not runner.has_ended and timeout is not None:
+                    self.__deadline_sequence += 1
+                    heapq.heappush(self.__deadlines, (time() + timeout, self.__deadline_sequence, runner))
+                    self.__deadlines_changed.notify()
+
+    def timer(self):
+        with self.__lock:
+            while not self.__is_stopped:
+                if not self.__deadlines:
+                    self.__deadlines_changed.wait()
+                    continue
+                deadline = self.__deadlines[0][0]
+                if deadline > time():
+                    self.__deadlines_changed.wait(deadline - time())
+                    continue
+                runner = heapq.heappop(self.__deadlines)[2]
+                if not runner.has_ended and runner not in self.__scheduled_runners:
+                    self.__scheduled_runners.add(runner)
+                    self.__ready_runners.enqueue(runner)
+
+class KeepAliveWatcher(Thread):
+    """
+    KeepAliveWatcher holds idle keep-alive connections without tying up a worker thread.
+    Their ClientTask is submitted again when the next request arrives, and they are closed after idle_timeout seconds.
+    """
+    def __init__(self, submit, idle_timeout):
+        super().__init__(daemon=True)
+        self.__submit = submit
+        self.__idle_timeout = idle_timeout
+        self.__selector = selectors.DefaultSelector()
+        self.__wakeup_receiver, self.__wakeup_sender = socket.socketpair()
+        self.__wakeup_receiver.setblocking(False)
+        self.__selector.register(self.__wakeup_receiver, selectors.EVENT_READ)
+        self.__new_connections = Queue()
+        self.__idle_connections = OrderedDict() # connection -> (deadline, client_task), oldest first
+        self.__is_stopped = False
+
+    def park(self, client_task, connection):
+        self.__new_connections.enqueue((client_task, connection))
+        self.__wakeup_sender.send(b"\0")
+
+    def stop(self):
+        self.__is_stopped = True
+        self.__wakeup_sender.send(b"\0")
+
+    def run(self):
+        while not self.__is_stopped:
+            timeout = None
+            if self.__idle_connections:
+                timeout = max(0, next(iter(self.__idle_connections.values()))[0] - time())
+            for key, events in self.__selector.select(timeout):
+                if key.fileobj is self.__wakeup_receiver:
+                    self.__wakeup_receiver.recv(4096)
+                    continue
+                self.__selector.unregister(key.fileobj)
+                self.__submit(self.__idle_connections.pop(key.data)[1])
+            new_connection = self.__new_connections.dequeue()
+            while new_connection is not None:
+                client_task, connection = new_connection
+                self.__idle_connections[connection] = (time() + self.__idle_timeout, client_task)
+                self.__selector.register(connection.sock, selectors.EVENT_READ, connection)
+                new_connection = self.__new_connections.dequeue()
+            while self.__idle_connections:
+                connection, (deadline, client_task) = next(iter(self.__idle_connections.items()))
+                if deadline > time():
+                    break
+                del self.__idle_connections[connection]
+                self.__selector.unregister(connection.sock)
+                connection.close()
+        for connection in self.__idle_connections:
+            connection.close()
+        self.__idle_connections.clear()
+        self.__selector.close()
+
+CLIENT_COMMANDS = CommandRegistry()
 
 class ClientTask:
-    def __init__(self, db_manager, game_server, connection_sock, address):
-        self.__sock = connection_sock
+    def __init__(self, db_manager, game_server, connection, address):
+        self.__connection = connection
         self.__client_host = address[0]
         self.__client_port = address[1]
         self.__client_address = address
         self.__game_server = game_server
         self.__db_manager = db_manager
+        self.__requests_served = 0
+        self.__keep_alive = False
+        self.__long_time_connection = False
     
     def __call__(self):
-        print("Connected from", self.__client_host, self.__client_port)
-        request = Packet.recv(self.__sock)
-        command = request["command"]
-        data = request["data"]
-        long_time_connection = False
+        if self.__requests_served == 0:
+            print("Connected from", self.__client_host, self.__client_port)
+        else: # a client that went quiet in the middle of a request must not hold this worker
+            self.__connection.sock.settimeout(self.__game_server.keep_alive_timeout)
+        try:
+            request = self.__connection.recv()
+            self.__connection.sock.settimeout(None)
+        except (ProtocolError, OSError) as error:
+            print("Rejected request from", self.__client_host, self.__client_port, error)
+            self.__connection.close()
+            return
+        if self.handle_request(request):
+            self.__game_server.keep_alive(self, self.__connection)
+
+    def send_response(self, response):
+        response["keep_alive"] = self.__keep_alive
+        self.__connection.send(response)
+
+    def handle_request(self, request) -> bool:
+        """
+        Handles one request, returns True if the connection stays open for the client's next request.
+        Clients ask for that with "keep_alive": true, up to keep_alive_max_requests requests per connection.
+        """
+        if "command" not in request: # connection closed before sending a request
+            self.__connection.close()
+            return False
+        if self.__requests_served == 0:
+            self.__connection.encoding = negotiate_encoding(request)
+            self.__connection.compression = negotiate_compression(request)
+        self.__requests_served += 1
+        self.__keep_alive = bool(request.get("keep_alive")) and self.__requests_served < self.__game_server.keep_alive_max_requests
+        if self.__game_server.is_stopped() or self.__game_server.is_paused():
+            self.__keep_alive = False
+        self.__long_time_connection = False
         if self.__game_server.is_stopped():
-            response = Packet()
-            response["command"] = command.replace("request", "response")
-            response["data"] = {
+            self.send_response(CommandRegistry.response(request["command"], {
                 "error" : "Server has been stopped."
-            }
-            response.send(self.__sock)
+            }))
         elif self.__game_server.is_paused():
-            response = Packet()
-            response["command"] = command.replace("request", "response")
-            response["data"] = {
+            self.send_response(CommandRegistry.response(request["command"], {
                 "error" : "Server has been paused."
-            }
-            response.send(self.__sock)
+            }))
         else:
-            if command == "login_request":
-                username = data["username"]
-                password = data["password"]
-                db_result = self.__db_manager.login(username, password)
-                response = Packet()
-                response["command"] = "login_response"
-                if not isinstance(db_result, Exception):
-                    response["data"] = {
-                        "session_id" : db_result
-                    }
-                else:
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                response.send(self.__sock)
-            elif command == "signup_request":
-                username = data["username"]
-                password = data["password"]
-                first_name = data["firstname"]
-                last_name = data["lastname"]
-                db_result = self.__db_manager.add_account(username, password, first_name, last_name)
-                response = Packet()
-                response["command"] = "signup_response"
-                if not isinstance(db_result, Exception):
-                    response["data"] = {
-                        "ok" : "done"
-                    }
-                else:
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                response.send(self.__sock)
-            elif command == "signout_request":
-                session_token = data["session_id"]
-                db_result = self.__db_manager.logout(session_token)
-                response = Packet()
-                response["command"] = "signout_response"
-                if not isinstance(db_result, Exception):
-                    response["data"] = {
-                        "ok" : "done"
-                    }
-                else:
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                response.send(self.__sock)
-            elif command == "get_account_request":
-                session_token = data["session_id"]
-                db_result = self.__db_manager.get_account(session_token)
-                response = Packet()
-                response["command"] = "get_account_response"
-                if not isinstance(db_result, Exception):
-                    response["data"] = db_result
-                    response["data"]["ok"] = "done"
-                else:
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                response.send(self.__sock)
-            elif command == "edit_account_request":
-                session_token = data["session_id"]
-                current_password = data["current_password"]
-                username = data["username"]
-                password = data["password"]
-                first_name = data["first_name"]
-                last_name = data["last_name"]
-                db_result = self.__db_manager.edit_account(session_token, current_password, username, password, first_name, last_name)
-                response = Packet()
-                response["command"] = "edit_account_response"
-                if not isinstance(db_result, Exception):
-                    response["data"] = {
-                        "ok" : "done"
-                    }
-                else:
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                response.send(self.__sock)
-            elif command == "edit_profile_request":
-                session_token = data["session_id"]
-                current_password = data["current_password"]
-                first_name = data["first_name"]
-                last_name = data["last_name"]
-                db_result = self.__db_manager.edit_profile(session_token, current_password, first_name, last_name)
-                response = Packet()
-                response["command"] = "edit_profile_response"
-                if not isinstance(db_result, Exception):
-                    response["data"] = {
-                        "ok" : "done"
-                    }
-                else:
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                response.send(self.__sock)
-            elif command == "edit_username_request":
-                session_token = data["session_id"]
-                current_password = data["current_password"]
-                username = data["username"]
-                db_result = self.__db_manager.change_username(session_token, current_password, username)
-                response = Packet()
-                response["command"] = "edit_username_response"
-                if not isinstance(db_result, Exception):
-                    response["data"] = {
-                        "ok" : "done"
-                    }
-                else:
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                response.send(self.__sock)
-            elif command == "edit_password_request":
-                session_token = data["session_id"]
-                current_password = data["current_password"]
-                new_password = data["new_password"]
-                db_result = self.__db_manager.change_password(session_token, current_password, new_password)
-                response = Packet()
-                response["command"] = "edit_password_response"
-                if not isinstance(db_result, Exception):
-                    response["data"] = {
-                        "ok" : "done"
-                    }
-                else:
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                response.send(self.__sock)            
-            elif command == "remove_account_request":
-                session_token = data["session_id"]
-                current_password = data["current_password"]
-                db_result = self.__db_manager.remove_account(session_token, current_password)
-                response = Packet()
-                response["command"] = "remove_account_response"
-                if not isinstance(db_result, Exception):
-                    response["data"] = {
-                        "ok" : "done"
-                    }
-                else:
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                response.send(self.__sock)
-            elif command == "new_game_request":
-                session_token = data["session_id"]
-                board_size = data["board_size"]
-                player_count = data["player_count"]
-                is_public = data["is_public"]
-                max_hint = data["max_hint"]
-                db_result = self.__db_manager.new_game(session_token, board_size, player_count, is_public, max_hint)
-                if not isinstance(db_result, Exception):
-                    game_id = db_result[0]
-                    account_id = db_result[1]
-                    long_time_connection = True
-                    self.__game_server.add_to_runners(game_id)
-                    task = {
-                        "command" : "new_player_connection_task",
-                        "account_id" : account_id,
-                        "socket" : self.__sock,
-                        "client_address" : self.__client_address
-                    }
-                    self.__game_server._game_runners[game_id]._tasks_queue.enqueue(task)
-                else:
-                    response = Packet()
-                    response["command"] = "new_game_response"                    
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                    response.send(self.__sock)
-            elif command == "join_game_request":
-                session_token = data["session_id"]
-                game_id = data["game_id"]
-                creator_username = data["creator_username"]
-                db_result = self.__db_manager.join_game(session_token, game_id, creator_username)
-                if not isinstance(db_result, Exception):
-                    account_id = db_result
-                    long_time_connection = True
-                    task = {
-                        "command" : "new_player_connection_task",
-                        "account_id" : account_id,
-                        "socket" : self.__sock,
-                        "client_address" : self.__client_address
-                    }
-                    self.__game_server._game_runners[game_id]._tasks_queue.enqueue(task)
-                else:
-                    response = Packet()
-                    response["command"] = "join_game_response"                    
-                    response["data"] = {
-                        "error" : str(db_result)
-                    }
-                    response.send(self.__sock)                
-        if not long_time_connection:
-            self.__sock.close()
+            response = CLIENT_COMMANDS.dispatch(self, request)
+            if response is not None:
+                self.send_response(response)
+        if self.__long_time_connection:
+            return False
+        if self.__keep_alive:
+            return True
+        self.__connection.close()
+        return False
+
+    @CLIENT_COMMANDS.command("login_request", "username", "password")
+    def login(self, data):
+        with self.__game_server.admission.admit(self.__client_host):
+            session_token = check_db_result(self.__db_manager.login(data["username"], data["password"]))
+        return {
+            "session_id" : session_token
+        }
+
+    @CLIENT_COMMANDS.command("signup_request", "username", "password", "firstname", "lastname")
+    def signup(self, data):
+        with self.__game_server.admission.admit(self.__client_host):
+            check_db_result(self.__db_manager.add_account(data["username"], data["password"], data["firstname"], data["lastname"]))
+        return {
+            "ok" : "done"
+        }
+
+    @CLIENT_COMMANDS.command("signout_request", "session_id")
+    def signout(self, data):
+        check_db_result(self.__db_manager.logout(data["session_id"]))
+        return {
+            "ok" : "done"
+        }
+
+    @CLIENT_COMMANDS.command("get_account_request", "session_id")
+    def get_account(self, data):
+        account = check_db_result(self.__db_manager.get_account(data["session_id"]))
+        account["ok"] = "done"
+        return account
+
+    @CLIENT_COMMANDS.command("edit_account_request", "session_id", "current_password", "username", "password", "first_name", "last_name")
+    def edit_account(self, data):
+        check_db_result(self.__db_manager.edit_account(
+            data["session_id"], data["current_password"], data["username"], data["password"], data["first_name"], data["last_name"]
+        ))
+        return {
+            "ok" : "done"
+        }
+
+    @CLIENT_COMMANDS.command("edit_profile_request", "session_id", "current_password", "first_name", "last_name")
+    def edit_profile(self, data):
+        check_db_result(self.__db_manager.edit_profile(data["session_id"], data["current_password"], data["first_name"], data["last_name"]))
+        return {
+            "ok" : "done"
+        }
+
+    @CLIENT_COMMANDS.command("edit_username_request", "session_id", "current_password", "username")
+    def edit_username(self, data):
+        check_db_result(self.__db_manager.change_username(data["session_id"], data["current_password"], data["username"]))
+        return {
+            "ok" : "done"
+        }
+
+    @CLIENT_COMMANDS.command("edit_password_request", "session_id", "current_password", "new_password")
+    def edit_password(self, data):
+        check_db_result(self.__db_manager.change_password(data["session_id"], data["current_password"], data["new_password"]))
+        return {
+            "ok" : "done"
+        }
+
+    @CLIENT_COMMANDS.command("remove_account_request", "session_id", "current_password")
+    def remove_account(self, data):
+        check_db_result(self.__db_manager.remove_account(data["session_id"], data["current_password"]))
+        return {
+            "ok" : "done"
+        }
+
+    @CLIENT_COMMANDS.command("new_game_request", "session_id", "board_size", "player_count", "is_public", "max_hint")
+    def new_game(self, data):
+        bots = data.get("bots", []) # difficulty of each seat taken by a bot
+        for difficulty in bots:
+            check_difficulty(difficulty)
+        if len(bots) >= data["player_count"]:
+            raise BotError("A game needs at least one human player.")
+        game_id, account_id = check_db_result(self.__db_manager.new_game(
+            data["session_id"], data["board_size"], data["player_count"], data["is_public"], data["max_hint"]
+        ))
+        self.__long_time_connection = True
+        self.__game_server.connect_player(game_id, account_id, self.__connection, self.__client_address, new_game = True)
+        for difficulty in bots:
+            bot_account_id = self.__db_manager.add_bot_player(game_id, difficulty)
+            if not isinstance(bot_account_id, Exception):
+                self.__game_server.add_bot(game_id, bot_account_id, difficulty)
+
+    @CLIENT_COMMANDS.command("join_game_request", "session_id", "game_id", "creator_username")
+    def join_game(self, data):
+        account_id = check_db_result(self.__db_manager.join_game(data["session_id"], data["game_id"], data["creator_username"]))
+        self.__long_time_connection = True
+        self.__game_server.connect_player(data["game_id"], account_id, self.__connection, self.__client_address)
 
 class GameServer(Thread):
     DEFAULT_HOST = "127.0.0.1"
     DEFAULT_PORT = 12345
-    def __init__(self, db_manager, host = None, port = None):
+    KEEP_ALIVE_TIMEOUT = 30
+    KEEP_ALIVE_MAX_REQUESTS = 100
+    def __init__(self, db_manager, host = None, port = None, max_frame_size = None, keep_alive_timeout = None, keep_alive_max_requests = None, admission = None, journal = None):
         super().__init__()
         self.__server_host = host if host else GameServer.DEFAULT_HOST
         self.__server_port = port if port else GameServer.DEFAULT_PORT
+        self.__max_frame_size = max_frame_size
+        self.keep_alive_timeout = keep_alive_timeout if keep_alive_timeout else GameServer.KEEP_ALIVE_TIMEOUT
+        self.keep_alive_max_requests = keep_alive_max_requests if keep_alive_max_requests else GameServer.KEEP_ALIVE_MAX_REQUESTS
+        self.admission = admission if admission else AdmissionController()
+        self.journal = journal if journal else GameJournal(db_manager)
+        self.__keep_alive_watcher = None
         self.__db_manager = db_manager
         self._game_runners = {}
         self.__sock = None
         self.__executor = None
+        self.__scheduler = GameScheduler()
         self.__is_paused = False
         self.__is_stopped = False
 
     def add_to_runners(self, game_id):
-        runner = GameRunner(self.__db_manager, game_id)
+        runner = GameRunner(self.__db_manager, game_id, self.__scheduler, self.journal)
         self._game_runners[game_id] = runner
-        runner.start()
+        self.__scheduler.schedule(runner)
+
+    def connect_player(self, game_id, account_id, connection, client_address, new_game = False):
+        if new_game:
+            self.add_to_runners(game_id)
+        task = {
+            "command" : "new_player_connection_task",
+            "account_id" : account_id,
+            "connection" : connection,
+            "client_address" : client_address
+        }
+        self._game_runners[game_id].enqueue_task(task)
 
     def run(self):
         self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__sock.bind((self.__server_host, self.__server_port))
         self.__sock.listen()
         self.__executor = ThreadPoolExecutor()
+        self.__keep_alive_watcher = KeepAliveWatcher(self.__executor.submit, self.keep_alive_timeout)
+        self.__keep_alive_watcher.start()
+        self.start_game_workers()
         while True:
             if not self.__is_paused and not self.__is_stopped:
-                ct = ClientTask(self.__db_manager, self, *self.__sock.accept())
+                connection_sock, address = self.__sock.accept()
+                ct = ClientTask(self.__db_manager, self, Connection(connection_sock, max_frame_size = self.__max_frame_size), address)
                 self.__executor.submit(ct)
             else:
                 if self.__is_stopped:
                     self.__sock.close()
                     for game_id in self._game_runners.keys():
-                        self._game_runners[game_id].has_stopped = True
+                        self._game_runners[game_id].stop()
                     self._game_runners.clear()
+                    self.__keep_alive_watcher.stop()
                     self.__executor.shutdown()
+                    shutdown_search_pool()
+                    self.stop_game_workers()
                     break
                 else:
                     sleep(0.2)
 
+    def start_game_workers(self):
+        self.journal.start()
+        self.__scheduler.start()
+
+    def stop_game_workers(self):
+        self.__scheduler.stop()
+        self.journal.stop() # the runners are done, write what they left
+
+    def add_bot(self, game_id, account_id, difficulty):
+        self.connect_player(game_id, account_id, BotConnection(difficulty), None)
+
+    def command_metrics(self) -> dict:
+        return CLIENT_COMMANDS.metrics()
+
+    def admission_stats(self) -> dict:
+        return self.admission.stats()
+
+    def account_cache_stats(self) -> dict:
+        return self.__db_manager.account_cache.stats()
+
+    def session_cache_stats(self) -> dict:
+        return self.__db_manager.session_cache.stats()
+
+    def journal_stats(self) -> dict:
+        return self.journal.stats()
+
+    def keep_alive(self, client_task, connection):
+        if connection.reader.has_pending(): # the next request is already buffered
+            self.__executor.submit(client_task)
+        else:
+            self.__keep_alive_watcher.park(client_task, connection)
+
     def pause(self):
         self.__is_paused = True
         self.make_sure_exiting_accept_block()
@@ -657,4 +865,17 @@ class GameServer(Thread):
 
     def stop(self):
         self.__is_stopped = True
-        self.make_sure_exiting_accept_block()
\ No newline at end of file
+        self.make_sure_exiting_accept_block()
+
+def create_game_server(db_manager, host = None, port = None, use_asyncio = False, shard_count = None, **kwargs):
+    """
+    Returns the threaded GameServer, the single event loop AsyncGameServer when use_asyncio is set,
+    or a ShardedGameServer running games in shard_count worker processes.
+    """
+    if shard_count:
+        from sos.core.sharded_game_server import ShardedGameServer
+        return ShardedGameServer(db_manager, host, port, shard_count = shard_count, **kwargs)
+    if use_asyncio:
+        from sos.core.async_game_server import AsyncGameServer
+        return AsyncGameServer(db_manager, host, port, **kwargs)
+    return GameServer(db_manager, host, port, **kwargs)
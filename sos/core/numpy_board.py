@@ -0,0 +1,121 @@
+try:
+    import numpy
+except ImportError: # optional, only NumpyBoard needs it
+    numpy = None
+from sos.core.board import DIRECTIONS
+
+EMPTY = 0
+S = 1
+O = 2
+BORDER = 3 # letter of the 2 cell wide frame around the board, never part of a triple
+LETTER_CODES = {None : EMPTY, "S" : S, "O" : O}
+LETTERS = [None, "S", "O"]
+
+class NumpyBoard:
+    """
+    NumpyBoard is a Board kept in NumPy arrays: int8 letter codes with a border frame, so neighbours need no
+    bounds checks, and int16 indexes into a table of owner account_ids.
+    Triples are found by comparing shifted views of the letter array, for one move or for the whole board at once.
+    """
+    def __init__(self, board_size):
+        if numpy is None:
+            raise ImportError("NumpyBoard needs numpy.")
+        self.size = board_size
+        self.__letters = numpy.full((board_size + 4, board_size + 4), BORDER, dtype=numpy.int8)
+        self.__letters[2:-2, 2:-2] = EMPTY
+        self.__owners = numpy.zeros((board_size, board_size), dtype=numpy.int16)
+        self.__owner_ids = [None] # owner index -> account_id
+        self.__owner_indexes = {None : 0}
+        self.__directions = numpy.array(DIRECTIONS)
+
+    @classmethod
+    def from_checkpoint(cls, board_size, letters, owners, owner_ids):
+        board = cls(board_size)
+        board.__letters[2:-2, 2:-2] = numpy.frombuffer(letters, dtype=numpy.int8).reshape(board_size, board_size)
+        board.__owners[:] = numpy.frombuffer(owners, dtype=numpy.int16).reshape(board_size, board_size)
+        board.__owner_ids = list(owner_ids)
+        board.__owner_indexes = {account_id : i for i, account_id in enumerate(owner_ids)}
+        return board
+
+    def owner_index(self, account_id) -> int:
+        if account_id not in self.__owner_indexes:
+            self.__owner_indexes[account_id] = len(self.__owner_ids)
+            self.__owner_ids.append(account_id)
+        return self.__owner_indexes[account_id]
+
+    def owner(self, row, column):
+        return self.__owner_ids[self.__owners[row, column]]
+
+    def letter(self, row, column):
+        return LETTERS[self.__letters[row + 2, column + 2]]
+
+    def set_cell(self, row, column, owner, letter):
+        self.__owners[row, column] = self.owner_index(owner)
+        self.__letters[row + 2, column + 2] = LETTER_CODES[letter]
+
+    def letter_codes(self) -> bytes:
+        return self.shifted(0, 0).tobytes()
+
+    def checkpoint(self) -> tuple:
+        """
+        Returns (letters, owners, owner_ids) in the format of CompactBoard.checkpoint, from_checkpoint rebuilds the board.
+        """
+        return self.letter_codes(), self.__owners.tobytes(), list(self.__owner_ids)
+
+    def neighbours(self, row, column, distance):
+        cells = self.__directions * distance + (row + 2, column + 2)
+        return cells, self.__letters[cells[:, 0], cells[:, 1]]
+
+    def check_for_sos_triple(self, account_id, row, column, letter, no_act = False, changed_cells = None):
+        first_cells, first_letters = self.neighbours(row, column, 1)
+        if letter == "S":
+            second_cells, second_letters = self.neighbours(row, column, 2)
+            triples = [
+                (tuple(second_cells[i] - 2), tuple(first_cells[i] - 2))
+                for i in numpy.flatnonzero((first_letters == O) & (second_letters == S))
+            ]
+        else: # letter == "O"
+            triples = [
+                (tuple(first_cells[i] - 2), tuple(first_cells[7 - i] - 2))
+                for i in numpy.flatnonzero((first_letters[:4] == S) & (first_letters[:3:-1] == S))
+            ]
+        if not no_act:
+            owner_index = self.owner_index(account_id)
+            for triple in triples:
+                for cell in triple:
+                    self.__owners[cell] = owner_index
+                    if changed_cells is not None:
+                        changed_cells[(int(cell[0]), int(cell[1]))] = True
+        return len(triples) > 0, len(triples)
+
+    def count_sos_triples(self, row, column, letter) -> int:
+        return self.check_for_sos_triple(None, row, column, letter, no_act = True)[1]
+
+    def shifted(self, row_offset, column_offset):
+        # view of the letters such that shifted(dr, dc)[i, j] is the letter of cell (i + dr, j + dc)
+        return self.__letters[2 + row_offset:2 + row_offset + self.size, 2 + column_offset:2 + column_offset + self.size]
+
+    def scoring_counts(self):
+        """
+        Returns two arrays with the number of triples an "S" and an "O" would complete on each empty cell.
+        """
+        s_counts = numpy.zeros((self.size, self.size), dtype=numpy.int8)
+        o_counts = numpy.zeros((self.size, self.size), dtype=numpy.int8)
+        for row_offset, column_offset in DIRECTIONS:
+            s_counts += (self.shifted(row_offset, column_offset) == O) & (self.shifted(2 * row_offset, 2 * column_offset) == S)
+        for row_offset, column_offset in DIRECTIONS[:4]:
+            o_counts += (self.shifted(row_offset, column_offset) == S) & (self.shifted(-row_offset, -column_offset) == S)
+        occupied = self.shifted(0, 0) != EMPTY
+        s_counts[occupied] = 0
+        o_counts[occupied] = 0
+        return s_counts, o_counts
+
+    def scoring_moves(self) -> dict:
+        """
+        Returns {(row, column, letter) : count} for every move on an empty cell that completes a triple.
+        """
+        moves = {}
+        for letter, counts in zip(("S", "O"), self.scoring_counts()):
+            for row, column in zip(*numpy.nonzero(counts)):
+                moves[(int(row), int(column), letter)] = int(counts[row, column])
+        return moves
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+class SessionCache:
+    """
+    SessionCache maps session tokens to their account_id for ttl seconds, -1 for tokens that are not valid
+    for negative_ttl seconds, keeping at most max_size tokens (0 disables it) and evicting the least recently used.
+    DatabaseManager invalidates a token when it deletes it and every token of an account when it deletes its sessions.
+    A fill that read the database before an invalidation is dropped, the session may be gone by now.
+    The ttl bounds how long a session deleted by another process stays valid here.
+    """
+    TTL = 300
+    NEGATIVE_TTL = 30
+    MAX_SIZE = 10000
+    def __init__(self, ttl = None, negative_ttl = None, max_size = None):
+        self.ttl = ttl if ttl else SessionCache.TTL
+        self.negative_ttl = negative_ttl if negative_ttl else SessionCache.NEGATIVE_TTL
+        self.max_size = max_size if max_size is not None else SessionCache.MAX_SIZE
+        self.__entries = OrderedDict() # token -> (account_id, expiry time), least recently used first
+        self.__tokens_by_account = {} # account_id -> tokens cached for it
+        self.__lock = Lock()
+        self.__generation = 0 # invalidations so far
+        self.__counters = {
+            "hits" : 0,
+            "negative_hits" : 0,
+            "misses" : 0,
+            "expirations" : 0,
+            "evictions" : 0,
+            "invalidations" : 0
+        }
+
+    def get(self, token : str):
+        """
+        Returns (account_id, generation), account_id is None on a miss and generation is to be passed to put().
+        """
+        with self.__lock:
+            entry = self.__entries.get(token)
+            if entry is not None and entry[1] <= monotonic():
+                self.remove(token)
+                self.__counters["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.__counters["misses"] += 1
+                return None, self.__generation
+            self.__entries.move_to_end(token)
+            self.__counters["hits" if entry[0] != -1 else "negative_hits"] += 1
+            return entry[0], self.__generation
+
+    def put(self, token : str, account_id : int, generation : int):
+        with self.__lock:
+            if generation != self.__generation or self.max_size == 0:
+                return
+            self.remove(token)
+            self.__entries[token] = (account_id, monotonic() + (self.ttl if account_id != -1 else self.negative_ttl))
+            if account_id != -1:
+                self.__tokens_by_account.setdefault(account_id, set()).add(token)
+            if len(self.__entries) > self.max_size:
+                self.remove(next(iter(self.__entries)))
+                self.__counters["evictions"] += 1
+
+    def remove(self, token : str):
+        # callers hold the lock
+        entry = self.__entries.pop(token, None)
+        if entry is not None and entry[0] != -1:
+            tokens = self.__tokens_by_account[entry[0]]
+            tokens.discard(token)
+            if not tokens:
+                del self.__tokens_by_account[entry[0]]
+
+    def invalidate(self, token : str):
+        with self.__lock:
+            self.remove(token)
+            self.__generation += 1
+            self.__counters["invalidations"] += 1
+
+    def invalidate_account(self, account_id : int):
+        with self.__lock:
+            for token in list(self.__tokens_by_account.get(account_id, ())):
+                self.remove(token)
+            self.__generation += 1
+            self.__counters["invalidations"] += 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            result = dict(self.__counters)
+            result["size"] = len(self.__entries)
+        lookups = result["hits"] + result["negative_hits"] + result["misses"]
+        result["hit_rate"] = (result["hits"] + result["negative_hits"]) / lookups if lookups else 0.0
+        return result
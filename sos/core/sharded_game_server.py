@@ -0,0 +1,162 @@
+import os
+import json
+import socket
+import multiprocessing
+from threading import Lock
+from sos.utils.protocol import Connection, ENCODINGS, COMPRESSIONS
+from sos.core.database_manager import DatabaseManager
+from sos.core.game_server import GameServer, GameRunner, GameScheduler
+from sos.core.bot import BotConnection, shutdown_search_pool
+from sos.core.game_journal import GameJournal
+
+class GameShard:
+    """
+    GameShard runs in a worker process and owns the GameRunners of the games mapped to it.
+    Player sockets arrive over a UNIX control socket as passed file descriptors.
+    """
+    def __init__(self, control_sock, db_path, max_frame_size = None, journal_settings = None):
+        self.__control_sock = control_sock
+        self.__db_path = db_path
+        self.__max_frame_size = max_frame_size
+        self.__journal_settings = journal_settings if journal_settings else {}
+        self._game_runners = {}
+
+    def run(self):
+        # accounts are edited in the front process, a cache here would never hear of it
+        db_manager = DatabaseManager(self.__db_path, account_cache_size = 0)
+        journal = GameJournal(db_manager, **self.__journal_settings)
+        journal.start()
+        scheduler = GameScheduler()
+        scheduler.start()
+        while True:
+            try:
+                message, fds = recv_control_message(self.__control_sock)
+            except OSError:
+                break
+            if message is None: # front process closed the control socket
+                break
+            if "bot" in message:
+                connection = BotConnection(message["bot"])
+            else:
+                connection = Connection(
+                    socket.socket(fileno=fds[0]),
+                    ENCODINGS[message["encoding"]],
+                    max_frame_size = self.__max_frame_size,
+                    compression = COMPRESSIONS.get(message["compression"])
+                )
+                connection.reader.put_pending(message["pending"])
+            game_id = message["game_id"]
+            if game_id not in self._game_runners:
+                self._game_runners[game_id] = GameRunner(db_manager, game_id, scheduler, journal)
+                scheduler.schedule(self._game_runners[game_id])
+            task = {
+                "command" : "new_player_connection_task",
+                "account_id" : message["account_id"],
+                "connection" : connection,
+                "client_address" : tuple(message["client_address"]) if message["client_address"] else None
+            }
+            self._game_runners[game_id].enqueue_task(task)
+        for runner in self._game_runners.values():
+            runner.stop()
+        scheduler.stop()
+        journal.stop()
+        shutdown_search_pool()
+        db_manager.close_connection()
+
+MAX_MESSAGE_SIZE = 64 * 1024 # of one SEQPACKET message on a control socket
+
+def send_control_message(control_sock, message : dict, fds = (), pending = b""):
+    """
+    Sends message as JSON with fds attached, then the bytes the front process read ahead of the
+    player's socket in messages of at most MAX_MESSAGE_SIZE. Callers hold the lock of control_sock.
+    """
+    message["pending_size"] = len(pending)
+    socket.send_fds(control_sock, [json.dumps(message).encode(encoding="utf-8")], list(fds))
+    for offset in range(0, len(pending), MAX_MESSAGE_SIZE):
+        control_sock.send(pending[offset:offset + MAX_MESSAGE_SIZE])
+
+def recv_control_message(control_sock) -> tuple:
+    """
+    Returns (message, fds) sent by send_control_message, with the read-ahead bytes in message["pending"].
+    message is None once the other end has closed control_sock.
+    """
+    message, fds, flags, address = socket.recv_fds(control_sock, MAX_MESSAGE_SIZE, 1)
+    if not message:
+        return None, fds
+    message = json.loads(message)
+    pending = bytearray()
+    while len(pending) < message["pending_size"]:
+        chunk = control_sock.recv(MAX_MESSAGE_SIZE)
+        if not chunk:
+            return None, fds
+        pending += chunk
+    message["pending"] = bytes(pending)
+    return message, fds
+
+def run_game_shard(control_sock, db_path, max_frame_size, journal_settings):
+    GameShard(control_sock, db_path, max_frame_size, journal_settings).run()
+
+class ShardedGameServer(GameServer):
+    """
+    ShardedGameServer accepts connections and serves account commands in this process, while games run
+    in shard_count worker processes. A game always lives on shard game_id % shard_count, new and joining
+    players are handed to it by passing their socket over a UNIX socket. The database file is shared.
+    """
+    def __init__(self, db_manager, host = None, port = None, max_frame_size = None, shard_count = None, **kwargs):
+        super().__init__(db_manager, host, port, max_frame_size, **kwargs)
+        self.shard_count = shard_count if shard_count else (os.cpu_count() or 1)
+        self.__db_path = db_manager.db_path
+        self.__max_frame_size = max_frame_size
+        self.__shards = [] # (process, control socket, lock)
+
+    def start_game_workers(self):
+        self.start_shards() # games run in the shards, this process needs no scheduler nor journal
+
+    def stop_game_workers(self):
+        self.stop_shards()
+
+    def start_shards(self):
+        context = multiprocessing.get_context("spawn")
+        for i in range(self.shard_count):
+            front_sock, shard_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = context.Process(target=run_game_shard, args=(shard_sock, self.__db_path, self.__max_frame_size, self.journal.settings()), daemon=True)
+            process.start()
+            shard_sock.close()
+            self.__shards.append((process, front_sock, Lock()))
+
+    def stop_shards(self):
+        for process, front_sock, lock in self.__shards:
+            front_sock.close()
+        for process, front_sock, lock in self.__shards:
+            process.join()
+        self.__shards.clear()
+
+    def shard_for_game(self, game_id) -> int:
+        return game_id % self.shard_count
+
+    def add_to_runners(self, game_id):
+        pass # runners are created by the shard when the first player arrives
+
+    def add_bot(self, game_id, account_id, difficulty):
+        process, front_sock, lock = self.__shards[self.shard_for_game(game_id)]
+        message = {
+            "game_id" : game_id,
+            "account_id" : account_id,
+            "client_address" : None,
+            "bot" : difficulty
+        }
+        with lock:
+            send_control_message(front_sock, message)
+
+    def connect_player(self, game_id, account_id, connection, client_address, new_game = False):
+        process, front_sock, lock = self.__shards[self.shard_for_game(game_id)]
+        message = {
+            "game_id" : game_id,
+            "account_id" : account_id,
+            "client_address" : client_address,
+            "encoding" : connection.encoding.name,
+            "compression" : connection.compression.name if connection.compression else None
+        }
+        with lock: # the pending bytes follow the message, no other message may come in between
+            send_control_message(front_sock, message, [connection.sock.fileno()], connection.reader.take_pending())
+        connection.close() # the shard holds its own copy of the socket now
@@ -0,0 +1,54 @@
+class SosOpportunityIndex:
+    """
+    SosOpportunityIndex keeps, for every empty cell, how many SOS triples each letter would complete there.
+    A placement can only change the counts of empty cells at most two cells away from it,
+    so place() recounts a 5x5 window instead of the whole board.
+    count_function(row, column, letter) counts the triples the board would give for that move.
+    """
+    MAX_COUNT = 8 # an "S" can close a triple in all 8 directions, an "O" in 4
+    LETTERS = ("S", "O")
+    __slots__ = ("__board_size", "__count_function", "__occupied", "__counts", "__moves_by_count")
+    def __init__(self, board_size, count_function):
+        self.__board_size = board_size
+        self.__count_function = count_function
+        self.__occupied = bytearray(board_size * board_size)
+        self.__counts = {} # (row, column, letter) -> count, only moves that score
+        self.__moves_by_count = {} # count -> set of moves, created when first needed
+
+    def place(self, row, column):
+        self.__occupied[row * self.__board_size + column] = 1
+        for i in range(max(row - 2, 0), min(row + 3, self.__board_size)):
+            for j in range(max(column - 2, 0), min(column + 3, self.__board_size)):
+                for letter in SosOpportunityIndex.LETTERS:
+                    if self.__occupied[i * self.__board_size + j]:
+                        self.set_count((i, j, letter), 0)
+                    else:
+                        self.set_count((i, j, letter), self.__count_function(i, j, letter))
+
+    def set_count(self, move, count):
+        old_count = self.__counts.get(move, 0)
+        if old_count == count:
+            return
+        if old_count:
+            self.__moves_by_count[old_count].discard(move)
+        if count:
+            self.__counts[move] = count
+            self.__moves_by_count.setdefault(count, set()).add(move)
+        else:
+            del self.__counts[move]
+
+    def count(self, row, column, letter) -> int:
+        return self.__counts.get((row, column, letter), 0)
+
+    def best_move(self):
+        """
+        Returns (row, column, letter) of a move completing the most triples, or None if no move scores.
+        Ties go to the lowest row, then column, so the same board always gets the same hint.
+        """
+        for count in range(SosOpportunityIndex.MAX_COUNT, 0, -1):
+            if self.__moves_by_count.get(count):
+                return min(self.__moves_by_count[count])
+        return None
+
+    def scoring_moves(self) -> dict:
+        return dict(self.__counts)
@@ -1,10 +1,17 @@
+import os
 from PySide2.QtWidgets import QWidget
 from PySide2.QtCore import Signal
 from sos.gui.admin_screen_ui import Ui_AdminScreen
-from sos.core.game_server import GameServer
+from sos.core.game_server import create_game_server
 
 class AdminScreen(QWidget, Ui_AdminScreen):
     signoutRequested = Signal()
+    # create_game_server arguments of each entry of serverModeComboBox
+    SERVER_MODES = {
+        "Threaded" : {},
+        "Asyncio" : {"use_asyncio" : True},
+        "Sharded" : {"shard_count" : os.cpu_count() or 1}
+    }
     def __init__(self):
         super().__init__()
         self.setupUi(self)
@@ -17,6 +24,7 @@ class AdminScreen(QWidget, Ui_AdminScreen):
         self.stopServerButton.setEnabled(False)
         self.startServerButton.setEnabled(True)
         self.serverAddressLineEdit.setEnabled(True)
+        self.serverModeComboBox.setEnabled(True)
 
     def handle_start_server(self):
         host = self.serverAddressLineEdit.text().split(":")[0].replace("-", "")
@@ -24,7 +32,8 @@ class AdminScreen(QWidget, Ui_AdminScreen):
         self.startServerButton.setEnabled(False)
         self.stopServerButton.setEnabled(True)
         self.serverAddressLineEdit.setEnabled(False)
-        self.game_server = GameServer(self.db_model, host, port)
+        self.serverModeComboBox.setEnabled(False)
+        self.game_server = create_game_server(self.db_model, host, port, **AdminScreen.SERVER_MODES[self.serverModeComboBox.currentText()])
         self.game_server.start()
         self.serverStatusLabel.setText("Running")
         
@@ -32,6 +41,7 @@ class AdminScreen(QWidget, Ui_AdminScreen):
         self.startServerButton.setEnabled(True)
         self.stopServerButton.setEnabled(False)
         self.serverAddressLineEdit.setEnabled(True)
+        self.serverModeComboBox.setEnabled(True)
         self.serverStatusLabel.setText("Stopped")
         self.game_server.stop()
 
@@ -41,12 +41,12 @@ class Ui_AdminScreen(object):
         self.signoutButton = QPushButton(AdminScreen)
         self.signoutButton.setObjectName(u"signoutButton")
 
-        self.gridLayout.addWidget(self.signoutButton, 0, 7, 1, 1)
+        self.gridLayout.addWidget(self.signoutButton, 0, 8, 1, 1)
 
         self.mdiArea = QMdiArea(AdminScreen)
         self.mdiArea.setObjectName(u"mdiArea")
 
-        self.gridLayout.addWidget(self.mdiArea, 1, 0, 1, 8)
+        self.gridLayout.addWidget(self.mdiArea, 1, 0, 1, 9)
 
         self.startServerButton = QPushButton(AdminScreen)
         self.startServerButton.setObjectName(u"startServerButton")
@@ -58,14 +58,22 @@ class Ui_AdminScreen(object):
 
         self.gridLayout.addWidget(self.serverAddressLineEdit, 0, 4, 1, 1)
 
+        self.serverModeComboBox = QComboBox(AdminScreen)
+        self.serverModeComboBox.addItem("")
+        self.serverModeComboBox.addItem("")
+        self.serverModeComboBox.addItem("")
+        self.serverModeComboBox.setObjectName(u"serverModeComboBox")
+
+        self.gridLayout.addWidget(self.serverModeComboBox, 0, 5, 1, 1)
+
         self.horizontalSpacer = QSpacerItem(40, 20, QSizePolicy.Expanding, QSizePolicy.Minimum)
 
-        self.gridLayout.addItem(self.horizontalSpacer, 0, 6, 1, 1)
+        self.gridLayout.addItem(self.horizontalSpacer, 0, 7, 1, 1)
 
         self.serverStatusLabel = QLabel(AdminScreen)
         self.serverStatusLabel.setObjectName(u"serverStatusLabel")
 
-        self.gridLayout.addWidget(self.serverStatusLabel, 0, 5, 1, 1)
+        self.gridLayout.addWidget(self.serverStatusLabel, 0, 6, 1, 1)
 
 
         self.retranslateUi(AdminScreen)
@@ -82,6 +90,9 @@ class Ui_AdminScreen(object):
         self.startServerButton.setText(QCoreApplication.translate("AdminScreen", u"Start server", None))
         self.serverAddressLineEdit.setInputMask(QCoreApplication.translate("AdminScreen", u"000.000.000.000:00000;-", None))
         self.serverAddressLineEdit.setText(QCoreApplication.translate("AdminScreen", u"127.0.0.1:12345", None))
+        self.serverModeComboBox.setItemText(0, QCoreApplication.translate("AdminScreen", u"Threaded", None))
+        self.serverModeComboBox.setItemText(1, QCoreApplication.translate("AdminScreen", u"Asyncio", None))
+        self.serverModeComboBox.setItemText(2, QCoreApplication.translate("AdminScreen", u"Sharded", None))
         self.serverStatusLabel.setText(QCoreApplication.translate("AdminScreen", u"running", None))
     # retranslateUi
 
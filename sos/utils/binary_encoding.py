@@ -0,0 +1,249 @@
+import struct
+from sos.utils.errors import ProtocolError
+
+__all__ = ["dumps", "loads", "COMMANDS"]
+
+# Binary payload layout: one byte command id followed by the command body.
+# Board messages have dedicated packed schemas, every other command carries its
+# remaining fields as tagged values (see pack_value / unpack_value).
+COMMANDS = [
+    "login_request", "login_response",
+    "signup_request", "signup_response",
+    "signout_request", "signout_response",
+    "get_account_request", "get_account_response",
+    "edit_account_request", "edit_account_response",
+    "edit_profile_request", "edit_profile_response",
+    "edit_username_request", "edit_username_response",
+    "edit_password_request", "edit_password_response",
+    "remove_account_request", "remove_account_response",
+    "new_game_request", "new_game_response",
+    "join_game_request", "join_game_response",
+    "game_runner_game_details",
+    "game_runner_new_player_banned",
+    "game_runner_players_status",
+    "game_runner_board_status",
+    "game_runner_board_delta",
+    "game_runner_board_request",
+    "game_runner_your_turn",
+    "game_runner_my_turn",
+    "game_runner_hint",
+    "game_runner_hint_result",
+    "game_runner_winner_announced",
+    "game_runner_disconnect",
+    "game_runner_abort"
+]
+COMMAND_IDS = {command : command_id for command_id, command in enumerate(COMMANDS)}
+
+LETTERS = ["", "S", "O"]
+LETTER_BITS = {letter : bits for bits, letter in enumerate(LETTERS)}
+UNOWNED_COLOR = "silver"
+
+BYTE = struct.Struct(">B")
+UINT16 = struct.Struct(">H")
+UINT32 = struct.Struct(">I")
+INT64 = struct.Struct(">q")
+FLOAT64 = struct.Struct(">d")
+BOARD_HEADER = struct.Struct(">IH") # sequence, board size
+DELTA_HEADER = struct.Struct(">IH") # sequence, cell count
+DELTA_CELL = struct.Struct(">HHB") # row, column, cell
+MY_TURN = struct.Struct(">HHB") # row, column, letter bits
+MAX_DEPTH = 32 # of nested lists and dicts in a tagged value
+
+class BinaryEncodingError(ProtocolError):
+    pass
+
+def check_size(buffer, offset : int, size : int):
+    if offset + size > len(buffer):
+        raise BinaryEncodingError("Frame of {} bytes ends before byte {}.".format(len(buffer), offset + size))
+
+def unpack_from(schema : struct.Struct, buffer, offset : int) -> tuple:
+    check_size(buffer, offset, schema.size)
+    return schema.unpack_from(buffer, offset)
+
+def decode_string(buffer, offset : int, length : int) -> str:
+    check_size(buffer, offset, length)
+    try:
+        return bytes(buffer[offset:offset + length]).decode(encoding="utf-8")
+    except UnicodeDecodeError as error:
+        raise BinaryEncodingError("Invalid string at byte {}: {}".format(offset, error))
+
+def pack_value(value, out : bytearray):
+    if value is None:
+        out += b"N"
+    elif value is True:
+        out += b"T"
+    elif value is False:
+        out += b"F"
+    elif isinstance(value, int):
+        out += b"i" + INT64.pack(value)
+    elif isinstance(value, float):
+        out += b"f" + FLOAT64.pack(value)
+    elif isinstance(value, str):
+        encoded = value.encode(encoding="utf-8")
+        out += b"s" + UINT32.pack(len(encoded)) + encoded
+    elif isinstance(value, (list, tuple)):
+        out += b"l" + UINT32.pack(len(value))
+        for item in value:
+            pack_value(item, out)
+    elif isinstance(value, dict):
+        out += b"d" + UINT32.pack(len(value))
+        for key, item in value.items():
+            pack_value(str(key), out)
+            pack_value(item, out)
+    else:
+        raise BinaryEncodingError("Unsupported value type {}.".format(type(value).__name__))
+
+def unpack_value(buffer, offset : int, depth = 0) -> tuple:
+    if depth > MAX_DEPTH:
+        raise BinaryEncodingError("Values nested deeper than {} levels.".format(MAX_DEPTH))
+    tag = unpack_from(BYTE, buffer, offset)[0]
+    offset += 1
+    if tag == ord("N"):
+        return None, offset
+    if tag == ord("T"):
+        return True, offset
+    if tag == ord("F"):
+        return False, offset
+    if tag == ord("i"):
+        return unpack_from(INT64, buffer, offset)[0], offset + INT64.size
+    if tag == ord("f"):
+        return unpack_from(FLOAT64, buffer, offset)[0], offset + FLOAT64.size
+    if tag == ord("s"):
+        length = unpack_from(UINT32, buffer, offset)[0]
+        offset += UINT32.size
+        return decode_string(buffer, offset, length), offset + length
+    if tag == ord("l"):
+        count = unpack_from(UINT32, buffer, offset)[0]
+        offset += UINT32.size
+        result = []
+        for i in range(count):
+            item, offset = unpack_value(buffer, offset, depth + 1)
+            result.append(item)
+        return result, offset
+    if tag == ord("d"):
+        count = unpack_from(UINT32, buffer, offset)[0]
+        offset += UINT32.size
+        result = {}
+        for i in range(count):
+            key, offset = unpack_value(buffer, offset, depth + 1)
+            if not isinstance(key, str):
+                raise BinaryEncodingError("Dictionary key at byte {} is not a string.".format(offset))
+            result[key], offset = unpack_value(buffer, offset, depth + 1)
+        return result, offset
+    raise BinaryEncodingError("Unknown value tag {}.".format(tag))
+
+def pack_palette(colors : dict, out : bytearray):
+    out += BYTE.pack(len(colors))
+    for color in colors:
+        encoded = color.encode(encoding="utf-8")
+        out += BYTE.pack(len(encoded)) + encoded
+
+def unpack_palette(buffer, offset : int) -> tuple:
+    palette = [UNOWNED_COLOR]
+    count = unpack_from(BYTE, buffer, offset)[0]
+    offset += 1
+    for i in range(count):
+        length = unpack_from(BYTE, buffer, offset)[0]
+        offset += 1
+        palette.append(decode_string(buffer, offset, length))
+        offset += length
+    return palette, offset
+
+def build_palette(cells) -> dict:
+    # palette index 0 is reserved for unowned cells
+    colors = {}
+    for color, letter in cells:
+        if color != UNOWNED_COLOR and color not in colors:
+            colors[color] = len(colors) + 1
+    if len(colors) > 63:
+        raise BinaryEncodingError("Too many colors for a packed board.")
+    return colors
+
+def pack_cell(colors : dict, color : str, letter : str) -> int:
+    # 2 bits for the letter, the remaining 6 bits for the owner's palette index
+    return (colors.get(color, 0) << 2) | LETTER_BITS[letter]
+
+def unpack_cell(palette : list, cell : int) -> list:
+    if cell >> 2 >= len(palette) or cell & 3 >= len(LETTERS):
+        raise BinaryEncodingError("Cell {} does not match a palette of {} colors.".format(cell, len(palette)))
+    return [palette[cell >> 2], LETTERS[cell & 3]]
+
+def dump_board_status(packet : dict, out : bytearray):
+    board = packet["data"]["board"]
+    colors = build_palette(cell for row in board for cell in row)
+    out += BOARD_HEADER.pack(packet["data"]["sequence"], len(board))
+    pack_palette(colors, out)
+    out += bytes(pack_cell(colors, color, letter) for row in board for color, letter in row)
+
+def load_board_status(buffer, offset : int) -> dict:
+    sequence, board_size = unpack_from(BOARD_HEADER, buffer, offset)
+    palette, offset = unpack_palette(buffer, offset + BOARD_HEADER.size)
+    check_size(buffer, offset, board_size * board_size)
+    board = []
+    for i in range(board_size):
+        row = buffer[offset + i * board_size:offset + (i + 1) * board_size]
+        board.append([unpack_cell(palette, cell) for cell in row])
+    return {"data" : {"sequence" : sequence, "board" : board}}
+
+def dump_board_delta(packet : dict, out : bytearray):
+    cells = packet["data"]["cells"]
+    colors = build_palette((color, letter) for row, column, color, letter in cells)
+    out += DELTA_HEADER.pack(packet["data"]["sequence"], len(cells))
+    pack_palette(colors, out)
+    for row, column, color, letter in cells:
+        out += DELTA_CELL.pack(row, column, pack_cell(colors, color, letter))
+
+def load_board_delta(buffer, offset : int) -> dict:
+    sequence, count = unpack_from(DELTA_HEADER, buffer, offset)
+    palette, offset = unpack_palette(buffer, offset + DELTA_HEADER.size)
+    check_size(buffer, offset, count * DELTA_CELL.size)
+    cells = []
+    for i in range(count):
+        row, column, cell = DELTA_CELL.unpack_from(buffer, offset + i * DELTA_CELL.size)
+        cells.append([row, column] + unpack_cell(palette, cell))
+    return {"data" : {"sequence" : sequence, "cells" : cells}}
+
+def dump_my_turn(packet : dict, out : bytearray):
+    data = packet["data"]
+    out += MY_TURN.pack(data["row"], data["column"], LETTER_BITS[data["letter"]])
+
+def load_my_turn(buffer, offset : int) -> dict:
+    row, column, letter = unpack_from(MY_TURN, buffer, offset)
+    if letter >= len(LETTERS):
+        raise BinaryEncodingError("Unknown letter {}.".format(letter))
+    return {"data" : {"row" : row, "column" : column, "letter" : LETTERS[letter]}}
+
+SCHEMAS = {
+    "game_runner_board_status" : (dump_board_status, load_board_status),
+    "game_runner_board_delta" : (dump_board_delta, load_board_delta),
+    "game_runner_my_turn" : (dump_my_turn, load_my_turn)
+}
+
+def dumps(packet : dict) -> bytes:
+    command = packet["command"]
+    if command not in COMMAND_IDS:
+        raise BinaryEncodingError("Command {} has no binary id.".format(command))
+    out = bytearray(BYTE.pack(COMMAND_IDS[command]))
+    if command in SCHEMAS:
+        SCHEMAS[command][0](packet, out)
+    else:
+        pack_value({key : value for key, value in packet.items() if key != "command"}, out)
+    return bytes(out)
+
+def loads(buffer) -> dict:
+    """
+    Raises BinaryEncodingError for truncated or malformed payloads, every read is checked against the buffer.
+    """
+    command_id = unpack_from(BYTE, buffer, 0)[0]
+    if command_id >= len(COMMANDS):
+        raise BinaryEncodingError("Unknown command id {}.".format(command_id))
+    command = COMMANDS[command_id]
+    if command in SCHEMAS:
+        fields = SCHEMAS[command][1](buffer, 1)
+    else:
+        fields, _ = unpack_value(buffer, 1)
+        if not isinstance(fields, dict):
+            raise BinaryEncodingError("Fields of {} are not a dictionary.".format(command))
+    result = {"command" : command}
+    result.update(fields)
+    return result
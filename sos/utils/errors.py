@@ -0,0 +1,5 @@
+class ProtocolError(Exception):
+    """
+    ProtocolError is raised for frames a peer should not have sent, the connection is dropped then.
+    """
+    pass
@@ -3,8 +3,11 @@
 # secret = list(range(256))
 # random.shuffle(secret)
 # Following list should be held secret:
-__all__ = ["encrypt_secret", "decrypt_secret"]
+__all__ = ["encrypt_secret", "decrypt_secret", "encrypt_table", "decrypt_table"]
 encrypt_secret = [227, 55, 201, 175, 156, 158, 38, 110, 33, 250, 249, 179, 157, 77, 59, 120, 169, 251, 248, 239, 86, 89, 14, 87, 18, 189, 128, 17, 4, 159, 138, 69, 37, 255, 5, 116, 118, 113, 30, 95, 56, 102, 61, 241, 223, 75, 194, 122, 163, 34, 45, 244, 54, 213, 202, 146, 139, 107, 35, 149, 96, 221, 217, 57, 26, 199, 127, 133, 229, 131, 168, 190, 76, 97, 186, 192, 52, 28, 126, 203, 207, 187, 92, 160, 219, 193, 84, 247, 182, 224, 109, 242, 78, 15, 43, 19, 63, 112, 254, 196, 125, 178, 111, 208, 46, 104, 188, 129, 79, 70, 98, 136, 226, 144, 225, 212, 103, 11, 71, 252, 49, 64, 85, 137, 141, 94, 185, 153, 237, 60, 48, 177, 152, 22, 240, 83, 236, 67, 135, 147, 62, 171, 21, 145, 164, 119, 218, 2, 41, 215, 32, 155, 81, 253, 40, 243, 214, 6, 58, 150, 246, 10, 42, 132, 123, 91, 68, 29, 8, 25, 166, 184, 191, 72, 140, 65, 204, 73, 31, 231, 232, 234, 39, 20, 172, 198, 195, 161, 124, 235, 100, 216, 12, 176, 16, 80, 23, 90, 66, 245, 121, 134, 99, 47, 13, 209, 220, 173, 108, 238, 143, 210, 228, 1, 211, 165, 197, 206, 183, 82, 142, 180, 151, 50, 174, 181, 7, 115, 170, 3, 222, 88, 106, 148, 0, 114, 154, 44, 117, 9, 93, 53, 230, 24, 130, 27, 105, 162, 74, 167, 51, 101, 36, 205, 233, 200]
 decrypt_secret = [None for i in range(256)]
 for i in range(256):
-    decrypt_secret[encrypt_secret[i]] = i
\ No newline at end of file
+    decrypt_secret[encrypt_secret[i]] = i
+# 256-byte translation tables, suitable for bytes.translate / bytearray.translate
+encrypt_table = bytes(encrypt_secret)
+decrypt_table = bytes(decrypt_secret)
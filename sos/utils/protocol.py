@@ -1,10 +1,18 @@
 import struct
 import json
+import zlib
+import asyncio
+import socket
+from collections import deque
+from threading import Thread, Lock, Condition, Timer
+from time import time
 from sos.utils.mapgen import *
+from sos.utils.errors import ProtocolError
+from sos.utils import binary_encoding
 
 class Packet(dict):
     """
-    Packet is used to represent a request or response. 
+    Packet is used to represent a request or response.
     It has a "command" (equivalent to URL in APIs), "data" a dictionary of data fields, and may contain "session" data.
     """
     def __init__(self, d=None):
@@ -17,39 +25,562 @@ class Packet(dict):
         return json.dumps(self)
 
     @staticmethod
-    def fromJson(js : str): 
+    def fromJson(js : str):
         return Packet(js)
 
-    def send(self, sock):
-        send_msg(sock, self.toJson())
+    def send(self, sock, encoding = None, codec = None, compression = None):
+        send_frame(sock, self.to_frame(encoding, codec, compression))
+
+    def to_frame(self, encoding = None, codec = None, compression = None) -> bytes:
+        """
+        Serializes, encrypts and length-prefixes the packet once, so the same frame can be sent to many sockets.
+        """
+        encoding = encoding if encoding else JSON_ENCODING
+        return encode_frame(encoding.dumps(self), codec, compression)
+
+    @staticmethod
+    def recv(sock, encoding = None, codec = None):
+        encoding = encoding if encoding else JSON_ENCODING
+        payload = recv_payload(sock, codec)
+        if not payload:
+            return Packet()
+        return encoding.loads(payload)
+
+class Encoding:
+    """
+    Encoding turns a packet into the frame payload bytes and back.
+    """
+    name = None
+
+    def dumps(self, packet : Packet) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, payload) -> Packet:
+        raise NotImplementedError
+
+class JsonEncoding(Encoding):
+    name = "json"
+
+    def dumps(self, packet : Packet) -> bytes:
+        return packet.toJson().encode(encoding="utf-8")
+
+    def loads(self, payload) -> Packet:
+        fields = json.loads(bytes(payload).decode(encoding="utf-8"))
+        if not isinstance(fields, dict):
+            raise ProtocolError("JSON frame is not an object.")
+        packet = Packet()
+        packet.update(fields)
+        return packet
+
+class BinaryEncoding(Encoding):
+    """
+    BinaryEncoding packs boards as one byte per cell and every other command as struct-packed tagged values.
+    See sos.utils.binary_encoding for the layout.
+    """
+    name = "binary"
+
+    def dumps(self, packet : Packet) -> bytes:
+        return binary_encoding.dumps(packet)
+
+    def loads(self, payload) -> Packet:
+        packet = Packet()
+        packet.update(binary_encoding.loads(payload))
+        return packet
+
+JSON_ENCODING = JsonEncoding()
+BINARY_ENCODING = BinaryEncoding()
+ENCODINGS = {encoding.name : encoding for encoding in [JSON_ENCODING, BINARY_ENCODING]}
+
+def negotiate_encoding(request : Packet) -> Encoding:
+    """
+    Clients opt into another encoding with an "encoding" field in their first request, JSON is the default.
+    """
+    return ENCODINGS.get(request.get("encoding"), JSON_ENCODING)
+
+class Compression:
+    """
+    Compression is applied to frame payloads of at least threshold bytes, before the codec.
+    Compressed frames are marked with COMPRESSED_FLAG in their length prefix.
+    """
+    name = None
+
+    def __init__(self, threshold : int):
+        self.threshold = threshold
+
+    def compress(self, payload : bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, payload, max_length : int) -> bytes:
+        raise NotImplementedError
+
+# Preset dictionary shared by both ends. It primes every frame with the strings boards and
+# status updates repeat, while keeping frames independent so a broadcast frame is still built once.
+ZLIB_DICTIONARY = (
+    b'{"command": "game_runner_players_status", "data": {"scores": {}, "colors": {}, "hints": {}, "status": {}}}'
+    b'"online", "offline", "0h", '
+    b'{"command": "game_runner_board_delta", "data": {"sequence": 0, "cells": [[0, 0, "hsl(0, 100%, 50%)", "S"]]}}'
+    b'{"command": "game_runner_board_status", "data": {"sequence": 0, "board": [['
+    b'["hsl(0, 100%, 50%)", "O"], ["hsl(0, 100%, 50%)", "S"], ' + b'["silver", ""], ' * 16
+)
+
+class ZlibCompression(Compression):
+    name = "zlib"
+    DEFAULT_THRESHOLD = 512
+
+    def __init__(self, threshold = None, level = 6, zdict = ZLIB_DICTIONARY):
+        super().__init__(threshold if threshold else ZlibCompression.DEFAULT_THRESHOLD)
+        self.__level = level
+        self.__zdict = zdict
+
+    def compress(self, payload : bytes) -> bytes:
+        compressor = zlib.compressobj(self.__level, zdict=self.__zdict)
+        return compressor.compress(payload) + compressor.flush()
+
+    def decompress(self, payload, max_length : int) -> bytes:
+        decompressor = zlib.decompressobj(zdict=self.__zdict)
+        try:
+            result = decompressor.decompress(payload, max_length)
+        except zlib.error as error:
+            raise ProtocolError("Corrupt compressed frame: {}".format(error))
+        if decompressor.unconsumed_tail:
+            raise FrameTooLargeError("Decompressed frame exceeds the limit of {} bytes.".format(max_length))
+        return result
+
+ZLIB_COMPRESSION = ZlibCompression()
+COMPRESSIONS = {compression.name : compression for compression in [ZLIB_COMPRESSION]}
+
+def negotiate_compression(request : Packet) -> Compression:
+    """
+    Clients opt into compression with a "compression" field in their first request, frames are not compressed by default.
+    """
+    return COMPRESSIONS.get(request.get("compression"))
+
+class Codec:
+    """
+    Codec transforms frame payloads on their way to and from the socket.
+    bytearray buffers are transformed in place and returned, bytes and memoryviews are returned as a new bytes object.
+    """
+    def encode(self, buffer):
+        return buffer
+
+    def decode(self, buffer):
+        return buffer
+
+class SubstitutionCodec(Codec):
+    """
+    SubstitutionCodec applies a byte substitution cipher as a single bulk translation over 256-byte tables.
+    """
+    def __init__(self, encode_table : bytes, decode_table : bytes):
+        self.__encode_table = encode_table
+        self.__decode_table = decode_table
+
+    def encode(self, buffer):
+        return SubstitutionCodec.translate(buffer, self.__encode_table)
+
+    def decode(self, buffer):
+        return SubstitutionCodec.translate(buffer, self.__decode_table)
 
     @staticmethod
-    def recv(sock):
-        return Packet.fromJson(recv_msg(sock))
+    def translate(buffer, table : bytes):
+        if isinstance(buffer, bytearray):
+            buffer[:] = buffer.translate(table)
+            return buffer
+        return bytes(buffer).translate(table)
+
+DEFAULT_CODEC = SubstitutionCodec(encrypt_table, decrypt_table)
+LENGTH_PREFIX = struct.Struct('>I')
+COMPRESSED_FLAG = 0x80000000
+
+class FrameTooLargeError(ProtocolError):
+    pass
+
+class SlowConsumerError(ProtocolError):
+    pass
+
+class OutboundQueue:
+    """
+    OutboundQueue holds the frames waiting to be written to one client.
+    A frame put as a snapshot of a group replaces the frames of that group still waiting, they are out of date.
+    put raises SlowConsumerError once the client has stayed over max_queued_bytes for slow_consumer_timeout seconds,
+    or at once past HARD_LIMIT_FACTOR times the limit. The queue is cleared and closed then.
+    """
+    DEFAULT_MAX_QUEUED_BYTES = 1024 * 1024
+    DEFAULT_SLOW_CONSUMER_TIMEOUT = 10
+    HARD_LIMIT_FACTOR = 4
+    def __init__(self, max_queued_bytes = None, slow_consumer_timeout = None):
+        self.max_queued_bytes = max_queued_bytes if max_queued_bytes else OutboundQueue.DEFAULT_MAX_QUEUED_BYTES
+        self.slow_consumer_timeout = slow_consumer_timeout if slow_consumer_timeout else OutboundQueue.DEFAULT_SLOW_CONSUMER_TIMEOUT
+        self.coalesced_frames = 0
+        self.__frames = deque() # (frame, group)
+        self.__queued_bytes = 0
+        self.__over_limit_since = None
+        self.__is_closed = False
+        self.__not_empty = Condition()
+
+    def put(self, frame : bytes, group = None, snapshot = False):
+        with self.__not_empty:
+            if self.__is_closed:
+                return
+            if snapshot and group is not None:
+                kept = deque(item for item in self.__frames if item[1] != group)
+                self.coalesced_frames += len(self.__frames) - len(kept)
+                self.__frames = kept
+                self.__queued_bytes = sum(len(item[0]) for item in kept)
+            self.__frames.append((frame, group))
+            self.__queued_bytes += len(frame)
+            if self.__queued_bytes > self.max_queued_bytes:
+                if self.__over_limit_since is None:
+                    self.__over_limit_since = time()
+                if self.__queued_bytes > self.max_queued_bytes * OutboundQueue.HARD_LIMIT_FACTOR or \
+                        time() - self.__over_limit_since > self.slow_consumer_timeout:
+                    error = SlowConsumerError("Client fell {} bytes behind.".format(self.__queued_bytes))
+                    self.__frames.clear()
+                    self.__queued_bytes = 0
+                    self.__is_closed = True
+                    self.__not_empty.notify()
+                    raise error
+            self.__not_empty.notify()
+
+    def take(self, block = True) -> list:
+        """
+        Removes and returns all waiting frames, an empty list if there are none and block is False,
+        and None once the queue is closed and empty.
+        """
+        with self.__not_empty:
+            while block and not self.__frames and not self.__is_closed:
+                self.__not_empty.wait()
+            if not self.__frames:
+                return None if self.__is_closed else []
+            frames = [frame for frame, group in self.__frames]
+            self.__frames.clear()
+            self.__queued_bytes = 0
+            self.__over_limit_since = None
+            return frames
+
+    def close(self, last_frame : bytes = None) -> bool:
+        """
+        Closes the queue after the waiting frames and last_frame, returns True if frames are still waiting.
+        """
+        with self.__not_empty:
+            if last_frame is not None:
+                self.__frames.append((last_frame, None))
+            self.__is_closed = True
+            self.__not_empty.notify()
+            return bool(self.__frames)
+
+class FrameReader:
+    """
+    FrameReader reads length-prefixed frames from a socket with recv_into into a reusable buffer.
+    Frames are returned as memoryviews into that buffer and stay valid until the next read_frame call,
+    compressed tells whether the last frame returned had COMPRESSED_FLAG set.
+    """
+    DEFAULT_MAX_FRAME_SIZE = 1024 * 1024
+    DEFAULT_BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, sock, max_frame_size = None, buffer_size = None):
+        self.__sock = sock
+        self.max_frame_size = max_frame_size if max_frame_size else FrameReader.DEFAULT_MAX_FRAME_SIZE
+        self.__buffer = bytearray(buffer_size if buffer_size else FrameReader.DEFAULT_BUFFER_SIZE)
+        self.__view = memoryview(self.__buffer)
+        self.__start = 0 # first byte not handed out yet
+        self.__end = 0 # one past the last received byte
+        self.compressed = False
+
+    def read_frame(self) -> memoryview:
+        if not self.__fill(LENGTH_PREFIX.size):
+            return None
+        frame_length = LENGTH_PREFIX.unpack_from(self.__buffer, self.__start)[0]
+        self.compressed = bool(frame_length & COMPRESSED_FLAG)
+        frame_length &= ~COMPRESSED_FLAG
+        if frame_length > self.max_frame_size:
+            raise FrameTooLargeError("Frame of {} bytes exceeds the limit of {} bytes.".format(frame_length, self.max_frame_size))
+        if not self.__fill(LENGTH_PREFIX.size + frame_length):
+            return None
+        frame_start = self.__start + LENGTH_PREFIX.size
+        self.__start = frame_start + frame_length
+        return self.__view[frame_start:self.__start]
+
+    def has_pending(self) -> bool:
+        return self.__end > self.__start
+
+    def take_pending(self) -> bytes:
+        """
+        Removes and returns the bytes received but not handed out yet, e.g. to pass the socket on.
+        """
+        pending = bytes(self.__view[self.__start:self.__end])
+        self.__start = self.__end = 0
+        return pending
+
+    def put_pending(self, data : bytes):
+        """
+        Appends bytes received by another reader of the same socket, they are read before the socket itself.
+        """
+        pending = bytes(self.__view[self.__start:self.__end]) + data
+        if len(pending) > len(self.__buffer):
+            self.__buffer = bytearray(len(pending))
+            self.__view = memoryview(self.__buffer)
+        self.__view[:len(pending)] = pending
+        self.__start = 0
+        self.__end = len(pending)
+
+    def __fill(self, n : int) -> bool:
+        pending = self.__end - self.__start
+        if pending >= n:
+            return True
+        if self.__start + n > len(self.__buffer):
+            if n > len(self.__buffer):
+                self.__buffer = bytearray(max(n, 2 * len(self.__buffer)))
+                new_view = memoryview(self.__buffer)
+                new_view[:pending] = self.__view[self.__start:self.__end]
+                self.__view = new_view
+            else:
+                self.__view[:pending] = self.__view[self.__start:self.__end]
+            self.__start = 0
+            self.__end = pending
+        while self.__end - self.__start < n:
+            received = self.__sock.recv_into(self.__view[self.__end:])
+            if received == 0:
+                return False
+            self.__end += received
+        return True
+
+class Connection:
+    """
+    Connection wraps a client socket together with the wire format negotiated for it.
+    """
+    def __init__(self, sock, encoding = None, codec = None, max_frame_size = None, compression = None):
+        self.sock = sock
+        self.encoding = encoding if encoding else JSON_ENCODING
+        self.codec = codec if codec else DEFAULT_CODEC
+        self.compression = compression
+        self.max_frame_size = max_frame_size if max_frame_size else FrameReader.DEFAULT_MAX_FRAME_SIZE
+        self.reader = FrameReader(sock, self.max_frame_size) if sock is not None else None
+        self.outbound = None
+        self.abort_error = None
+        self.abort_packet = None
+        self.__socket_lock = Lock()
+        self.__socket_owners = 0
+
+    @property
+    def frame_format(self):
+        # connections with the same frame format can share prebuilt frames
+        return (self.encoding, self.codec, self.compression)
+
+    def to_frame(self, packet : Packet) -> bytes:
+        return packet.to_frame(self.encoding, self.codec, self.compression)
+
+    def send(self, packet : Packet, group = None, snapshot = False):
+        self.send_frame(self.to_frame(packet), group, snapshot)
+
+    def send_frame(self, frame : bytes, group = None, snapshot = False):
+        if self.outbound is None:
+            send_frame(self.sock, frame)
+            return
+        try:
+            self.outbound.put(frame, group, snapshot)
+        except SlowConsumerError as error:
+            self.abort(error)
+
+    def start_writer(self, abort_packet : Packet = None, max_queued_bytes = None, slow_consumer_timeout = None):
+        """
+        From now on frames are queued and written by a writer thread, so send never blocks on the network.
+        A client that falls too far behind gets abort_packet with the reason as its "error" and is shut down.
+        """
+        self.abort_packet = abort_packet
+        self.outbound = OutboundQueue(max_queued_bytes, slow_consumer_timeout)
+        self.__socket_owners = 2 # the writer and whoever calls close
+        self.spawn_writer()
+
+    def spawn_writer(self):
+        Thread(target=self.writer, daemon=True).start()
+
+    def writer(self):
+        while True:
+            frames = self.outbound.take()
+            if frames is None:
+                break
+            try:
+                send_frame(self.sock, b"".join(frames))
+            except OSError:
+                self.shutdown()
+        if self.abort_error:
+            self.shutdown() # wakes up the reader blocked in recv
+        self.release_socket()
+
+    def release_socket(self):
+        with self.__socket_lock:
+            self.__socket_owners -= 1
+            if self.__socket_owners == 0:
+                self.sock.close()
+
+    def abort_frame(self, error) -> bytes:
+        if self.abort_packet is None:
+            return None
+        packet = Packet()
+        packet.update(self.abort_packet)
+        packet["data"] = {
+            "error" : str(error)
+        }
+        return self.to_frame(packet)
+
+    def abort(self, error):
+        # recv raises error from now on, the writer gets a little time to deliver the reason
+        self.abort_error = error
+        self.outbound.close(self.abort_frame(error))
+        self.shutdown_later()
+
+    def shutdown_later(self):
+        Timer(self.outbound.slow_consumer_timeout, self.shutdown).start()
+
+    def shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def recv(self) -> Packet:
+        frame = self.reader.read_frame()
+        if frame is None: # a zero-length frame is not the end of the stream
+            if self.abort_error:
+                raise self.abort_error
+            return Packet()
+        return self.decode_frame(frame, self.reader.compressed)
+
+    def decode_frame(self, frame, compressed : bool) -> Packet:
+        """
+        Raises ProtocolError for any frame that does not decode, whichever of the codec, compression or encoding fails.
+        """
+        try:
+            payload = self.codec.decode(frame)
+            if compressed:
+                if not self.compression:
+                    raise ProtocolError("Compressed frame received without negotiating compression.")
+                payload = self.compression.decompress(payload, self.max_frame_size)
+            return self.encoding.loads(payload)
+        except ProtocolError:
+            raise
+        except (ValueError, TypeError, AttributeError, RecursionError) as error:
+            raise ProtocolError("Malformed {} frame: {}".format(self.encoding.name, error))
+
+    def close(self):
+        if self.outbound is None:
+            self.sock.close()
+            return
+        if self.outbound.close(): # the writer sends the waiting frames first
+            self.shutdown_later()
+        self.release_socket()
+
+class AsyncConnection(Connection):
+    """
+    AsyncConnection speaks the same protocol over asyncio streams.
+    send_frame and close may be called from any thread, they are handed to the event loop in order.
+    """
+    def __init__(self, stream_reader, stream_writer, loop, encoding = None, codec = None, max_frame_size = None, compression = None):
+        super().__init__(None, encoding, codec, max_frame_size, compression)
+        self.stream_reader = stream_reader
+        self.stream_writer = stream_writer
+        self.loop = loop
+        self.__wakeup = asyncio.Event()
+
+    def send_frame(self, frame : bytes, group = None, snapshot = False):
+        if self.outbound is None:
+            self.loop.call_soon_threadsafe(self.stream_writer.write, frame)
+            return
+        super().send_frame(frame, group, snapshot)
+        self.loop.call_soon_threadsafe(self.__wakeup.set)
+
+    def spawn_writer(self):
+        asyncio.run_coroutine_threadsafe(self.writer_async(), self.loop)
+
+    async def writer_async(self):
+        while True:
+            frames = self.outbound.take(block = False)
+            if frames is None:
+                break
+            if not frames:
+                await self.__wakeup.wait()
+                self.__wakeup.clear()
+                continue
+            self.stream_writer.write(b"".join(frames))
+            try:
+                await self.stream_writer.drain()
+            except ConnectionError:
+                self.shutdown()
+        self.stream_writer.close()
+
+    def shutdown_later(self):
+        self.loop.call_soon_threadsafe(self.loop.call_later, self.outbound.slow_consumer_timeout, self.shutdown)
+
+    def shutdown(self):
+        self.stream_writer.transport.abort()
+
+    def recv(self) -> Packet:
+        # blocking receive for code running outside the event loop thread
+        return asyncio.run_coroutine_threadsafe(self.recv_async(), self.loop).result()
+
+    async def recv_async(self) -> Packet:
+        try:
+            header = await self.stream_reader.readexactly(LENGTH_PREFIX.size)
+            frame_length = LENGTH_PREFIX.unpack(header)[0]
+            compressed = bool(frame_length & COMPRESSED_FLAG)
+            frame_length &= ~COMPRESSED_FLAG
+            if frame_length > self.max_frame_size:
+                raise FrameTooLargeError("Frame of {} bytes exceeds the limit of {} bytes.".format(frame_length, self.max_frame_size))
+            frame = bytearray(await self.stream_reader.readexactly(frame_length))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            frame = None
+        if frame is None:
+            if self.abort_error:
+                raise self.abort_error
+            return Packet()
+        return self.decode_frame(frame, compressed)
+
+    def close(self):
+        if self.outbound is None:
+            self.loop.call_soon_threadsafe(self.stream_writer.close)
+            return
+        super().close()
+        self.loop.call_soon_threadsafe(self.__wakeup.set)
 
 def encrypt(bmsg : bytes) -> bytearray:
-    result = bytearray()
-    for b in bmsg:
-        result.append(encrypt_secret[int(b)])
-    return result
+    return bytearray(bmsg).translate(encrypt_table)
 
 def decrypt(bmsg : bytes) -> bytearray:
-    result = bytearray()
-    for b in bmsg:
-        result.append(decrypt_secret[int(b)])
-    return result
+    return bytearray(bmsg).translate(decrypt_table)
+
+def encode_frame(payload : bytes, codec = None, compression = None) -> bytes:
+    codec = codec if codec else DEFAULT_CODEC
+    flags = 0
+    if compression and len(payload) >= compression.threshold:
+        compressed = compression.compress(payload)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags = COMPRESSED_FLAG
+    payload = codec.encode(payload)
+    return LENGTH_PREFIX.pack(len(payload) | flags) + payload
+
+def send_frame(sock, frame : bytes):
+    sock.sendall(frame)
 
-def send_msg(sock, msg : str):
-    msg = encrypt(msg.encode(encoding="utf-8"))
-    msg = struct.pack('>I', len(msg)) + msg
-    sock.sendall(msg)
+def send_msg(sock, msg : str, codec = None):
+    send_frame(sock, encode_frame(msg.encode(encoding="utf-8"), codec))
 
-def recv_msg(sock) -> str:
+def recv_payload(sock, codec = None) -> bytearray:
+    codec = codec if codec else DEFAULT_CODEC
     raw_msglen = recvall(sock, 4)
     if not raw_msglen:
         return None
-    msglen = struct.unpack('>I', raw_msglen)[0]
-    return decrypt(recvall(sock, msglen)).decode(encoding="utf-8")
+    msglen = LENGTH_PREFIX.unpack(raw_msglen)[0]
+    data = recvall(sock, msglen)
+    if data is None:
+        return None
+    return codec.decode(data)
+
+def recv_msg(sock, codec = None) -> str:
+    payload = recv_payload(sock, codec)
+    if payload is None:
+        return None
+    return payload.decode(encoding="utf-8")
 
 def recvall(sock, n : int) -> bytearray:
     data = bytearray()
@@ -58,4 +589,4 @@ def recvall(sock, n : int) -> bytearray:
         if not packet:
             return None
         data.extend(packet)
-    return data
\ No newline at end of file
+    return data
@@ -1,12 +1,1015 @@
+import os
 import sys
+import asyncio
+import threading
+import time
+import random
+import zlib
+import socket
+import tempfile
+import sqlite3
+from sos.utils.mapgen import encrypt_secret, decrypt_secret, encrypt_table
+from concurrent.futures import Future
+from sos.core import bot
 from sos.core.database_manager import DatabaseManager
-from sos.core.game_server import GameServer
+from sos.core.game_server import GameServer, GameRunner, GameScheduler, Queue, create_game_server
+from sos.core.async_game_server import AsyncGameRunner
+from sos.utils.protocol import Packet, Connection, ProtocolError, BINARY_ENCODING, LENGTH_PREFIX, FrameReader, FrameTooLargeError
+from sos.utils.protocol import OutboundQueue, SlowConsumerError
+from sos.utils.protocol import COMPRESSED_FLAG, ZLIB_COMPRESSION, ZlibCompression, negotiate_compression, encode_frame, DEFAULT_CODEC
+from sos.utils.binary_encoding import pack_value, unpack_value, BinaryEncodingError, COMMAND_IDS
+from sos.core.board import Board, CompactBoard
+from sos.core.numpy_board import NumpyBoard
+from sos.core.sos_index import SosOpportunityIndex
+from sos.core.game_replay import GameReplay, WrongMoveNumberError
+from sos.core.game_journal import GameJournal
+from sos.core.connection_pool import ConnectionPool
+from sos.core.command_registry import CommandRegistry, CommandMetrics
+from sos.core.admission_control import AdmissionController, AdmissionRejectedError
+from sos.core.sharded_game_server import send_control_message, recv_control_message
 
-def test_game_server():
+def test_codec_matches_legacy_cipher():
+    payload = bytes(range(256))
+    legacy = bytes(encrypt_secret[byte] for byte in payload) # the former per-byte loop
+    assert encrypt_table == legacy
+    assert DEFAULT_CODEC.encode(payload) == legacy
+    assert DEFAULT_CODEC.encode(bytearray(payload)) == legacy
+    assert bytes(DEFAULT_CODEC.encode(memoryview(bytearray(payload)))) == legacy
+    assert bytes(DEFAULT_CODEC.decode(bytearray(legacy))) == payload
+    assert bytes(DEFAULT_CODEC.decode(legacy)) == bytes(decrypt_secret[byte] for byte in legacy)
+
+def start_game(db_manager, usernames, board_size = 3, max_hint = 1, journal = None) -> tuple:
+    # a game created by the first player and joined by all of them, handled without a scheduler
+    sessions = []
+    for username in usernames:
+        db_manager.add_account(username, "password", "FIRST", "LAST")
+        sessions.append(db_manager.login(username, "password"))
+    game_id, creator_id = db_manager.new_game(sessions[0], board_size, len(usernames), True, max_hint)
+    account_ids = [creator_id] + [db_manager.join_game(session, game_id, usernames[0]) for session in sessions[1:]]
+    runner = GameRunner(db_manager, game_id, journal = journal)
+    clients = {account_id : join_player(runner, account_id) for account_id in account_ids}
+    return runner, clients
+
+def join_player(runner, account_id) -> Connection:
+    server_sock, client_sock = socket.socketpair()
+    runner.handle_task({
+        "command" : "new_player_connection_task",
+        "account_id" : account_id,
+        "connection" : Connection(server_sock),
+        "client_address" : None
+    })
+    return Connection(client_sock)
+
+def play(runner, account_id, row, column, letter):
+    runner.handle_task({"command" : "player_turn_done_task", "account_id" : account_id, "row" : row, "column" : column, "letter" : letter})
+
+def test_broadcast_serializes_once():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "broadcast.sqlite3"))
+    runner, clients = start_game(db_manager, ["first", "second", "third"])
+    frames = []
+    to_frame = Packet.to_frame
+    def counting_to_frame(packet, *args):
+        frames.append(to_frame(packet, *args))
+        return frames[-1]
+    Packet.to_frame = counting_to_frame
+    try:
+        runner.broadcast(make_packet("game_runner_hint_result", {"result" : "broadcast"}))
+    finally:
+        Packet.to_frame = to_frame
+    assert len(frames) == 1
+    for client in clients.values():
+        while True:
+            frame = client.reader.read_frame()
+            if LENGTH_PREFIX.pack(len(frame)) + frame == frames[0]:
+                break
+        client.close()
+
+def test_board_deltas_and_snapshots():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "deltas.sqlite3"))
+    runner, clients = start_game(db_manager, ["first", "second"])
+    first, second = runner._GameRunner__players_turn
+    colors = {account_id : wait_for(clients[account_id], "game_runner_game_details")["data"]["color"] for account_id in clients}
+    play(runner, first, 0, 0, "S")
+    play(runner, second, 0, 1, "O")
+    play(runner, first, 0, 2, "S") # completes a triple, the O is recoloured
+    deltas = [wait_for(clients[second], "game_runner_board_delta")["data"] for i in range(3)]
+    assert [delta["sequence"] for delta in deltas] == [1, 2, 3]
+    assert deltas[0]["cells"] == [[0, 0, colors[first], "S"]]
+    assert deltas[1]["cells"] == [[0, 1, colors[second], "O"]]
+    assert deltas[2]["cells"][0] == [0, 2, colors[first], "S"] # the placed cell comes first
+    assert sorted(deltas[2]["cells"][1:]) == [[0, 0, colors[first], "S"], [0, 1, colors[first], "O"]]
+    runner.handle_task({"command" : "disconnect_player_task", "account_id" : second})
+    clients[second].close()
+    client = join_player(runner, second) # a rejoining player gets the whole board
+    snapshot = wait_for(client, "game_runner_board_status")["data"]
+    assert snapshot["sequence"] == 3
+    assert snapshot["board"][0] == [[colors[first], "S"], [colors[first], "O"], [colors[first], "S"]]
+    assert snapshot["board"][1] == [["silver", ""]] * 3
+    runner.handle_task({"command" : "board_snapshot_task", "account_id" : first})
+    while True: # skipping the snapshots sent when the players joined
+        status = wait_for(clients[first], "game_runner_board_status")["data"]
+        if status["sequence"] == 3:
+            break
+    assert status == snapshot
+    client.close()
+    clients[first].close()
+
+def run_game_server():
     db_manager = DatabaseManager()
     server = GameServer(db_manager, "127.0.0.1", 12345)
     server.start()
     server.join()
 
+def test_game_server():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "server.sqlite3"))
+    port = free_port()
+    server = GameServer(db_manager, "127.0.0.1", port)
+    server.start()
+    try:
+        time.sleep(0.2)
+        assert request(port, "signup_request", {"username" : "server", "password" : "password", "firstname" : "SER", "lastname" : "VER"}).recv()["data"] == {"ok" : "done"}
+        session_id = request(port, "login_request", {"username" : "server", "password" : "password"}).recv()["data"]["session_id"]
+        assert request(port, "get_account_request", {"session_id" : session_id}).recv()["data"]["username"] == "server"
+        metrics = server.command_metrics()
+        assert [metrics[command]["count"] >= 1 for command in ("signup_request", "login_request", "get_account_request")] == [True] * 3
+    finally:
+        server.stop()
+        server.join(10)
+    assert not server.is_alive()
+
+def test_queue_dequeue_blocks_until_woken():
+    queue = Queue()
+    assert queue.dequeue() is None
+    started = time.monotonic()
+    assert queue.dequeue(block = True, timeout = 0.1) is None
+    assert 0.1 <= time.monotonic() - started < 1
+    threading.Timer(0.1, queue.enqueue, ("task",)).start()
+    started = time.monotonic()
+    assert queue.dequeue(block = True) == "task" # woken by the enqueue, not by a timeout
+    assert 0.05 < time.monotonic() - started < 1
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "queue.sqlite3"))
+    db_manager.add_account("queue", "password", "QU", "EUE")
+    runner = GameRunner(db_manager, db_manager.new_game(db_manager.login("queue", "password"), 3, 2, True, 1)[0])
+    threading.Timer(0.1, runner.stop).start()
+    started = time.monotonic()
+    assert runner._tasks_queue.dequeue(block = True, timeout = 10) == {"command" : "stop_task"}
+    assert time.monotonic() - started < 1
+
+class RecordingGameRunner(GameRunner):
+    IDLE_TIMEOUT = 0.3
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handled = []
+        self.running = 0
+        self.overlaps = 0
+        self.lock = threading.Lock()
+
+    def handle_task(self, task):
+        if "number" not in task:
+            return super().handle_task(task)
+        with self.lock:
+            self.running += 1
+            self.overlaps += self.running > 1
+        time.sleep(0.0005)
+        self.handled.append(task["number"])
+        with self.lock:
+            self.running -= 1
+
+def new_games(db_manager, game_count) -> list:
+    db_manager.add_account("creator", "password", "CRE", "ATOR")
+    session_token = db_manager.login("creator", "password")
+    return [db_manager.new_game(session_token, 3, 2, True, 1)[0] for i in range(game_count)]
+
+def test_scheduler_runs_each_game_serially():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "scheduler.sqlite3"))
+    scheduler = GameScheduler(worker_count = 4)
+    scheduler.start()
+    runners = [RecordingGameRunner(db_manager, game_id, scheduler) for game_id in new_games(db_manager, 4)]
+    for i in range(200):
+        for runner in runners:
+            runner.enqueue_task({"command" : "record_task", "number" : i})
+    for runner in runners: # stopped in the middle of their batches
+        runner.stop()
+    scheduler.stop()
+    for runner in runners:
+        assert runner.handled == list(range(200))
+        assert runner.overlaps == 0
+        assert runner.has_ended
+    assert db_manager.db_cursor.execute("SELECT COUNT(*) FROM Games WHERE (is_running = 1);").fetchone()[0] == 0
+
+def test_scheduler_reaps_idle_games():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "reaping.sqlite3"))
+    scheduler = GameScheduler(worker_count = 2)
+    scheduler.start()
+    game_ids = new_games(db_manager, 2)
+    idle_runner, busy_runner = [RecordingGameRunner(db_manager, game_id, scheduler) for game_id in game_ids]
+    busy_runner.IDLE_TIMEOUT = 60
+    started = time.monotonic()
+    scheduler.schedule(idle_runner)
+    scheduler.schedule(busy_runner)
+    while not idle_runner.has_ended and time.monotonic() - started < 5:
+        busy_runner.enqueue_task({"command" : "record_task", "number" : 0})
+        time.sleep(0.02)
+    assert idle_runner.has_ended and not busy_runner.has_ended
+    assert 0.3 <= time.monotonic() - started < 2 # reaped from the deadline heap after IDLE_TIMEOUT
+    assert [db_manager.db_cursor.execute("SELECT is_running FROM Games WHERE (game_id = ?);", (game_id,)).fetchone()[0] for game_id in game_ids] == [0, 1]
+    busy_runner.stop()
+    scheduler.stop()
+    assert busy_runner.has_ended
+
+def test_binary_values_round_trip():
+    value = {"a" : [0, -2 ** 63, 2 ** 63 - 1, 2.5, "ünïcode", "", None, True, False], "b" : {"c" : [], "d" : {}}, "e" : (1, 2)}
+    out = bytearray()
+    pack_value(value, out)
+    assert unpack_value(out, 0) == ({"a" : value["a"], "b" : value["b"], "e" : [1, 2]}, len(out))
+    try:
+        pack_value({1, 2}, bytearray())
+        assert False
+    except BinaryEncodingError:
+        pass
+
+def make_packet(command, data, **fields) -> Packet:
+    packet = Packet()
+    packet["command"] = command
+    packet["data"] = data
+    packet.update(fields)
+    return packet
+
+def binary_round_trip(packet):
+    assert BINARY_ENCODING.loads(BINARY_ENCODING.dumps(packet)) == packet
+
+def test_binary_board_schemas():
+    colors = ["hsl({}, 100%, 50%)".format(i) for i in range(64)]
+    board = [[[colors[i * 8 + j], "SO"[(i + j) % 2]] for j in range(8)] for i in range(8)]
+    board[7][7] = ["silver", ""] # 63 colors and the unowned cells fill the palette
+    binary_round_trip(make_packet("game_runner_board_status", {"sequence" : 7, "board" : board}))
+    binary_round_trip(make_packet("game_runner_board_delta", {"sequence" : 8, "cells" : [
+        [0, 1, colors[0], "S"], [300, 2, colors[62], "O"], [4, 5, "silver", ""]
+    ]}))
+    binary_round_trip(make_packet("game_runner_my_turn", {"row" : 3, "column" : 4, "letter" : "O"}))
+    binary_round_trip(make_packet("login_response", {"session_id" : "token"}, keep_alive = True))
+    board[7][7] = [colors[63], "S"] # a 64th color does not fit in the 6 bits of a cell
+    try:
+        BINARY_ENCODING.dumps(make_packet("game_runner_board_status", {"sequence" : 7, "board" : board}))
+        assert False
+    except BinaryEncodingError:
+        pass
+    try:
+        BINARY_ENCODING.loads(bytes([255]))
+        assert False
+    except BinaryEncodingError:
+        pass
+
+def test_binary_decoding_rejects_malformed_payloads():
+    generator = random.Random(0)
+    payloads = [BINARY_ENCODING.dumps(packet) for packet in [
+        board_status_packet(6),
+        make_packet("game_runner_board_delta", {"sequence" : 2, "cells" : [[1, 2, "hsl(0, 100%, 50%)", "S"]]}),
+        make_packet("game_runner_my_turn", {"row" : 1, "column" : 2, "letter" : "O"}),
+        make_packet("login_request", {"username" : "ünïcode", "password" : "password"}, keep_alive = True)
+    ]]
+    malformed = [payload[:i] for payload in payloads for i in range(len(payload))]
+    malformed += [generator.randbytes(generator.randrange(1, 64)) for i in range(2000)]
+    malformed.append(bytes([COMMAND_IDS["login_request"]]) + b"l\x00\x00\x00\x01" * 1000) # nested too deep
+    for payload in malformed:
+        try:
+            BINARY_ENCODING.loads(payload)
+        except BinaryEncodingError as error:
+            assert isinstance(error, ProtocolError)
+
+def wait_for(connection, command) -> Packet:
+    while True:
+        packet = connection.recv()
+        assert packet, "Connection closed before {}.".format(command)
+        if packet["command"] == command:
+            return packet
+
+def test_malformed_frames_disconnect_the_player():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "malformed.sqlite3"))
+    db_manager.add_account("player", "password", "PLA", "YER")
+    session_id = db_manager.login("player", "password")
+    port = free_port()
+    server = GameServer(db_manager, "127.0.0.1", port)
+    server.start()
+    try:
+        time.sleep(0.2)
+        connection = request(port, "new_game_request", {
+            "session_id" : session_id, "board_size" : 3, "player_count" : 2, "is_public" : True, "max_hint" : 1
+        }, encoding = "binary")
+        my_turn = BINARY_ENCODING.dumps(make_packet("game_runner_my_turn", {"row" : 0, "column" : 0, "letter" : "S"}))
+        for payload in [my_turn[:3], my_turn[:1] + b"garbage", b"", None]:
+            connection.sock.settimeout(5) # a listener killed by the frame would leave the client waiting
+            connection.encoding = BINARY_ENCODING
+            game_id = wait_for(connection, "game_runner_game_details")["data"]["game_id"]
+            if payload is None: # the game still takes moves after all that
+                break
+            connection.sock.sendall(encode_frame(payload))
+            wait_for(connection, "game_runner_abort")
+            assert connection.recv() == {}
+            connection = request(port, "join_game_request", {
+                "session_id" : session_id, "game_id" : game_id, "creator_username" : "player"
+            }, encoding = "binary")
+    finally:
+        server.stop()
+        server.join()
+
+def raw_frame(payload : bytes) -> bytes:
+    return LENGTH_PREFIX.pack(len(payload)) + payload
+
+def test_frame_reader_split_and_batched_frames():
+    reader_sock, writer_sock = socket.socketpair()
+    reader = FrameReader(reader_sock, buffer_size = 8) # smaller than a frame, the buffer has to grow and compact
+    frame = raw_frame(bytes(range(100)))
+    def send_split():
+        for chunk in (frame[:2], frame[2:7], frame[7:60], frame[60:]):
+            writer_sock.sendall(chunk)
+            time.sleep(0.02)
+    sender = threading.Thread(target=send_split)
+    sender.start()
+    assert bytes(reader.read_frame()) == bytes(range(100))
+    sender.join()
+    writer_sock.sendall(raw_frame(b"first") + raw_frame(b"") + raw_frame(b"third") + frame[:3])
+    assert bytes(reader.read_frame()) == b"first"
+    assert reader.has_pending()
+    assert bytes(reader.read_frame()) == b""
+    assert bytes(reader.read_frame()) == b"third"
+    assert reader.take_pending() == frame[:3]
+    reader.put_pending(frame[:3])
+    writer_sock.sendall(frame[3:])
+    assert bytes(reader.read_frame()) == bytes(range(100))
+    writer_sock.close()
+    assert reader.read_frame() is None
+
+def test_frame_reader_rejects_oversized_frames():
+    reader_sock, writer_sock = socket.socketpair()
+    reader = FrameReader(reader_sock, max_frame_size = 16)
+    writer_sock.sendall(raw_frame(bytes(16)) + LENGTH_PREFIX.pack(17))
+    assert len(reader.read_frame()) == 16
+    try:
+        reader.read_frame()
+        assert False
+    except FrameTooLargeError:
+        pass
+    writer_sock.close()
+
+def test_malformed_frames_raise_protocol_errors():
+    server_sock, client_sock = socket.socketpair()
+    server = Connection(server_sock)
+    for payload in [b"", b"{", b"[1, 2]", b"\xff\xfe", b"[" * 100000]:
+        client_sock.sendall(encode_frame(payload))
+        try:
+            server.recv()
+            assert False
+        except ProtocolError:
+            pass
+    server.encoding = BINARY_ENCODING
+    client_sock.sendall(encode_frame(b""))
+    try:
+        server.recv() # not mistaken for the end of the stream
+        assert False
+    except BinaryEncodingError:
+        pass
+    client_sock.close()
+    assert server.recv() == {}
+    server.close()
+
+def board_status_packet(board_size) -> Packet:
+    return make_packet("game_runner_board_status", {"sequence" : 1, "board" : [
+        [["hsl({}, 100%, 50%)".format(i * 18), "SO"[j % 2]] if (i + j) % 4 else ["silver", ""] for j in range(board_size)]
+        for i in range(board_size)
+    ]})
+
+def test_compression_negotiation_and_frames():
+    assert negotiate_compression(make_packet("login_request", {}, compression = "zlib")) is ZLIB_COMPRESSION
+    assert negotiate_compression(make_packet("login_request", {}, compression = "brotli")) is None
+    assert negotiate_compression(make_packet("login_request", {})) is None
+    payload = board_status_packet(20).toJson().encode(encoding="utf-8")
+    frame = encode_frame(payload, compression = ZLIB_COMPRESSION)
+    prefix = LENGTH_PREFIX.unpack_from(frame)[0]
+    assert prefix & COMPRESSED_FLAG and prefix & ~COMPRESSED_FLAG == len(frame) - LENGTH_PREFIX.size
+    assert len(frame) - LENGTH_PREFIX.size < len(zlib.compress(payload, 6)) # the preset dictionary pays off
+    small = b'{"command": "game_runner_your_turn"}'
+    assert LENGTH_PREFIX.unpack_from(encode_frame(small, compression = ZLIB_COMPRESSION))[0] == len(small)
+    noise = random.Random(0).randbytes(2048) # compressing would make it longer, it is sent as it is
+    assert LENGTH_PREFIX.unpack_from(encode_frame(noise, compression = ZLIB_COMPRESSION))[0] == len(noise)
+
+def test_compressed_frames_round_trip():
+    server_sock, client_sock = socket.socketpair()
+    server = Connection(server_sock, compression = ZLIB_COMPRESSION)
+    client = Connection(client_sock, compression = ZlibCompression())
+    packet = board_status_packet(20)
+    server.send(packet)
+    assert client.recv() == packet
+    client.max_frame_size = 1024 # the decompressed frame is larger
+    server.send(packet)
+    try:
+        client.recv()
+        assert False
+    except FrameTooLargeError:
+        pass
+    plain_client = Connection(client_sock)
+    server.send(packet)
+    try:
+        plain_client.recv()
+        assert False
+    except ProtocolError:
+        pass
+    server_sock.sendall(LENGTH_PREFIX.pack(7 | COMPRESSED_FLAG) + DEFAULT_CODEC.encode(b"corrupt"))
+    try:
+        client.recv()
+        assert False
+    except ProtocolError:
+        pass
+    server.close()
+    client.close()
+
+def test_command_registry_dispatch_and_metrics():
+    registry = CommandRegistry()
+    @registry.command("echo_request", "text")
+    def echo(owner, data):
+        return {"text" : owner + data["text"]}
+    @registry.command("fail_request")
+    def fail(owner, data):
+        raise ValueError("Nothing works.")
+    registry.register("quiet_request", lambda owner, data: None)
+    assert "echo_request" in registry and "unknown_request" not in registry
+    assert registry.dispatch(">", make_packet("echo_request", {"text" : "hi"})) == make_packet("echo_response", {"text" : ">hi"})
+    assert registry.dispatch(">", make_packet("echo_request", {})) == make_packet("echo_response", {"error" : "Missing fields: text."})
+    assert registry.dispatch(">", make_packet("echo_request", "not a dict"))["data"] == {"error" : "Missing fields: text."}
+    assert registry.dispatch(">", make_packet("fail_request", {})) == make_packet("fail_response", {"error" : "Nothing works."})
+    assert registry.dispatch(">", make_packet("quiet_request", {})) is None
+    assert registry.dispatch(">", make_packet("unknown_request", {})) is None # not answered, nor counted
+    metrics = registry.metrics()
+    assert sorted(metrics) == ["echo_request", "fail_request", "quiet_request"]
+    assert (metrics["echo_request"]["count"], metrics["echo_request"]["errors"]) == (3, 2)
+    assert (metrics["fail_request"]["count"], metrics["fail_request"]["errors"]) == (1, 1)
+    assert (metrics["quiet_request"]["count"], metrics["quiet_request"]["errors"]) == (1, 0)
+    assert 0 <= metrics["echo_request"]["p50_ms"] <= metrics["echo_request"]["p99_ms"] <= metrics["echo_request"]["max_ms"]
+    latencies = list(range(1, 11))
+    assert [CommandMetrics.percentile(latencies, percentile) for percentile in (1, 50, 90, 99, 100)] == [1, 5, 9, 10, 10]
+    assert CommandMetrics.percentile([], 50) == 0.0
+
+def test_outbound_queue_coalesces_snapshots():
+    queue = OutboundQueue()
+    queue.put(b"board 1", "board", True)
+    queue.put(b"delta 2", "board")
+    queue.put(b"players 1", "players", True)
+    queue.put(b"hint")
+    queue.put(b"board 3", "board", True) # replaces board 1 and delta 2
+    queue.put(b"delta 4", "board")
+    assert queue.take(block = False) == [b"players 1", b"hint", b"board 3", b"delta 4"]
+    assert queue.coalesced_frames == 2
+    assert queue.take(block = False) == []
+    queue.put(b"players 2", "players", True)
+    assert queue.close(b"abort")
+    assert queue.take() == [b"players 2", b"abort"]
+    assert queue.take() is None
+
+def test_outbound_queue_slow_consumer():
+    queue = OutboundQueue(max_queued_bytes = 10, slow_consumer_timeout = 0.05)
+    queue.put(bytes(8))
+    queue.put(bytes(8)) # over the limit, not for long yet
+    time.sleep(0.1)
+    try:
+        queue.put(bytes(1))
+        assert False
+    except SlowConsumerError:
+        pass
+    assert queue.take() is None
+    queue = OutboundQueue(max_queued_bytes = 10, slow_consumer_timeout = 60)
+    try:
+        queue.put(bytes(41)) # past HARD_LIMIT_FACTOR times the limit
+        assert False
+    except SlowConsumerError:
+        pass
+
+def test_slow_consumer_gets_abort_packet_last():
+    server_sock, client_sock = socket.socketpair()
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    server = Connection(server_sock)
+    server.start_writer(make_packet("game_runner_abort", {}), max_queued_bytes = 16 * 1024, slow_consumer_timeout = 5)
+    for i in range(200): # the client reads nothing meanwhile
+        server.send(make_packet("game_runner_players_status", {"sequence" : i, "padding" : "x" * 4096}))
+    client = Connection(client_sock)
+    packets = []
+    while True:
+        packet = client.recv()
+        if not packet:
+            break
+        packets.append(packet)
+    assert packets[-1]["command"] == "game_runner_abort" and "behind" in packets[-1]["data"]["error"]
+    assert [packet["data"]["sequence"] for packet in packets[:-1]] == list(range(len(packets) - 1))
+    assert len(packets) < 200
+    try:
+        server.recv()
+        assert False
+    except SlowConsumerError:
+        pass
+    server.close()
+
+def rejected(admission) -> bool:
+    try:
+        with admission:
+            return False
+    except AdmissionRejectedError:
+        return True
+
+def test_admission_control_rejections():
+    controller = AdmissionController(per_client_rate = 0.001, per_client_burst = 2)
+    assert [rejected(controller.admit("a")) for i in range(3)] == [False, False, True]
+    assert not rejected(controller.admit("b"))
+    controller = AdmissionController(per_client_rate = 0.001, per_client_burst = 1, global_rate = 20, global_burst = 1)
+    assert not rejected(controller.admit("a"))
+    assert rejected(controller.admit("b")) and rejected(controller.admit("b"))
+    time.sleep(0.1)
+    assert not rejected(controller.admit("b")) # the global rejections left b's own token
+    stats = controller.stats()
+    assert (stats["admitted"], stats["rejected_client_rate"], stats["rejected_global_rate"]) == (2, 0, 2)
+    controller = AdmissionController(max_pending = 1)
+    with controller.admit("a"):
+        assert rejected(controller.admit("b"))
+    assert not rejected(controller.admit("b"))
+    stats = controller.stats()
+    assert (stats["admitted"], stats["rejected_pending"], stats["pending"]) == (2, 1, 0)
+
+def play_random_game(boards, board_size, seed):
+    # plays the same random moves on every board and checks they agree after each one
+    generator = random.Random(seed)
+    cells = [(i, j) for i in range(board_size) for j in range(board_size)]
+    generator.shuffle(cells)
+    for row, column in cells:
+        account_id = generator.randint(1, 4)
+        letter = generator.choice("SO")
+        expected_moves = boards[0].scoring_moves()
+        results = []
+        for board in boards:
+            assert board.scoring_moves() == expected_moves
+            assert board.count_sos_triples(row, column, letter) == expected_moves.get((row, column, letter), 0)
+            board.set_cell(row, column, account_id, letter)
+            changed_cells = {(row, column) : True}
+            found, count = board.check_for_sos_triple(account_id, row, column, letter, changed_cells = changed_cells)
+            results.append((found, count, list(changed_cells)))
+        assert all(result == results[0] for result in results)
+        for i in range(board_size):
+            for j in range(board_size):
+                assert all(board.owner(i, j) == boards[0].owner(i, j) for board in boards)
+                assert all(board.letter(i, j) == boards[0].letter(i, j) for board in boards)
+
+def test_numpy_board_matches_board():
+    for seed in range(40):
+        board_size = 3 + seed % 8
+        play_random_game([Board(board_size), NumpyBoard(board_size), CompactBoard(board_size)], board_size, seed)
+
+def test_numpy_board_checkpoint_matches_compact_board():
+    for seed in range(10):
+        board_size = 3 + seed % 8
+        boards = [NumpyBoard(board_size), CompactBoard(board_size)]
+        play_random_game(boards, board_size, seed)
+        assert boards[0].letter_codes() == boards[1].letter_codes()
+        assert boards[0].checkpoint() == boards[1].checkpoint()
+        restored = NumpyBoard.from_checkpoint(board_size, *boards[1].checkpoint())
+        assert restored.checkpoint() == boards[1].checkpoint()
+        assert restored.scoring_moves() == boards[1].scoring_moves()
+
+def test_numpy_board_scoring_moves():
+    board = NumpyBoard(5)
+    board.set_cell(0, 0, 1, "S")
+    board.set_cell(0, 1, 1, "O")
+    board.set_cell(2, 2, 2, "S")
+    assert board.scoring_moves() == {(0, 2, "S") : 1, (1, 1, "O") : 1}
+    assert board.check_for_sos_triple(3, 1, 1, "O", no_act = True) == (True, 1)
+    assert board.owner(0, 0) == 1
+
+def test_sos_index_matches_board():
+    for seed in range(10):
+        board_size = 3 + seed
+        generator = random.Random(seed)
+        board = Board(board_size)
+        index = SosOpportunityIndex(board_size, board.count_sos_triples)
+        cells = [(i, j) for i in range(board_size) for j in range(board_size)]
+        generator.shuffle(cells)
+        for row, column in cells:
+            board.set_cell(row, column, 1, generator.choice("SO"))
+            index.place(row, column)
+            scoring_moves = board.scoring_moves()
+            assert index.scoring_moves() == scoring_moves
+            best_move = index.best_move()
+            if scoring_moves:
+                best_count = max(scoring_moves.values())
+                assert best_move == min(move for move, count in scoring_moves.items() if count == best_count)
+                assert index.count(*best_move) == best_count
+            else:
+                assert best_move is None
+
+def test_async_runner_survives_failing_task():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "async.sqlite3"))
+    db_manager.add_account("async", "password", "AS", "YNC")
+    game_id, account_id = db_manager.new_game(db_manager.login("async", "password"), 3, 2, True, 1)
+    async def play():
+        runner = AsyncGameRunner(db_manager, game_id, asyncio.get_running_loop())
+        task = asyncio.get_running_loop().create_task(runner.run_async())
+        runner.enqueue_task({ # fails, the game has not started yet
+            "command" : "player_turn_done_task", "account_id" : account_id, "row" : 0, "column" : 0, "letter" : "S"
+        })
+        await asyncio.sleep(0.2)
+        assert not task.done()
+        runner.stop()
+        await asyncio.wait_for(task, 5)
+    asyncio.run(play())
+    assert db_manager.db_cursor.execute("SELECT is_running FROM Games WHERE (game_id = ?);", (game_id,)).fetchone()[0] == 0
+
+def test_shard_handoff_keeps_pending_bytes():
+    front_sock, shard_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    player_sock, client_sock = socket.socketpair()
+    pending = random.Random(0).randbytes(1024 * 1024 + 5) # a whole frame read ahead
+    sender = threading.Thread(target=lambda: [
+        send_control_message(front_sock, {"game_id" : 1}, [player_sock.fileno()], pending),
+        send_control_message(front_sock, {"game_id" : 2})
+    ])
+    sender.start()
+    message, fds = recv_control_message(shard_sock)
+    assert (message["game_id"], message["pending"]) == (1, pending)
+    with socket.socket(fileno=fds[0]) as handed_sock:
+        handed_sock.send(b"ping")
+        assert client_sock.recv(4) == b"ping"
+    message, fds = recv_control_message(shard_sock)
+    assert (message["game_id"], message["pending"], fds) == (2, b"", [])
+    sender.join()
+    front_sock.close()
+    assert recv_control_message(shard_sock)[0] is None
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def request(port, command, data, **fields):
+    connection = Connection(socket.create_connection(("127.0.0.1", port)))
+    connection.send(make_packet(command, data, **fields))
+    return connection
+
+def test_shard_gets_large_read_ahead():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "sharded.sqlite3"))
+    db_manager.add_account("player", "password", "PLA", "YER")
+    session_id = db_manager.login("player", "password")
+    port = free_port()
+    server = create_game_server(db_manager, "127.0.0.1", port, shard_count = 1)
+    server.start()
+    try:
+        time.sleep(0.5)
+        padding = "x" * 256 * 1024
+        connection = request(port, "signout_request", {"session_id" : "unknown", "padding" : padding}, keep_alive = True)
+        assert connection.recv()["keep_alive"] # the front process now reads up to 256 KiB at once
+        connection.sock.sendall(connection.to_frame(make_packet("new_game_request", {
+            "session_id" : session_id, "board_size" : 3, "player_count" : 1, "is_public" : True, "max_hint" : 1
+        })) + connection.to_frame(make_packet("game_runner_my_turn", {"row" : 1, "column" : 2, "letter" : "S", "padding" : padding})))
+        connection.sock.settimeout(10)
+        color = wait_for(connection, "game_runner_game_details")["data"]["color"]
+        assert wait_for(connection, "game_runner_board_delta")["data"]["cells"] == [[1, 2, color, "S"]]
+    finally:
+        server.stop()
+        server.join()
+
+def test_keep_alive_connections_close():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "keepalive.sqlite3"))
+    port = free_port()
+    server = GameServer(db_manager, "127.0.0.1", port, keep_alive_timeout = 0.3, keep_alive_max_requests = 3)
+    server.start()
+    try:
+        time.sleep(0.2)
+        connection = request(port, "signout_request", {"session_id" : "unknown"}, keep_alive = True)
+        for i in range(2):
+            assert connection.recv()["keep_alive"]
+            time.sleep(0.1) # parked with the keep-alive watcher meanwhile
+            connection.send(make_packet("signout_request", {"session_id" : "unknown"}, keep_alive = True))
+        assert not connection.recv()["keep_alive"] # the third request is the last one
+        assert connection.recv() == {}
+        connection = request(port, "signout_request", {"session_id" : "unknown"}, keep_alive = True)
+        assert connection.recv()["keep_alive"]
+        started = time.monotonic()
+        assert connection.recv() == {} # closed after keep_alive_timeout without a request
+        assert 0.2 < time.monotonic() - started < 2
+    finally:
+        server.stop()
+        server.join()
+
+def exhaustive_value(letters, size):
+    # what negamax computes, without pruning, table or move ordering
+    values = []
+    for index in range(size * size):
+        if letters[index] == bot.EMPTY:
+            for letter in (bot.S, bot.O):
+                gain = bot.count_triples(letters, size, index // size, index % size, letter)
+                letters[index] = letter
+                value = exhaustive_value(letters, size)
+                letters[index] = bot.EMPTY
+                values.append(gain + value if gain else -value)
+    return max(values) if values else 0
+
+def test_bot_negamax_matches_exhaustive_search():
+    generator = random.Random(0)
+    for i in range(20):
+        letters = bytearray(9)
+        for index in generator.sample(range(9), 4):
+            letters[index] = generator.choice((bot.S, bot.O))
+        expected = exhaustive_value(letters, 3)
+        bot.transposition_table.clear()
+        for j in range(2): # the second search is answered from the transposition table
+            assert bot.negamax(letters, 3, 5, -9, 9, time.monotonic() + 60) == expected
+        assert bot.transposition_table
+
+def test_bot_ordered_moves_caps_isolated_cells():
+    letters = bytearray(10 * 10)
+    letters[0] = bot.S
+    letters[1] = bot.O
+    moves = bot.ordered_moves(letters, 10)
+    assert moves[0] == (1, 2, bot.S)
+    isolated = [index for gain, index, letter in moves if bot.is_isolated(letters, 10, *divmod(index, 10))]
+    assert len(isolated) == bot.MAX_QUIET_ISOLATED
+    assert all(letter == bot.S for gain, index, letter in moves if index in isolated)
+    assert len(moves) == 2 * (3 * 4 - 2) + bot.MAX_QUIET_ISOLATED
+
+def test_bot_search():
+    letters = bytes([bot.S, bot.O, bot.EMPTY] + [bot.EMPTY] * 22)
+    assert bot.search(letters, 5, 0.2) == (0, 2, "S")
+    assert bot.search(bytes([bot.S] * 9), 3, 0.2) is None
+    started = time.monotonic()
+    row, column, letter = bot.search(bytes(15 * 15), 15, 0.1)
+    assert time.monotonic() - started < 0.5
+    assert 0 <= row < 15 and 0 <= column < 15 and letter in "SO"
+
+def test_bot_plays_first_move_without_worker():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "bot.sqlite3"))
+    db_manager.add_account("human", "password", "HU", "MAN")
+    game_id, account_id = db_manager.new_game(db_manager.login("human", "password"), 3, 2, True, 1)
+    runner = GameRunner(db_manager, game_id)
+    connection = bot.BotConnection("easy")
+    connection.attach(runner, 7)
+    future = Future()
+    future.set_exception(RuntimeError("worker process died"))
+    connection.play(future, bytes([bot.S, bot.O] + [bot.EMPTY] * 7), 3)
+    task = runner._tasks_queue.dequeue()
+    assert (task["command"], task["account_id"], task["row"], task["column"], task["letter"]) == ("player_turn_done_task", 7, 0, 2, "S")
+    connection.play(future, bytes([bot.S] * 9), 3) # nothing left to play
+    assert runner._tasks_queue.dequeue() is None
+
+def test_bot_game_runs_to_the_end():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "bots.sqlite3"))
+    port = free_port()
+    server = GameServer(db_manager, "127.0.0.1", port)
+    server.start()
+    try:
+        time.sleep(0.2)
+        request(port, "signup_request", {"username" : "human", "password" : "password", "firstname" : "HU", "lastname" : "MAN"}).recv()
+        session_id = request(port, "login_request", {"username" : "human", "password" : "password"}).recv()["data"]["session_id"]
+        assert "error" in request(port, "new_game_request", {
+            "session_id" : session_id, "board_size" : 3, "player_count" : 2, "is_public" : True, "max_hint" : 1, "bots" : ["easy", "easy"]
+        }).recv()["data"]
+        connection = request(port, "new_game_request", {
+            "session_id" : session_id, "board_size" : 4, "player_count" : 3, "is_public" : True, "max_hint" : 1, "bots" : ["easy", "medium"]
+        })
+        empty_cells = [(i, j) for i in range(4) for j in range(4)]
+        while True:
+            packet = connection.recv()
+            if packet["command"] == "game_runner_board_delta":
+                for row, column, color, letter in packet["data"]["cells"]:
+                    if (row, column) in empty_cells:
+                        empty_cells.remove((row, column))
+            elif packet["command"] == "game_runner_players_status":
+                usernames = sorted(packet["data"]["scores"])
+            elif packet["command"] == "game_runner_your_turn":
+                move = Packet()
+                move["command"] = "game_runner_my_turn"
+                move["data"] = {"row" : empty_cells[0][0], "column" : empty_cells[0][1], "letter" : "O"}
+                connection.send(move)
+            elif packet["command"] == "game_runner_winner_announced":
+                break
+        assert empty_cells == []
+        assert usernames == ["easy_bot_1", "human", "medium_bot_1"]
+        game_id = db_manager.db_cursor.execute("SELECT MAX(game_id) FROM Games;").fetchone()[0]
+        assert db_manager.db_cursor.execute("SELECT is_running FROM Games WHERE (game_id = ?);", (game_id,)).fetchone()[0] == 0
+        leave = Packet()
+        leave["command"] = "game_runner_disconnect"
+        connection.send(leave)
+    finally:
+        server.stop()
+        server.join()
+    assert db_manager.db_cursor.execute("SELECT COUNT(*) FROM GameLogs WHERE (game_id = ?);", (game_id,)).fetchone()[0] == 16
+
+def test_game_replay_matches_game():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "replay.sqlite3"))
+    db_manager.add_account("replay", "replay", "RE", "PLAY")
+    game_id, account_id = db_manager.new_game(db_manager.login("replay", "replay"), 9, 2, True, 3)
+    generator = random.Random(0)
+    cells = [(i, j) for i in range(9) for j in range(9)]
+    generator.shuffle(cells)
+    board = CompactBoard(9)
+    scores = {account_id : 0}
+    expected = [(board.checkpoint(), dict(scores))]
+    moves = []
+    for row, column in cells:
+        player = generator.choice([account_id, account_id + 1])
+        if generator.random() < 0.1: # a hint costs a point even when there was nothing to suggest
+            db_manager.add_game_hint(game_id, player, generator.choice(["S", ""]), row, column)
+            scores[player] = scores.get(player, 0) - 1
+        letter = generator.choice("SO")
+        board.set_cell(row, column, player, letter)
+        db_manager.add_game_log(game_id, player, letter, row, column)
+        scores[player] = scores.get(player, 0) + board.check_for_sos_triple(player, row, column, letter)[1]
+        expected.append((board.checkpoint(), dict(scores)))
+        moves.append((len(moves) + 1, player, row, column, letter))
+    assert db_manager.db_cursor.execute("SELECT COUNT(*) FROM GameHints WHERE (letter = '');").fetchone()[0] > 0
+    replay = GameReplay(db_manager.db_path)
+    replay.CHECKPOINT_INTERVAL = 8
+    for move_number in list(range(len(expected))) * 2: # the second pass starts from checkpoints
+        replayed_board, replayed_scores = replay.replay(game_id, move_number)
+        assert (replayed_board.checkpoint(), replayed_scores) == expected[move_number]
+    replay.BATCH_SIZE = 7
+    assert [move[:5] for move in replay.moves(game_id)] == moves
+    assert [move[:5] for move in replay.moves(game_id, 70, 72)] == moves[70:72]
+    try:
+        replay.replay(game_id, len(cells) + 1)
+        assert False
+    except WrongMoveNumberError:
+        pass
+
+def test_account_cache_writes_through():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "cache.sqlite3"))
+    db_manager.add_account("cached", "password", "CA", "CHED")
+    session_token = db_manager.login("cached", "password")
+    account_id = db_manager.validate_session_token(session_token)
+    assert db_manager.get_username_from_account_id(account_id) == "cached"
+    assert db_manager.get_username_from_account_id(account_id) == "cached"
+    assert db_manager.account_cache.stats()["hits"] == 1
+    db_manager.edit_profile(session_token, "password", "NEW", "NAME")
+    assert db_manager.get_cached_account(account_id) == {"username" : "cached", "first_name" : "NEW", "last_name" : "NAME"}
+    db_manager.change_username(session_token, "password", "renamed")
+    assert db_manager.get_username_from_account_id(account_id) == "renamed"
+    db_manager.edit_account(account_id, "edited", "password", "CA", "CHED", False, False)
+    assert db_manager.get_username_from_account_id(account_id) == "edited"
+    db_manager.remove_account(db_manager.login("edited", "password"), "password")
+    assert db_manager.get_username_from_account_id(account_id) == "DELETED_ACCOUNT_{}".format(account_id)
+    stats = db_manager.account_cache.stats()
+    assert (stats["misses"], stats["writes"]) == (1, 4) # every write went through, nothing was read again
+    stale, generation = db_manager.account_cache.get(account_id + 1)
+    db_manager.account_cache.write(account_id + 1, {"username" : "other"}) # not cached, a partial entry is not added
+    db_manager.account_cache.put(account_id + 1, {"username" : "stale"}, generation)
+    assert db_manager.account_cache.get(account_id + 1)[0] is None
+
+def test_connection_pool_gives_each_thread_its_own_connection():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "pool.sqlite3"))
+    connections = [db_manager.db_connection]
+    thread = threading.Thread(target=lambda: connections.append(db_manager.db_connection))
+    thread.start()
+    thread.join()
+    assert connections[1] is not connections[0]
+    assert db_manager.db_connection is connections[0]
+    for connection in connections:
+        assert connection.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+        assert connection.execute("PRAGMA synchronous;").fetchone()[0] == 1 # NORMAL
+        assert connection.execute("PRAGMA busy_timeout;").fetchone()[0] == ConnectionPool.BUSY_TIMEOUT_MS
+    assert db_manager.connection_pool.connection_count() == 2
+    db_manager.close_connection()
+    for connection in connections:
+        try:
+            connection.execute("SELECT 1;")
+            assert False
+        except sqlite3.ProgrammingError: # closed
+            pass
+    assert db_manager.connection_pool.connection_count() == 0
+    assert db_manager.db_connection not in connections # the pool opens a new one on the next use
+
+def test_game_journal_writes_beside_locked_writers():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "concurrent.sqlite3"))
+    journal = GameJournal(db_manager, max_batch = 8)
+    journal.start()
+    def add_accounts():
+        for i in range(50):
+            assert db_manager.add_account("writer{}".format(i), "password", "WRI", "TER") is True
+    thread = threading.Thread(target=add_accounts)
+    thread.start()
+    for i in range(400):
+        journal.add_game_log(1, 1, "SO"[i % 2], i, i)
+    thread.join()
+    journal.stop()
+    assert (journal.stats()["records"], journal.stats()["failed_records"]) == (400, 0)
+    assert db_manager.db_cursor.execute("SELECT COUNT(*) FROM GameLogs;").fetchone()[0] == 400
+    assert db_manager.db_cursor.execute("SELECT COUNT(*) FROM Accounts WHERE username LIKE 'writer%';").fetchone()[0] == 50
+
+def test_game_journal_writes_behind():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "journal.sqlite3"))
+    journal = GameJournal(db_manager, max_batch = 4, flush_interval = 10)
+    journal.start()
+    for i in range(6):
+        journal.add_game_log(1, 1, "SO"[i % 2], i, i)
+    journal.add_game_hint(1, 1, "S", -1, 0) # breaks the CHECK on row_number, only this record is dropped
+    journal.add_game_hint(1, 1, "S", 1, 1)
+    journal.flush()
+    assert db_manager.db_cursor.execute("SELECT log_number, row_number FROM GameLogs ORDER BY log_number;").fetchall() == [
+        (i + 1, i + 1) for i in range(6)
+    ]
+    assert db_manager.db_cursor.execute("SELECT hint_number, letter FROM GameHints;").fetchall() == [(1, "S")]
+    journal.add_game_log(1, 1, "S", 7, 7)
+    journal.stop()
+    assert db_manager.db_cursor.execute("SELECT COUNT(*) FROM GameLogs;").fetchone()[0] == 7
+    stats = journal.stats()
+    assert (stats["records"], stats["failed_records"], stats["pending"]) == (8, 1, 0)
+
+def test_reloaded_game_continues_numbering():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "numbers.sqlite3"))
+    journal = GameJournal(db_manager)
+    journal.start()
+    runner, clients = start_game(db_manager, ["alone"], board_size = 4, max_hint = 2, journal = journal)
+    account_id = next(iter(clients))
+    game_id = runner._GameRunner__game_id
+    def play_and_ask(runner, cells):
+        for row, column in cells:
+            play(runner, account_id, row, column, "O")
+        runner.handle_task({"command" : "please_help_task", "account_id" : account_id})
+    play_and_ask(runner, [(0, 0), (1, 1)])
+    journal.flush()
+    clients[account_id].close()
+    runner = GameRunner(db_manager, game_id, journal = journal) # as after a restart
+    client = join_player(runner, account_id)
+    play_and_ask(runner, [(2, 2), (3, 3), (0, 3)])
+    play_and_ask(runner, [])
+    journal.stop()
+    client.close()
+    logs = db_manager.db_cursor.execute("SELECT log_number, row_number FROM GameLogs WHERE game_id = ? ORDER BY gamelog_id;", (game_id,)).fetchall()
+    assert logs == [(1, 1), (2, 2), (3, 3), (4, 4), (5, 1)]
+    hints = db_manager.db_cursor.execute("SELECT hint_number FROM GameHints WHERE game_id = ? ORDER BY gamehint_id;", (game_id,)).fetchall()
+    assert hints == [(1,), (2,), (3,)]
+    assert db_manager.get_game_sequence_numbers(game_id) == (5, 3)
+
+def full_table_scans(connection, statements):
+    # (statement, plan step) for every step of the query plans that reads a whole table
+    scans = []
+    for statement in statements:
+        if statement.split()[0].upper() in ("SELECT", "UPDATE", "DELETE"):
+            for step in connection.execute("EXPLAIN QUERY PLAN " + statement).fetchall():
+                if step[3].startswith("SCAN") and step[3] != "SCAN CONSTANT ROW":
+                    scans.append((statement, step[3]))
+    return scans
+
+def test_hot_queries_use_indexes():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "plans.sqlite3"))
+    assert db_manager.schema_version() == len(DatabaseManager.MIGRATIONS)
+    db_manager.add_account("creator", "password", "CRE", "ATOR")
+    db_manager.add_account("player", "password", "PLA", "YER")
+    statements = []
+    db_manager.db_connection.set_trace_callback(statements.append)
+    creator_token = db_manager.login("creator", "password")
+    player_token = db_manager.login("player", "password")
+    game_id, creator_id = db_manager.new_game(creator_token, 5, 2, True, 3)
+    player_id = db_manager.join_game(player_token, game_id, "creator")
+    db_manager.get_account(player_token)
+    db_manager.get_game_information(game_id)
+    db_manager.get_username_from_account_id(player_id)
+    log_number, hint_number = db_manager.get_game_sequence_numbers(game_id)
+    db_manager.add_game_log(game_id, creator_id, "S", 0, 0, log_number + 1)
+    db_manager.add_game_hint(game_id, player_id, "S", 0, 1, hint_number + 1)
+    db_manager.add_game_log(game_id, player_id, "O", 0, 1)
+    db_manager.update_account_games_and_wins(creator_id, 1, 1)
+    db_manager.set_game_ended(game_id, creator_id)
+    db_manager.logout(player_token)
+    replay = GameReplay(db_manager.db_path)
+    replay.db_connection.set_trace_callback(statements.append)
+    replay.replay(game_id)
+    list(replay.moves(game_id))
+    assert len(statements) > 20
+    assert full_table_scans(db_manager.db_connection, statements) == []
+
+def test_session_cache_invalidation():
+    db_manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "sessions.sqlite3"))
+    db_manager.add_account("session", "password", "SES", "SION")
+    first_token = db_manager.login("session", "password")
+    second_token = db_manager.login("session", "password")
+    account_id = db_manager.validate_session_token(first_token)
+    assert db_manager.validate_session_token(second_token) == account_id
+    assert db_manager.validate_session_token("unknown") == -1
+    statements = []
+    db_manager.db_connection.set_trace_callback(statements.append)
+    for i in range(10):
+        assert db_manager.validate_session_token(first_token) == account_id
+        assert db_manager.validate_session_token("unknown") == -1
+    assert statements == []
+    stats = db_manager.session_cache.stats()
+    assert (stats["hits"], stats["negative_hits"], stats["misses"]) == (10, 10, 3)
+    assert stats["invalidations"] == 0 # a login adds a token, it has nothing to invalidate
+    db_manager.logout(first_token)
+    assert db_manager.validate_session_token(first_token) == -1
+    assert db_manager.validate_session_token(second_token) == account_id
+    db_manager.change_password(second_token, "password", "new password")
+    assert db_manager.validate_session_token(second_token) == -1
+    third_token = db_manager.login("session", "new password")
+    db_manager.session_cache.ttl = 0.01
+    assert db_manager.validate_session_token(third_token) == account_id
+    time.sleep(0.02)
+    assert db_manager.validate_session_token(third_token) == account_id
+    assert db_manager.session_cache.stats()["expirations"] == 1
+    db_manager.remove_account(third_token, "new password")
+    assert db_manager.validate_session_token(third_token) == -1
+
 if __name__ == "__main__":
-    test_game_server()
\ No newline at end of file
+    run_game_server()